@@ -0,0 +1,320 @@
+"""Microbenchmarks for the collector's request pipeline.
+
+This runs :py:meth:`~events.collector.EventCollector.process_request` with
+in-memory queues over a matrix of batch sizes, event sizes, compression and
+signature placement, plus the common error paths. For each case it reports
+the end-to-end time per request, the time taken by each stage of the
+pipeline run in isolation, and allocations per request.
+
+Results can be saved as JSON and compared against an earlier run to catch
+regressions:
+
+    PYTHONPATH=. python benchmarks/collector_bench.py --output before.json
+    # ... make changes ...
+    PYTHONPATH=. python benchmarks/collector_bench.py --compare before.json
+
+"""
+
+import argparse
+from cStringIO import StringIO
+import datetime
+import gc
+import gzip
+import hashlib
+import hmac
+import itertools
+import json
+import platform
+import sys
+import timeit
+
+import baseplate
+import webob
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from events.collector import EventCollector, parse_signature
+from events.compression import decode_body, get_decoder
+from events.const import MAXIMUM_INFLATED_SIZE, MAXIMUM_MESSAGE_SIZE
+from events.envelope import make_envelope_affixes, split_batch
+from events.framing import pack_messages
+from events.keystore import Keystore
+from events.origins import OriginMatcher
+
+
+KEY_NAME = "BenchKey"
+KEY_SECRET = "benchmark secret"
+
+BATCH_SIZES = [1, 10, 100, 500]
+EVENT_SIZES = [100, 1000]
+ERROR_CASES = ["bad_mac", "event_too_big"]
+
+
+class ListQueue(object):
+    def __init__(self):
+        self.messages = []
+
+    def put(self, message, timeout=None):
+        self.messages.append(message)
+
+
+class Case(object):
+    def __init__(self, batch_size, event_size, gzipped, signature, error):
+        self.batch_size = batch_size
+        self.event_size = event_size
+        self.gzipped = gzipped
+        self.signature = signature
+        self.error = error
+
+    @property
+    def name(self):
+        return "batch=%d,event=%d,gzip=%s,sig=%s,error=%s" % (
+            self.batch_size, self.event_size, "on" if self.gzipped else "off",
+            self.signature, self.error or "none")
+
+    def make_body(self):
+        padding = "x" * max(self.event_size - 30, 0)
+        events = [{"seq": i, "payload": padding}
+                  for i in xrange(self.batch_size)]
+        if self.error == "event_too_big":
+            events[-1]["payload"] = "x" * 101 * 1024
+        return json.dumps(events)
+
+    def make_environ(self):
+        body = self.make_body()
+        mac = hmac.new(KEY_SECRET, body, hashlib.sha256).hexdigest()
+        if self.error == "bad_mac":
+            mac = "0" * len(mac)
+
+        headers = {"User-Agent": "Benchmark/1.0"}
+        if self.gzipped:
+            f = StringIO()
+            with gzip.GzipFile(fileobj=f, mode="wb") as gz:
+                gz.write(body)
+            body = f.getvalue()
+            headers["Content-Encoding"] = "gzip"
+
+        path = "/v1"
+        if self.signature == "header":
+            headers["X-Signature"] = "key=%s, mac=%s" % (KEY_NAME, mac)
+        else:
+            path += "?key=%s&mac=%s" % (KEY_NAME, mac)
+
+        request = webob.Request.blank(
+            path, method="POST", body=body, headers=headers)
+        request.environ["REMOTE_ADDR"] = "1.2.3.4"
+        return request.environ, body
+
+
+def make_cases():
+    cases = []
+    for batch_size, event_size, gzipped, signature in itertools.product(
+            BATCH_SIZES, EVENT_SIZES, [False, True], ["header", "query"]):
+        cases.append(Case(batch_size, event_size, gzipped, signature, None))
+    for error in ERROR_CASES:
+        cases.append(Case(10, 1000, False, "header", error))
+    return cases
+
+
+def make_collector():
+    metrics_client = baseplate.metrics.Client(
+        baseplate.metrics.NullTransport(), "bench")
+    return EventCollector(
+        Keystore({KEY_NAME: KEY_SECRET}),
+        metrics_client,
+        ListQueue(),
+        ListQueue(),
+        OriginMatcher(["*"]),
+    )
+
+
+def make_requests(environ, body, count):
+    requests = []
+    for _ in xrange(count):
+        request_environ = dict(environ)
+        request_environ["wsgi.input"] = StringIO(body)
+        requests.append(webob.Request(request_environ))
+    return requests
+
+
+def time_per_call(func, iterations):
+    """Return the average time per call of func in nanoseconds."""
+    timer = timeit.Timer(func)
+    return min(timer.repeat(repeat=3, number=iterations)) / iterations * 1e9
+
+
+def measure_end_to_end(collector, environ, body, iterations):
+    best = None
+    for _ in xrange(3):
+        requests = make_requests(environ, body, iterations)
+        start = timeit.default_timer()
+        for request in requests:
+            collector.process_request(request)
+        elapsed = timeit.default_timer() - start
+        del collector.event_queue.messages[:]
+        del collector.error_queue.messages[:]
+        best = elapsed if best is None else min(best, elapsed)
+    return best / iterations * 1e9
+
+
+def measure_allocations(collector, environ, body, iterations):
+    requests = make_requests(environ, body, iterations)
+
+    if tracemalloc:
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for request in requests:
+            collector.process_request(request)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result = {"peak_bytes": peak - before}
+    else:
+        # without tracemalloc, the best we can do is count how many more
+        # gc-tracked objects exist afterwards.
+        gc.collect()
+        gc.disable()
+        try:
+            before = len(gc.get_objects())
+            for request in requests:
+                collector.process_request(request)
+            result = {"gc_objects": float(len(gc.get_objects()) - before) /
+                      iterations}
+        finally:
+            gc.enable()
+
+    del collector.event_queue.messages[:]
+    del collector.error_queue.messages[:]
+    return result
+
+
+def measure_stages(case, environ, body, iterations):
+    keystore = Keystore({KEY_NAME: KEY_SECRET})
+    stages = {}
+
+    header = "key=%s, mac=%s" % (KEY_NAME, "0" * 64)
+    stages["parse_signature"] = time_per_call(
+        lambda: parse_signature(header), iterations)
+    stages["keystore_lookup"] = time_per_call(
+        lambda: keystore.new_mac(KEY_NAME), iterations)
+
+    if case.gzipped:
+        decoder = get_decoder("gzip")
+        stages["decompress"] = time_per_call(
+            lambda: decode_body(body, decoder, MAXIMUM_INFLATED_SIZE),
+            iterations)
+        body = decode_body(body, decoder, MAXIMUM_INFLATED_SIZE)
+
+    def compute_mac():
+        mac = keystore.new_mac(KEY_NAME)
+        mac.update(body)
+        return mac.hexdigest()
+    stages["hmac"] = time_per_call(compute_mac, iterations)
+
+    stages["json_split"] = time_per_call(lambda: split_batch(body), iterations)
+
+    raw_events = split_batch(body)
+    start_time = datetime.datetime.utcnow()
+
+    def wrap():
+        prefix, suffix = make_envelope_affixes("1.2.3.4", start_time)
+        return [prefix + raw + suffix for raw in raw_events]
+    stages["envelope"] = time_per_call(wrap, iterations)
+
+    envelopes = wrap()
+    queue = ListQueue()
+
+    def enqueue():
+        del queue.messages[:]
+        for envelope in envelopes:
+            queue.put(envelope)
+    stages["enqueue"] = time_per_call(enqueue, iterations)
+    stages["frame"] = time_per_call(
+        lambda: pack_messages(envelopes, MAXIMUM_MESSAGE_SIZE["events"]),
+        iterations)
+    return stages
+
+
+def run_case(case, iterations):
+    environ, body = case.make_environ()
+    # keep the memory used by pre-built requests for big batches in check
+    iterations = max(10, min(iterations, 20 * 1024 * 1024 // max(len(body), 1)))
+    collector = make_collector()
+
+    # warm up caches and lazily initialized state
+    for request in make_requests(environ, body, 5):
+        collector.process_request(request)
+
+    return {
+        "iterations": iterations,
+        "body_bytes": len(body),
+        "end_to_end_ns": measure_end_to_end(
+            collector, environ, body, iterations),
+        "stages_ns": measure_stages(case, environ, body, iterations),
+        "allocations": measure_allocations(
+            collector, environ, body, iterations),
+    }
+
+
+def compare(results, baseline, threshold):
+    """Print how results differ from a baseline and return the regressions."""
+    regressions = []
+    for name, result in sorted(results.iteritems()):
+        try:
+            before = baseline[name]["end_to_end_ns"]
+        except KeyError:
+            continue
+        after = result["end_to_end_ns"]
+        change = (after - before) / before
+        marker = ""
+        if change > threshold:
+            regressions.append(name)
+            marker = "  <-- REGRESSION"
+        print "%-60s %10.0f -> %10.0f ns (%+.1f%%)%s" % (
+            name, before, after, change * 100, marker)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=200,
+                        help="requests per measurement (reduced for big bodies)")
+    parser.add_argument("--filter", default="",
+                        help="only run cases whose name contains this")
+    parser.add_argument("--output", help="save the results as JSON here")
+    parser.add_argument("--compare", help="a previous JSON result to compare to")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="slowdown fraction counted as a regression")
+    args = parser.parse_args()
+
+    results = {}
+    for case in make_cases():
+        if args.filter not in case.name:
+            continue
+        result = run_case(case, args.iterations)
+        results[case.name] = result
+        print "%-60s %10.0f ns/request" % (case.name, result["end_to_end_ns"])
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "meta": {
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "time": datetime.datetime.utcnow().isoformat(),
+                },
+                "results": results,
+            }, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        print
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""Measure the throughput of the injector loop against a fake broker.
+
+This feeds an in-memory queue of synthetic events through the injector's
+processing loop into a :py:class:`~events.sinks.FakeBrokerSink` and reports
+messages per second and acknowledgement latency percentiles. Failed sends
+are retried by a :py:class:`~events.retry.RetryScheduler` as in the
+injector, and the run ends once every event has been delivered or
+dead-lettered. No Kafka or message queue is needed, e.g.:
+
+    PYTHONPATH=. python benchmarks/injector_bench.py --mode batched --messages 100000
+
+"""
+
+import argparse
+import collections
+import json
+import logging
+import sys
+import time
+
+from baseplate.message_queue import TimedOutError
+
+from events.framing import pack_messages
+from events.injector import process_queue, process_queue_batched
+from events.retry import DEFAULT_BASE_DELAY as DEFAULT_RETRY_BASE_DELAY
+from events.retry import DEFAULT_MAX_ATTEMPTS as DEFAULT_RETRY_MAX_ATTEMPTS
+from events.retry import DEFAULT_MAX_DELAY as DEFAULT_RETRY_MAX_DELAY
+from events.retry import RetryScheduler
+from events.sinks import FakeBrokerSink
+from events.stats import summarize_latencies
+
+
+# how long an empty queue waits before timing out, at most. it never gets
+# any more messages, so this only keeps the loop from spinning while the
+# last acknowledgements and retries come in.
+_EMPTY_POLL_SECS = 0.001
+
+
+class InMemoryQueue(object):
+    """A queue of a fixed set of messages."""
+
+    def __init__(self, messages):
+        self.messages = collections.deque(messages)
+
+    def get(self, timeout=None):
+        try:
+            return self.messages.popleft()
+        except IndexError:
+            time.sleep(min(timeout, _EMPTY_POLL_SECS))
+            raise TimedOutError
+
+
+class CountingSink(object):
+    """A dead-letter sink which only counts what it is sent."""
+
+    def __init__(self, counts):
+        self.counts = counts
+
+    def send(self, topic, value):
+        self.counts["dead_lettered"] += 1
+
+    def flush(self, timeout=None):
+        pass
+
+
+class CountingRetryScheduler(RetryScheduler):
+    """A RetryScheduler which counts the failures it is told about."""
+
+    def __init__(self, counts, **kwargs):
+        super(CountingRetryScheduler, self).__init__(**kwargs)
+        self.counts = counts
+
+    def errback(self, topic_name, event, attempts=1):
+        retry_later = super(CountingRetryScheduler, self).errback(
+            topic_name, event, attempts)
+
+        def count_and_retry_later(exc):
+            self.counts["failed"] += 1
+            retry_later(exc)
+        return count_and_retry_later
+
+
+class AllAccountedFor(object):
+    """Stands in for a ShutdownFlag to end the injector loop.
+
+    Shutdown is "requested" once every event has been delivered or
+    dead-lettered.
+
+    """
+
+    def __init__(self, counts, total):
+        self.counts = counts
+        self.total = total
+
+    @property
+    def requested(self):
+        return (self.counts["delivered"] +
+                self.counts["dead_lettered"] >= self.total)
+
+
+def make_messages(count, event_size, frame_size):
+    event = json.dumps({
+        "ip": "1.2.3.4",
+        "time": "2015-11-17T12:34:56",
+        "event": {"payload": "x" * max(event_size - 70, 0)},
+    })
+    events = [event] * count
+    if frame_size:
+        return pack_messages(events, frame_size)
+    return events
+
+
+def run(args):
+    sink = FakeBrokerSink(
+        ack_latency=args.ack_latency_ms / 1000.,
+        ack_jitter=args.ack_jitter_ms / 1000.,
+        failure_rate=args.failure_rate,
+        timeout_rate=args.timeout_rate,
+        seed=args.seed,
+    )
+    queue = InMemoryQueue(
+        make_messages(args.messages, args.event_size, args.frame_size))
+    counts = collections.Counter()
+    retry_scheduler = CountingRetryScheduler(
+        counts,
+        dead_letter=CountingSink(counts),
+        max_attempts=args.retry_max_attempts,
+        base_delay=args.retry_base_delay_ms / 1000.,
+        max_delay=args.retry_max_delay_ms / 1000.,
+        seed=args.seed,
+    )
+    finished = AllAccountedFor(counts, args.messages)
+
+    def success_cb(value):
+        counts["delivered"] += 1
+
+    def batch_success_cb(delivered):
+        counts["delivered"] += delivered
+
+    # failures all go to the retry scheduler, so the error callbacks are
+    # never called
+    start = time.time()
+    if args.mode == "batched":
+        process_queue_batched(queue, "bench", sink, batch_success_cb, None,
+                              max_messages=args.drain_max_messages,
+                              linger_secs=0, retry_scheduler=retry_scheduler,
+                              shutdown=finished)
+    else:
+        process_queue(queue, "bench", sink, success_cb, None,
+                      retry_scheduler=retry_scheduler, shutdown=finished)
+    sink.flush()
+    elapsed = time.time() - start
+    sink.close()
+
+    result = {
+        "mode": args.mode,
+        "events": args.messages,
+        "delivered": counts["delivered"],
+        "failed": counts["failed"],
+        "dead_lettered": counts["dead_lettered"],
+        "elapsed_secs": elapsed,
+        "messages_per_sec": counts["delivered"] / elapsed,
+        "ack_latency_ms": summarize_latencies(sink.ack_latencies),
+    }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=["single", "batched"],
+                        default="single")
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument("--event-size", type=int, default=500)
+    parser.add_argument("--frame-size", type=int, default=0,
+                        help="pack events into frames of this many bytes")
+    parser.add_argument("--drain-max-messages", type=int, default=500)
+    parser.add_argument("--ack-latency-ms", type=float, default=5.)
+    parser.add_argument("--ack-jitter-ms", type=float, default=0.)
+    parser.add_argument("--failure-rate", type=float, default=0.)
+    parser.add_argument("--timeout-rate", type=float, default=0.)
+    parser.add_argument("--retry-max-attempts", type=int,
+                        default=DEFAULT_RETRY_MAX_ATTEMPTS)
+    parser.add_argument("--retry-base-delay-ms", type=float,
+                        default=DEFAULT_RETRY_BASE_DELAY * 1000)
+    parser.add_argument("--retry-max-delay-ms", type=float,
+                        default=DEFAULT_RETRY_MAX_DELAY * 1000)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--json", action="store_true",
+                        help="print the result as JSON")
+    args = parser.parse_args()
+
+    # the retry scheduler logs every failure and dead-lettered event, which
+    # would drown out the results (they're counted in them anyway)
+    logging.basicConfig(level=logging.CRITICAL)
+
+    result = run(args)
+    if args.json:
+        json.dump(result, sys.stdout, indent=2, sort_keys=True)
+        print
+    else:
+        print "%(mode)s: %(delivered)d delivered, %(failed)d failed, " \
+              "%(dead_lettered)d dead-lettered in %(elapsed_secs).2fs " \
+              "(%(messages_per_sec).0f msg/s)" % result
+        print "ack latency ms: %s" % ", ".join(
+            "%s=%.2f" % (name, value)
+            for name, value in sorted(result["ack_latency_ms"].items())
+            if value is not None)
+
+
+if __name__ == "__main__":
+    main()
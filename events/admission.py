@@ -0,0 +1,82 @@
+"""Admission control based on the depth of the message queues.
+
+Rather than accepting requests right up until a worker blocks on a full
+queue, the collector can turn requests away with a 503 and a Retry-After
+hint once the queues pass a watermark. Requests signed with priority keys
+are held to a higher watermark so that they are the last to be shed.
+
+"""
+
+import time
+
+
+DEFAULT_WATERMARK = 0.9
+DEFAULT_PRIORITY_WATERMARK = 0.98
+DEFAULT_RETRY_AFTER = 5
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+
+class QueueDepthSampler(object):
+    """Cached sampling of how full a queue is.
+
+    Each sample is a system call (mq_getattr(3) for the POSIX message queues),
+    so the result is reused for up to sample_interval seconds.
+
+    """
+
+    def __init__(self, message_queue, sample_interval=DEFAULT_SAMPLE_INTERVAL):
+        self.message_queue = message_queue
+        self.sample_interval = sample_interval
+        self._fill = 0.
+        self._next_sample = 0
+
+    def fill(self):
+        """Return how full the queue is, from 0 to 1."""
+        now = time.time()
+        if now >= self._next_sample:
+            queue = self.message_queue
+            self._fill = float(queue.depth) / queue.capacity
+            self._next_sample = now + self.sample_interval
+        return self._fill
+
+
+class AdmissionController(object):
+    """Decides whether or not to accept a request given queue depths.
+
+    Requests are shed when any of the sampled queues is fuller than the
+    watermark (a fraction of its capacity) or, for keys in priority_keys,
+    the priority_watermark.
+
+    error_samplers are for queues which are only put on without blocking,
+    like /errors. A full one costs the workers nothing, and it can be filled
+    by a flood of bad requests which shouldn't get valid ones shed, so they
+    are only held to errors_watermark, if any, whatever the key.
+
+    """
+
+    def __init__(self, samplers, watermark=DEFAULT_WATERMARK,
+                 priority_watermark=DEFAULT_PRIORITY_WATERMARK,
+                 priority_keys=(), retry_after=DEFAULT_RETRY_AFTER,
+                 error_samplers=(), errors_watermark=None):
+        self.samplers = samplers
+        self.error_samplers = error_samplers
+        self.errors_watermark = errors_watermark
+        self.watermark = watermark
+        self.priority_watermark = priority_watermark
+        self.priority_keys = frozenset(priority_keys)
+        self.retry_after = retry_after
+
+    def should_shed(self, keyname):
+        """Return whether or not a request for this key should be shed."""
+        if keyname in self.priority_keys:
+            watermark = self.priority_watermark
+        else:
+            watermark = self.watermark
+
+        if any(sampler.fill() >= watermark for sampler in self.samplers):
+            return True
+
+        if self.errors_watermark is None:
+            return False
+        return any(sampler.fill() >= self.errors_watermark
+                   for sampler in self.error_samplers)
@@ -1,37 +1,86 @@
 """HTTP Frontend for the event collector service."""
 
-import base64
-from cStringIO import StringIO
+import atexit
 import datetime
-import gzip
 import json
 import hashlib
 import hmac
 import logging
-import urlparse
+import math
+import time
 
-import baseplate
 from baseplate.crypto import constant_time_compare
-from baseplate.message_queue import MessageQueue, MessageQueueError
+from baseplate.message_queue import MessageQueueError
 from pyramid.config import Configurator
 from pyramid.httpexceptions import (
     HTTPBadRequest,
     HTTPForbidden,
     HTTPRequestEntityTooLarge,
+    HTTPServiceUnavailable,
+    HTTPTooManyRequests,
 )
 from pyramid.response import Response
 
+from .admission import (
+    AdmissionController,
+    QueueDepthSampler,
+    DEFAULT_PRIORITY_WATERMARK,
+    DEFAULT_RETRY_AFTER,
+    DEFAULT_SAMPLE_INTERVAL,
+    DEFAULT_WATERMARK,
+)
+from .compression import (
+    decode_body,
+    get_decoder,
+    DecompressionError,
+    TooBigError,
+)
 from .const import (
     MAXIMUM_BATCH_SIZE,
     MAXIMUM_EVENT_SIZE,
+    MAXIMUM_INFLATED_SIZE,
     MAXIMUM_MESSAGE_SIZE,
-    MAXIMUM_QUEUE_LENGTH,
 )
+from .compact import make_compact_headers, pack_compact_event
+from .dedup import DEFAULT_CAPACITY as DEFAULT_DEDUP_CAPACITY
+from .dedup import DEFAULT_PATH as DEFAULT_DEDUP_PATH
+from .dedup import DEFAULT_TTL as DEFAULT_DEDUP_TTL
+from .dedup import DuplicateFilter
+from .envelope import make_envelope_affixes, split_batch, NotABatchError
+from .errors import DEFAULT_SAMPLE_SIZE as DEFAULT_ERROR_SAMPLE_SIZE
+from .errors import DEFAULT_SAMPLES as DEFAULT_ERROR_SAMPLES
+from .errors import DEFAULT_WINDOW as DEFAULT_ERROR_WINDOW
+from .errors import ErrorAggregator
+from .fastpath import FastPathMiddleware
+from .framing import pack_messages
+from .health import DEFAULT_DEGRADED_STATUS, DEFAULT_DEGRADED_WATERMARK
+from .health import DebugStats, HealthCheck
+from .instrumentation import DEFAULT_RING_SIZE as DEFAULT_STAGE_RING_SIZE
+from .instrumentation import NULL_STAGE_TIMER, StageProfiler
+from .jsonbackend import DEFAULT_BACKEND as DEFAULT_JSON_BACKEND
+from .jsonbackend import get_backend
+from .keystore import make_keystore
+from .metrics import make_metrics_client
+from .origins import DEFAULT_CACHE_SIZE as DEFAULT_ORIGIN_CACHE_SIZE
+from .origins import OriginMatcher
+from .ratelimit import DEFAULT_BURST as DEFAULT_RATE_LIMIT_BURST
+from .ratelimit import DEFAULT_CAPACITY as DEFAULT_RATE_LIMIT_CAPACITY
+from .ratelimit import DEFAULT_PATH as DEFAULT_RATE_LIMIT_PATH
+from .ratelimit import RateLimiter, parse_limits
+from .spill import DEFAULT_DRAIN_INTERVAL as DEFAULT_SPILL_DRAIN_INTERVAL
+from .spill import DEFAULT_SEGMENT_SIZE as DEFAULT_SPILL_SEGMENT_SIZE
+from .spill import SpillLog, SpillingQueue, start_drainer
+from .stats import DEFAULT_WINDOW as DEFAULT_STATS_WINDOW
+from .stats import RequestStats
+from .transport import make_queue
 
 
 # The log level used here is defined in /etc/events.ini
 _LOG = logging.getLogger(__name__)
 
+# used to check the MAC of requests with unknown keys, which will always fail
+_INVALID_KEY_MAC = hmac.new("INVALID", digestmod=hashlib.sha256)
+
 _CORS_HEADERS = {
     "Access-Control-Allow-Origin": "*",
     "Access-Control-Max-Age": "1728000",  # 20 days
@@ -41,34 +90,6 @@ _CORS_HEADERS = {
 }
 
 
-def is_subdomain(domain, base_domain):
-    """Return whether or not domain is a subdomain of base_domain."""
-    return domain == base_domain or domain.endswith("." + base_domain)
-
-
-def is_allowed_origin(origin, whitelist):
-    """Check if the reported origin of a request is on a given whitelist."""
-    # if there's no whitelist, assume all is ok
-    if whitelist == ["*"]:
-        return True
-
-    try:
-        parsed = urlparse.urlparse(origin)
-    except ValueError:
-        return False
-
-    if parsed.scheme not in ("http", "https"):
-        return False
-
-    if parsed.port is not None and parsed.port not in (80, 443):
-        return False
-
-    for domain in whitelist:
-        if is_subdomain(parsed.hostname, domain):
-            return True
-    return False
-
-
 def parse_signature(header):
     """Parse an X-Signature header and return keyname and MAC.
 
@@ -85,9 +106,9 @@ def parse_signature(header):
     return params.get("key"), params.get("mac")
 
 
-def wrap_and_serialize_event(request, event):
+def wrap_and_serialize_event(request, event, dumps=json.dumps):
     """Wrap the client-sent event with some additional fields and serialize."""
-    return json.dumps({
+    return dumps({
         "ip": request.client_addr,
         "time": request.environ["events.start_time"].isoformat(),
         "event": event,
@@ -99,17 +120,72 @@ class EventCollector(object):
 
     It has two dependencies:
 
-    * keystore: a mapping of key names to secret tokens.
+    * keystore: a :py:class:`~events.keystore.Keystore` of signing keys.
     * queue: an object that consumes events.
 
+    allowed_origins is an :py:class:`~events.origins.OriginMatcher` for the
+    CORS whitelist.
+
+    If frame_events is set, the events of a batch are packed into as few
+    queue messages as possible (see :py:mod:`events.framing`) rather than
+    being put on the queue one at a time.
+
+    If compact_envelopes is set, events are put on the queue in compact
+    envelopes (see :py:mod:`events.compact`), with those of at least
+    compress_min_size bytes deflated if that is set.
+
+    Compressed batches may inflate to at most max_inflated_size bytes.
+
+    If given, admission_controller (an
+    :py:class:`~events.admission.AdmissionController`) decides which requests
+    to shed when the queues are backing up.
+
+    If given, profiler (a :py:class:`~events.instrumentation.StageProfiler`)
+    times the stages of a sample of requests and request_stats (a
+    :py:class:`~events.stats.RequestStats`) counts every request.
+
+    json_backend is the :py:class:`~events.jsonbackend.JSONBackend` used to
+    validate batches and build envelopes; the stdlib's by default.
+
+    If given, duplicate_filter (a :py:class:`~events.dedup.DuplicateFilter`)
+    is used to accept resent copies of batches without enqueuing them again
+    and rate_limiter (a :py:class:`~events.ratelimit.RateLimiter`) to turn
+    away keys sending more than their share.
+
+    If error_aggregator (an :py:class:`~events.errors.ErrorAggregator`) is
+    given, it publishes summaries of client errors instead of one error
+    event per rejected request.
+
     """
 
-    def __init__(self, keystore, metrics_client, event_queue, error_queue, allowed_origins):
+    def __init__(self, keystore, metrics_client, event_queue, error_queue,
+                 allowed_origins, frame_events=False,
+                 max_inflated_size=MAXIMUM_INFLATED_SIZE,
+                 admission_controller=None, profiler=None,
+                 request_stats=None, json_backend=None,
+                 duplicate_filter=None, rate_limiter=None,
+                 error_aggregator=None, compact_envelopes=False,
+                 compress_min_size=0):
         self.keystore = keystore
         self.metrics_client = metrics_client
         self.event_queue = event_queue
         self.error_queue = error_queue
         self.allowed_origins = allowed_origins
+        self.frame_events = frame_events
+        self.max_inflated_size = max_inflated_size
+        self.admission_controller = admission_controller
+        self.profiler = profiler
+        self.request_stats = request_stats
+        self.json_backend = json_backend or get_backend()
+        self.duplicate_filter = duplicate_filter
+        self.rate_limiter = rate_limiter
+        self.error_aggregator = error_aggregator
+        self.compact_envelopes = compact_envelopes
+        self.compress_min_size = compress_min_size
+        self.preflight_response = Response(
+            status="204 No Content",
+            headers=_CORS_HEADERS,
+        )
 
     def check_cors(self, request):
         try:
@@ -132,21 +208,22 @@ class EventCollector(object):
                 "cors.preflight.bad_method").increment()
             raise HTTPForbidden()
 
-        if not origin or not is_allowed_origin(origin, self.allowed_origins):
+        if not origin or not self.allowed_origins.is_allowed(origin):
             self.metrics_client.counter(
                 "cors.preflight.bad_origin").increment()
             raise HTTPForbidden()
 
         self.metrics_client.counter("cors.preflight.allowed").increment()
-        return Response(
-            status="204 No Content",
-            headers=_CORS_HEADERS,
-        )
+        return self.preflight_response
 
     def _publish_error(self, request, keyname, code):
         metric_name = "client-error.{}.{}".format(keyname, code)
         self.metrics_client.counter(metric_name).increment()
 
+        if self.error_aggregator:
+            self.error_aggregator.add(request, keyname, code)
+            return
+
         # the -100 allows some room for the wrapper
         unicode_body = request.body.decode("utf8", "replace")
         truncated_body = unicode_body[:MAXIMUM_BATCH_SIZE-100]
@@ -154,7 +231,7 @@ class EventCollector(object):
             "key": keyname,
             "error": code,
             "raw_batch": truncated_body,
-        })
+        }, dumps=self.json_backend.dumps)
 
         try:
             self.error_queue.put(error, timeout=0)
@@ -176,21 +253,49 @@ class EventCollector(object):
 
         """
 
+        if self.profiler:
+            timer = self.profiler.start()
+        else:
+            timer = NULL_STAGE_TIMER
+        start = time.time()
+        response = self._process_request(request, timer)
+        if self.profiler:
+            self.profiler.record(timer, response.status_int)
+        if self.request_stats:
+            self.request_stats.record(
+                request.environ.get("events.keyname"), response.status_int,
+                time.time() - start)
+        return response
+
+    def _process_request(self, request, timer):
         request.environ["events.start_time"] = datetime.datetime.utcnow()
 
         try:
             signature_header = request.headers["X-Signature"]
         except KeyError:
             keyname = request.GET.get("key", "")
-            mac = request.GET.get("mac", "")
+            # query parameters are decoded to unicode, but the MAC has to be
+            # compared against the bytes of the hexdigest
+            mac = request.GET.get("mac", "").encode("utf-8")
         else:
             keyname, mac = parse_signature(signature_header)
+        timer.mark("signature")
 
         try:
-            key = self.keystore[keyname]
+            mac_state = self.keystore.new_mac(keyname)
         except KeyError:
             keyname = "UNKNOWN"
-            key = "INVALID"
+            mac_state = _INVALID_KEY_MAC.copy()
+        request.environ["events.keyname"] = keyname
+        timer.keyname = keyname
+        timer.mark("keystore")
+
+        if (self.admission_controller and
+                self.admission_controller.should_shed(keyname)):
+            self.metrics_client.counter("shed." + keyname).increment()
+            return HTTPServiceUnavailable(headers={
+                "Retry-After": str(self.admission_controller.retry_after),
+            })
 
         if request.content_length > MAXIMUM_BATCH_SIZE:
             self._publish_error(request, keyname, "TOO_BIG")
@@ -200,96 +305,263 @@ class EventCollector(object):
         if not request.headers.get("User-Agent"):
             self._publish_error(request, keyname, "NO_USERAGENT")
             return HTTPBadRequest("no user-agent provided")
+        timer.compressed_bytes = len(body)
+        timer.mark("body_read")
 
-        # Handle Gzipped Requests
-        if request.headers.get('Content-Encoding') == 'gzip':
-            f = StringIO(body)
+        # Handle compressed requests, feeding the MAC as we go
+        content_encoding = request.headers.get("Content-Encoding", "").strip()
+        decoder = get_decoder(content_encoding) if content_encoding else None
+        if decoder:
             try:
-                body = gzip.GzipFile(fileobj=f).read()
-            except IOError:
-                return HTTPBadRequest("invalid gzip content")
+                body = decode_body(body, decoder, self.max_inflated_size,
+                                   chunk_callback=mac_state.update)
+            except TooBigError:
+                self._publish_error(request, keyname, "TOO_BIG")
+                return HTTPRequestEntityTooLarge()
+            except DecompressionError:
+                return HTTPBadRequest(
+                    "invalid {} content".format(content_encoding))
+            # the MAC of the inflated body is computed during this stage too
+            timer.mark("inflate")
+        else:
+            mac_state.update(body)
+        timer.inflated_bytes = len(body)
 
-        expected_mac = hmac.new(key, body, hashlib.sha256).hexdigest()
+        expected_mac = mac_state.hexdigest()
         _LOG.debug(
             'Received request with key: %r, mac: %r, expected_mac: %r',
-            key, mac, expected_mac)
+            keyname, mac, expected_mac)
         if not constant_time_compare(expected_mac, mac or ""):
             self._publish_error(request, keyname, "INVALID_MAC")
             return HTTPForbidden()
+        timer.mark("hmac")
+
+        if (self.duplicate_filter and
+                self.duplicate_filter.is_duplicate(keyname, expected_mac)):
+            self.metrics_client.counter("duplicate." + keyname).increment()
+            return self._accepted_response(request)
 
         try:
-            batch = json.loads(body)
+            raw_events = split_batch(body, self.json_backend)
+        except NotABatchError:
+            self._publish_error(request, keyname, "INVALID_PAYLOAD")
+            return HTTPBadRequest("json root object must be a list")
         except ValueError:
             self._publish_error(request, keyname, "INVALID_PAYLOAD")
             return HTTPBadRequest("invalid json")
-
-        if not isinstance(batch, list):
-            self._publish_error(request, keyname, "INVALID_PAYLOAD")
-            return HTTPBadRequest("json root object must be a list")
-
+        timer.mark("json")
+
+        if self.rate_limiter:
+            wait = self.rate_limiter.acquire(
+                keyname, len(raw_events), len(body))
+            if wait:
+                self.metrics_client.counter(
+                    "client-error.{}.RATE_LIMITED".format(keyname)).increment()
+                return HTTPTooManyRequests(headers={
+                    "Retry-After": str(int(math.ceil(wait))),
+                })
+
+        prefix, suffix = make_envelope_affixes(
+            request.client_addr, request.environ["events.start_time"],
+            self.json_backend)
+        compact_headers = None
+        if self.compact_envelopes:
+            compact_headers = make_compact_headers(
+                request.client_addr, request.environ["events.start_time"])
+        affixes_size = len(prefix) + len(suffix)
         reserialized_items = []
-        for item in batch:
-            reserialized = wrap_and_serialize_event(request, item)
-            if len(reserialized) > MAXIMUM_EVENT_SIZE:
+        for raw_event in raw_events:
+            # the limit applies to the JSON envelope that goes to kafka
+            if affixes_size + len(raw_event) > MAXIMUM_EVENT_SIZE:
                 self._publish_error(request, keyname, "EVENT_TOO_BIG")
                 return HTTPRequestEntityTooLarge()
+            if compact_headers:
+                reserialized = pack_compact_event(
+                    compact_headers, raw_event, self.compress_min_size)
+            else:
+                reserialized = prefix + raw_event + suffix
             reserialized_items.append(reserialized)
 
-        for item in reserialized_items:
-            self.event_queue.put(item)
+        if self.frame_events:
+            messages = pack_messages(
+                reserialized_items, MAXIMUM_MESSAGE_SIZE["events"])
+        else:
+            messages = reserialized_items
+        timer.mark("envelope")
+
+        for message in messages:
+            self.event_queue.put(message)
+        timer.mark("enqueue")
+
+        if self.duplicate_filter:
+            self.duplicate_filter.remember(keyname, expected_mac)
 
         self.metrics_client.counter("collected.http." + keyname).increment(
             len(reserialized_items))
 
+        return self._accepted_response(request)
+
+    def _accepted_response(self, request):
         headers = {}
         origin = request.headers.get("Origin")
-        if origin and is_allowed_origin(origin, self.allowed_origins):
+        if origin and self.allowed_origins.is_allowed(origin):
             headers.update(_CORS_HEADERS)
 
         return Response(headers=headers)
 
 
-def health_check(request):
-    """A very simple health check endpoint."""
-    return {
-        "mood": u"\U0001F357",
-    }
-
-
 def make_app(global_config, **settings):
     """Paste entry point: return a configured WSGI application."""
 
     config = Configurator(settings=settings)
 
-    keystore = {}
-    for setting, value in settings.iteritems():
-        key_prefix = "key."
-        if setting.startswith(key_prefix):
-            key_name = setting[len(key_prefix):]
-            key_secret = base64.b64decode(value)
-            keystore[key_name] = key_secret
-
-    allowed_origins = [
-        x.strip() for x in settings["allowed_origins"].split(",") if x.strip()]
-
-    metrics_client = baseplate.make_metrics_client(settings)
-    event_queue = MessageQueue(
-        "/events",
-        max_messages=MAXIMUM_QUEUE_LENGTH["events"],
-        max_message_size=MAXIMUM_MESSAGE_SIZE["events"],
+    keystore = make_keystore(settings)
+    if settings.get("key_file.reload_on_sighup", "false").lower() == "true":
+        keystore.install_sighup_handler()
+
+    allowed_origins = OriginMatcher(
+        [x.strip() for x in settings["allowed_origins"].split(",") if x.strip()],
+        cache_size=int(settings.get(
+            "allowed_origins_cache_size", DEFAULT_ORIGIN_CACHE_SIZE)),
     )
-    error_queue = MessageQueue(
-        "/errors",
-        max_messages=MAXIMUM_QUEUE_LENGTH["errors"],
-        max_message_size=MAXIMUM_MESSAGE_SIZE["errors"],
+
+    metrics_client = make_metrics_client(settings)
+    event_queue = make_queue(settings, "events")
+    error_queue = make_queue(settings, "errors")
+    admission_controller = None
+    if settings.get("admission.enabled", "false").lower() == "true":
+        sample_interval = float(settings.get(
+            "admission.sample_interval_ms",
+            DEFAULT_SAMPLE_INTERVAL * 1000)) / 1000.
+        errors_watermark = settings.get("admission.errors_watermark")
+        admission_controller = AdmissionController(
+            [QueueDepthSampler(event_queue, sample_interval)],
+            watermark=float(settings.get(
+                "admission.watermark", DEFAULT_WATERMARK)),
+            priority_watermark=float(settings.get(
+                "admission.priority_watermark", DEFAULT_PRIORITY_WATERMARK)),
+            priority_keys=[x.strip() for x in settings.get(
+                "admission.priority_keys", "").split(",") if x.strip()],
+            retry_after=int(settings.get(
+                "admission.retry_after", DEFAULT_RETRY_AFTER)),
+            error_samplers=[QueueDepthSampler(error_queue, sample_interval)],
+            errors_watermark=(
+                float(errors_watermark) if errors_watermark else None),
+        )
+    errors_degraded_watermark = settings.get(
+        "health.errors_degraded_watermark")
+    health_check = HealthCheck(
+        [("events", event_queue)],
+        degraded_watermark=float(settings.get(
+            "health.degraded_watermark", DEFAULT_DEGRADED_WATERMARK)),
+        degraded_status=int(settings.get(
+            "health.degraded_status", DEFAULT_DEGRADED_STATUS)),
+        error_queues=[("errors", error_queue)],
+        errors_degraded_watermark=(float(errors_degraded_watermark)
+                                   if errors_degraded_watermark else None),
     )
+    if settings.get("spill.directory"):
+        spill_max_bytes = settings.get("spill.max_bytes")
+        spill_log = SpillLog.open_free_slot(
+            settings["spill.directory"],
+            segment_size=int(settings.get(
+                "spill.segment_size", DEFAULT_SPILL_SEGMENT_SIZE)),
+            max_bytes=int(spill_max_bytes) if spill_max_bytes else None,
+        )
+        event_queue = SpillingQueue(event_queue, spill_log)
+        health_check.spill_log = spill_log
+        start_drainer(
+            event_queue,
+            metrics_client,
+            interval=float(settings.get(
+                "spill.drain_interval", DEFAULT_SPILL_DRAIN_INTERVAL)),
+        )
+    frame_events = settings.get("frame_events", "false").lower() == "true"
+    compact_envelopes = (
+        settings.get("compact_envelopes", "false").lower() == "true")
+    compress_min_size = int(
+        settings.get("compact_envelopes.compress_min_size", 0))
+    max_inflated_size = int(
+        settings.get("max_inflated_size", MAXIMUM_INFLATED_SIZE))
+    profiler = None
+    stage_sample_rate = float(settings.get("stage_timing.sample_rate", 0))
+    if stage_sample_rate:
+        profiler = StageProfiler(
+            metrics_client,
+            sample_rate=stage_sample_rate,
+            ring_size=int(settings.get(
+                "stage_timing.ring_size", DEFAULT_STAGE_RING_SIZE)),
+        )
+    debug_secret = settings.get("debug.secret")
+    request_stats = None
+    if debug_secret:
+        request_stats = RequestStats(window=int(settings.get(
+            "debug.stats_window", DEFAULT_STATS_WINDOW)))
+    json_backend = get_backend(
+        settings.get("json_backend", DEFAULT_JSON_BACKEND))
+    duplicate_filter = None
+    if settings.get("dedup.enabled", "false").lower() == "true":
+        duplicate_filter = DuplicateFilter(
+            path=settings.get("dedup.path", DEFAULT_DEDUP_PATH),
+            ttl=float(settings.get("dedup.ttl", DEFAULT_DEDUP_TTL)),
+            capacity=int(settings.get(
+                "dedup.capacity", DEFAULT_DEDUP_CAPACITY)),
+        )
+    rate_limiter = None
+    if settings.get("rate_limit.enabled", "false").lower() == "true":
+        limits = {}
+        for setting, value in settings.iteritems():
+            limit_prefix = "rate_limit.key."
+            if setting.startswith(limit_prefix):
+                limits[setting[len(limit_prefix):]] = parse_limits(value)
+        rate_limiter = RateLimiter(
+            limits,
+            default_limits=parse_limits(
+                settings.get("rate_limit.default", "0, 0")),
+            burst=float(settings.get(
+                "rate_limit.burst", DEFAULT_RATE_LIMIT_BURST)),
+            path=settings.get("rate_limit.path", DEFAULT_RATE_LIMIT_PATH),
+            capacity=int(settings.get(
+                "rate_limit.capacity", DEFAULT_RATE_LIMIT_CAPACITY)),
+        )
+    error_aggregator = None
+    if settings.get("errors.aggregate", "false").lower() == "true":
+        error_aggregator = ErrorAggregator(
+            error_queue,
+            window=float(settings.get("errors.window", DEFAULT_ERROR_WINDOW)),
+            samples=int(settings.get("errors.samples", DEFAULT_ERROR_SAMPLES)),
+            sample_size=int(settings.get(
+                "errors.sample_size", DEFAULT_ERROR_SAMPLE_SIZE)),
+            dumps=json_backend.dumps,
+        )
+        atexit.register(error_aggregator.flush)
+
     collector = EventCollector(
-        keystore, metrics_client, event_queue, error_queue, allowed_origins)
+        keystore, metrics_client, event_queue, error_queue, allowed_origins,
+        frame_events=frame_events,
+        max_inflated_size=max_inflated_size,
+        admission_controller=admission_controller,
+        profiler=profiler,
+        request_stats=request_stats,
+        json_backend=json_backend,
+        duplicate_filter=duplicate_filter,
+        rate_limiter=rate_limiter,
+        error_aggregator=error_aggregator,
+        compact_envelopes=compact_envelopes,
+        compress_min_size=compress_min_size,
+    )
     config.add_route("v1", "/v1", request_method="POST")
     config.add_route("v1_options", "/v1", request_method="OPTIONS")
     config.add_view(collector.process_request, route_name="v1")
     config.add_view(collector.check_cors, route_name="v1_options")
     config.add_route("health", "/health")
     config.add_view(health_check, route_name="health", renderer="json")
-
-    return config.make_wsgi_app()
+    if debug_secret:
+        config.add_route("debug_stats", "/debug/stats")
+        config.add_view(DebugStats(debug_secret, request_stats, profiler),
+                        route_name="debug_stats", renderer="json")
+
+    app = config.make_wsgi_app()
+    if settings.get("fast_path", "false").lower() == "true":
+        app = FastPathMiddleware(app, collector)
+    return app
@@ -0,0 +1,151 @@
+"""A compact binary envelope for events on their way to the injector.
+
+The JSON envelope repeats the ip and time as text in every event and is
+what the queue is sized for, but only Kafka's consumers need it. Collectors
+can instead put events on the queue in a compact envelope which the
+injector renders into the canonical JSON envelope (see
+:py:mod:`events.envelope`) just before sending it to Kafka:
+
+    +-------+---------+-------+------------+--------+--------+--------------
+    | magic | version | flags | time       | ip len | ip     | event
+    | 2B    | 1B      | 1B    | 8B         | 1B     | ...    | ...
+    +-------+---------+-------+------------+--------+--------+--------------
+
+Integers are big-endian. The time is in microseconds since the epoch. If
+:py:data:`FLAG_PACKED_IP` is set, the ip is the 4 or 16 byte binary form of
+an IPv4 or IPv6 address, otherwise it is the address as text (clients can
+put anything in X-Forwarded-For). :py:data:`FLAG_NO_IP` means there was no
+address at all. If :py:data:`FLAG_COMPRESSED` is set, the event was
+deflated.
+
+Compact envelopes can be packed into frames like any other event (see
+:py:mod:`events.framing`). Neither JSON envelopes nor frames can start with
+the magic bytes, so the injector can tell them apart.
+
+"""
+
+import datetime
+import socket
+import struct
+import zlib
+
+from .envelope import make_envelope_affixes
+
+
+_MAGIC = b"\xffE"
+_HEADER = struct.Struct("!2sBBqB")
+
+COMPACT_VERSION = 1
+FLAG_COMPRESSED = 0x01
+FLAG_PACKED_IP = 0x02
+FLAG_NO_IP = 0x04
+
+DEFAULT_COMPRESSION_LEVEL = 1
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_FAMILIES = {4: socket.AF_INET, 16: socket.AF_INET6}
+
+
+class CompactEnvelopeError(Exception):
+    """Raised when a message looks compact but cannot be decoded."""
+    pass
+
+
+def is_compact(message):
+    """Return whether or not message is an event in a compact envelope."""
+    return message[:len(_MAGIC)] == _MAGIC
+
+
+def _pack_ip(ip):
+    if ip is None:
+        return FLAG_NO_IP, b""
+
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            packed_ip = socket.inet_pton(family, ip)
+        except (socket.error, ValueError, UnicodeError):
+            continue
+        # only if it renders back exactly the same
+        if socket.inet_ntop(family, packed_ip) == ip:
+            return FLAG_PACKED_IP, packed_ip
+
+    if isinstance(ip, unicode):
+        ip = ip.encode("utf-8")
+    return 0, ip
+
+
+def make_compact_headers(ip, timestamp):
+    """Return the headers for the events of a request.
+
+    The first is for events sent as they are and the second for events which
+    have been compressed. timestamp is a naive UTC datetime.
+
+    Returns None if the ip can't be represented, in which case the events
+    have to be sent in JSON envelopes.
+
+    """
+    flags, packed_ip = _pack_ip(ip)
+    if len(packed_ip) > 0xff:
+        return None
+    delta = timestamp - _EPOCH
+    micros = ((delta.days * 86400 + delta.seconds) * 10 ** 6 +
+              delta.microseconds)
+    headers = []
+    for extra_flags in (0, FLAG_COMPRESSED):
+        headers.append(_HEADER.pack(
+            _MAGIC, COMPACT_VERSION, flags | extra_flags, micros,
+            len(packed_ip)) + packed_ip)
+    return tuple(headers)
+
+
+def pack_compact_event(headers, event, compress_min_size=0,
+                       compression_level=DEFAULT_COMPRESSION_LEVEL):
+    """Wrap a raw event in a compact envelope.
+
+    headers comes from :py:func:`make_compact_headers`. If compress_min_size
+    is set, events at least that big are deflated unless that doesn't make
+    them any smaller.
+
+    """
+    if compress_min_size and len(event) >= compress_min_size:
+        compressed = zlib.compress(event, compression_level)
+        if len(compressed) < len(event):
+            return headers[1] + compressed
+    return headers[0] + event
+
+
+def render_compact_event(message, json_backend=None):
+    """Return the canonical JSON envelope of a compact event."""
+    try:
+        _, version, flags, micros, ip_length = _HEADER.unpack_from(message)
+    except struct.error:
+        raise CompactEnvelopeError("truncated header")
+
+    if version != COMPACT_VERSION:
+        raise CompactEnvelopeError("unknown version %d" % version)
+
+    offset = _HEADER.size + ip_length
+    packed_ip = message[_HEADER.size:offset]
+    if len(packed_ip) != ip_length:
+        raise CompactEnvelopeError("truncated ip")
+
+    if flags & FLAG_PACKED_IP:
+        try:
+            ip = socket.inet_ntop(_FAMILIES[ip_length], packed_ip)
+        except (KeyError, ValueError, socket.error):
+            raise CompactEnvelopeError("invalid packed ip")
+    elif flags & FLAG_NO_IP:
+        ip = None
+    else:
+        ip = packed_ip.decode("utf-8", "replace")
+
+    event = message[offset:]
+    if flags & FLAG_COMPRESSED:
+        try:
+            event = zlib.decompress(event)
+        except zlib.error as exc:
+            raise CompactEnvelopeError("invalid compressed event: %s" % exc)
+
+    timestamp = _EPOCH + datetime.timedelta(microseconds=micros)
+    prefix, suffix = make_envelope_affixes(ip, timestamp, json_backend)
+    return prefix + event + suffix
@@ -0,0 +1,144 @@
+"""Streaming, size-capped decoding of compressed request bodies.
+
+Each supported ``Content-Encoding`` maps to a decoder: a function which takes
+the raw request body and a chunk size and yields the decoded body in chunks
+of no more than about that size. Because the output is produced
+incrementally, decoding can be abandoned as soon as it exceeds the allowed
+size instead of inflating the whole thing into memory first.
+
+More encodings can be supported with :py:func:`register_decoder`.
+
+"""
+
+from cStringIO import StringIO
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+_DECODERS = {}
+
+
+class DecompressionError(Exception):
+    """Raised when a body can't be decoded with its declared encoding."""
+    pass
+
+
+class TooBigError(Exception):
+    """Raised when a decoded body exceeds the maximum allowed size."""
+    pass
+
+
+def register_decoder(encoding, decoder):
+    """Register a decoder for the given Content-Encoding."""
+    _DECODERS[encoding.lower()] = decoder
+
+
+def get_decoder(encoding):
+    """Return the decoder for a Content-Encoding or None if unsupported."""
+    return _DECODERS.get(encoding.lower())
+
+
+def _stream_is_complete(decompressor):
+    # python 2's zlib doesn't tell us if it has seen the end of the stream.
+    # once it has, any further input is left untouched in unused_data.
+    if decompressor.unused_data:
+        return True
+
+    probe = decompressor.copy()
+    try:
+        probe.decompress(b"\x00")
+    except zlib.error:
+        return False
+    return probe.unused_data == b"\x00"
+
+
+def _iter_zlib_stream(data, wbits, chunk_size):
+    try:
+        while data:
+            decompressor = zlib.decompressobj(wbits)
+            while data:
+                chunk = decompressor.decompress(data, chunk_size)
+                data = decompressor.unconsumed_tail
+                if chunk:
+                    yield chunk
+
+            if not _stream_is_complete(decompressor):
+                raise DecompressionError("truncated stream")
+
+            chunk = decompressor.flush()
+            if chunk:
+                yield chunk
+
+            # gzip allows several members to be concatenated together
+            data = decompressor.unused_data
+    except zlib.error as exc:
+        raise DecompressionError(str(exc))
+
+
+def decode_gzip(body, chunk_size):
+    """Decode a gzip body."""
+    return _iter_zlib_stream(body, 16 + zlib.MAX_WBITS, chunk_size)
+
+
+def decode_deflate(body, chunk_size):
+    """Decode a deflate body.
+
+    RFC 7230 says this is a zlib stream, but enough clients send bare deflate
+    data that we accept that as well.
+
+    """
+    has_zlib_header = (
+        len(body) >= 2 and
+        ord(body[0]) & 0x0f == zlib.DEFLATED and
+        (ord(body[0]) << 8 | ord(body[1])) % 31 == 0
+    )
+    wbits = zlib.MAX_WBITS if has_zlib_header else -zlib.MAX_WBITS
+    return _iter_zlib_stream(body, wbits, chunk_size)
+
+
+def decode_zstd(body, chunk_size):
+    """Decode a zstd body."""
+    reader = zstandard.ZstdDecompressor().stream_reader(StringIO(body))
+    try:
+        while True:
+            chunk = reader.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    except zstandard.ZstdError as exc:
+        raise DecompressionError(str(exc))
+
+
+register_decoder("gzip", decode_gzip)
+register_decoder("deflate", decode_deflate)
+if zstandard is not None:
+    register_decoder("zstd", decode_zstd)
+
+
+def decode_body(body, decoder, max_size, chunk_callback=None,
+                chunk_size=DEFAULT_CHUNK_SIZE):
+    """Decode a body, stopping as soon as it gets bigger than max_size.
+
+    If given, chunk_callback is called with each chunk of decoded output as
+    it is produced.
+
+    :raises: :py:exc:`DecompressionError` if the body is corrupt and
+        :py:exc:`TooBigError` if the decoded body is too large.
+
+    """
+    chunks = []
+    size = 0
+    for chunk in decoder(body, chunk_size):
+        size += len(chunk)
+        if size > max_size:
+            raise TooBigError()
+        if chunk_callback:
+            chunk_callback(chunk)
+        chunks.append(chunk)
+    return b"".join(chunks)
@@ -3,6 +3,9 @@
 # maximum size of a batch of events
 MAXIMUM_BATCH_SIZE = 500 * 1024
 
+# default maximum size a compressed batch may inflate to
+MAXIMUM_INFLATED_SIZE = 10 * MAXIMUM_BATCH_SIZE
+
 # maximum size of a single event
 MAXIMUM_EVENT_SIZE = 100 * 1024
 
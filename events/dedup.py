@@ -0,0 +1,64 @@
+"""Suppression of batches that clients send more than once.
+
+Clients resend a batch when they time out waiting for the response, which is
+exactly when the collector is already slow, and without this every copy is
+parsed, wrapped and put on the queue again. The MAC of a batch is a good
+fingerprint of it, so the collector remembers the (key name, MAC) of each
+batch it accepts for a while and answers copies of it with a plain 200.
+
+Only accepted batches are remembered: if the first copy was rejected, a
+resend gets the same treatment rather than a 200 for something that was
+never collected. The fingerprints are in a
+:py:class:`~events.shm.SharedHashTable` so that a resend is recognised
+whichever worker it lands on.
+
+"""
+
+import time
+
+from .shm import SharedHashTable
+
+
+DEFAULT_PATH = "/dev/shm/event-collector-dedup"
+DEFAULT_TTL = 300
+DEFAULT_CAPACITY = 65536
+
+_VALUE_FORMAT = "!d"  # expiration time
+
+
+def _expired(value):
+    return value[0] < time.time()
+
+
+class DuplicateFilter(object):
+    """Remembers the fingerprints of recently accepted batches for ttl secs.
+
+    Once capacity fingerprints are in use, new ones displace others early.
+
+    """
+
+    def __init__(self, path=DEFAULT_PATH, ttl=DEFAULT_TTL,
+                 capacity=DEFAULT_CAPACITY):
+        self.ttl = ttl
+        self.table = SharedHashTable(
+            path, capacity, _VALUE_FORMAT, reclaimable=_expired)
+
+    @staticmethod
+    def _fingerprint(keyname, mac):
+        return u"{}:{}".format(keyname, mac).encode("utf-8")
+
+    def is_duplicate(self, keyname, mac):
+        """Return whether the batch was accepted within the last ttl secs."""
+        now = time.time()
+
+        def check(current):
+            return None, current is not None and current[0] >= now
+        return self.table.update(self._fingerprint(keyname, mac), check)
+
+    def remember(self, keyname, mac):
+        """Record that a batch has been accepted."""
+        expiration = time.time() + self.ttl
+
+        def store(current):
+            return (expiration,), None
+        self.table.update(self._fingerprint(keyname, mac), store)
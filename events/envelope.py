@@ -0,0 +1,92 @@
+"""Wrapping of raw client events in the collector's envelope.
+
+Decoding a whole batch and then encoding every event again just to wrap it in
+the envelope is the most expensive thing the collector does. Instead, the
+batch is scanned once to validate it and find the byte span of each event,
+and the envelope is built around those raw bytes with a prefix and suffix that
+are computed once per request.
+
+The resulting envelope is semantically identical to what
+:py:func:`events.collector.wrap_and_serialize_event` produces, but the event
+itself is passed through exactly as the client sent it (whitespace, escaping,
+number formatting and all).
+
+Both functions take an optional :py:class:`~events.jsonbackend.JSONBackend`
+to do their JSON work with; the stdlib's is used otherwise.
+
+"""
+
+import re
+
+from .jsonbackend import get_backend
+
+
+_DEFAULT_BACKEND = get_backend()
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+class NotABatchError(ValueError):
+    """Raised when a payload is valid JSON but its root isn't a list."""
+    pass
+
+
+def _skip_whitespace(body, idx):
+    return _WHITESPACE.match(body, idx).end()
+
+
+def _expect_end(body, idx):
+    if idx != len(body):
+        raise ValueError("extra data at position %d" % idx)
+
+
+def split_batch(body, json_backend=None):
+    """Validate a JSON batch and return the raw bytes of each of its events.
+
+    :raises: :py:exc:`ValueError` if the body isn't valid JSON and
+        :py:exc:`NotABatchError` if it is but isn't a list.
+
+    """
+    json_backend = json_backend or _DEFAULT_BACKEND
+    idx = _skip_whitespace(body, 0)
+    if body[idx:idx + 1] != "[":
+        # let the json backend decide which kind of invalid this is
+        json_backend.loads(body)
+        raise NotABatchError("json root object must be a list")
+
+    events = []
+    idx = _skip_whitespace(body, idx + 1)
+    if body[idx:idx + 1] == "]":
+        _expect_end(body, _skip_whitespace(body, idx + 1))
+        return events
+
+    scan_once = json_backend.scan_once
+    while True:
+        try:
+            _, end = scan_once(body, idx)
+        except StopIteration:
+            raise ValueError("expecting value at position %d" % idx)
+        events.append(body[idx:end])
+
+        idx = _skip_whitespace(body, end)
+        delimiter = body[idx:idx + 1]
+        if delimiter == "]":
+            break
+        elif delimiter != ",":
+            raise ValueError("expecting , or ] at position %d" % idx)
+        idx = _skip_whitespace(body, idx + 1)
+
+    _expect_end(body, _skip_whitespace(body, idx + 1))
+    return events
+
+
+def make_envelope_affixes(ip, timestamp, json_backend=None):
+    """Return the prefix and suffix to wrap around each raw event.
+
+    The field order matches the envelopes made by
+    :py:func:`events.collector.wrap_and_serialize_event`.
+
+    """
+    dumps = (json_backend or _DEFAULT_BACKEND).dumps
+    prefix = '{"ip": ' + dumps(ip) + ', "event": '
+    suffix = ', "time": ' + dumps(timestamp.isoformat()) + '}'
+    return prefix, suffix
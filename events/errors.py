@@ -0,0 +1,173 @@
+"""Aggregated publishing of client errors.
+
+By default, every rejected request puts an error event on the error queue
+with up to a whole batch of its body, decoded and re-encoded as JSON. During
+an error storm (e.g. a stale client release sending batches with bad MACs)
+that costs more CPU and queue I/O than the valid traffic does, and floods the
+small error queue anyway.
+
+:py:class:`ErrorAggregator` instead counts the errors of each (key, code)
+over a window and publishes one summary event per (key, code) at the end of
+it. Only the first few raw batches of each window are kept as samples, cut
+to sample_size bytes and deflated, so an error costs little more than a dict
+update no matter how many of them there are. The
+``client-error.<key>.<code>`` counters are unaffected and stay exact.
+
+A summary is wrapped in the usual envelope, with the ip and time of the
+window's first error, and looks like::
+
+    {
+        "key": "MyKey",
+        "error": "INVALID_MAC",
+        "count": 1234,
+        "first_time": "2015-11-17T12:34:56",
+        "last_time": "2015-11-17T12:35:05",
+        "samples": [
+            {
+                "ip": "1.2.3.4",
+                "time": "2015-11-17T12:34:56",
+                "size": 48213,
+                "raw_batch_deflate": "<base64 of the deflated first bytes>"
+            }
+        ]
+    }
+
+"""
+
+import base64
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+
+from baseplate.message_queue import MessageQueueError
+
+from .const import MAXIMUM_MESSAGE_SIZE
+
+
+_LOG = logging.getLogger(__name__)
+
+DEFAULT_WINDOW = 10.
+DEFAULT_SAMPLES = 3
+DEFAULT_SAMPLE_SIZE = 4096
+
+
+class _Summary(object):
+    def __init__(self, ip, start_time):
+        self.ip = ip
+        self.first_time = start_time
+        self.last_time = start_time
+        self.count = 0
+        self.samples = []
+
+
+class ErrorAggregator(object):
+    """Summarizes the errors of each key and code over a window of seconds.
+
+    Up to samples raw batches per key and code are kept each window, of which
+    the first sample_size bytes are published. Summaries are put on
+    error_queue every window seconds, as well as on
+    :py:meth:`~ErrorAggregator.flush` (e.g. at exit).
+
+    """
+
+    def __init__(self, error_queue, window=DEFAULT_WINDOW,
+                 samples=DEFAULT_SAMPLES, sample_size=DEFAULT_SAMPLE_SIZE,
+                 dumps=json.dumps,
+                 max_message_size=MAXIMUM_MESSAGE_SIZE["errors"]):
+        self.error_queue = error_queue
+        self.window = window
+        self.samples = samples
+        self.sample_size = sample_size
+        self.dumps = dumps
+        self.max_message_size = max_message_size
+
+        self._lock = threading.Lock()
+        self._summaries = {}
+        self._next_flush = time.time() + window
+        self._flusher_pid = None
+
+    def add(self, request, keyname, code):
+        """Count an error and maybe keep the request's body as a sample."""
+        start_time = request.environ["events.start_time"]
+        with self._lock:
+            summary = self._summaries.get((keyname, code))
+            if summary is None:
+                summary = _Summary(request.client_addr, start_time)
+                self._summaries[(keyname, code)] = summary
+            summary.count += 1
+            summary.last_time = start_time
+            take_sample = len(summary.samples) < self.samples
+            if take_sample:
+                # hold the place so that concurrent errors don't overshoot
+                summary.samples.append(None)
+                sample_index = len(summary.samples) - 1
+
+        if take_sample:
+            body = request.body
+            summary.samples[sample_index] = {
+                "ip": request.client_addr,
+                "time": start_time.isoformat(),
+                "size": len(body),
+                "raw_batch_deflate": base64.b64encode(
+                    zlib.compress(body[:self.sample_size])),
+            }
+
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        # the flusher thread doesn't survive forking, so (re)start it lazily
+        # in whichever process is seeing errors.
+        if self._flusher_pid != os.getpid():
+            self._start_flusher()
+
+        if time.time() >= self._next_flush:
+            self.flush()
+
+    def _start_flusher(self):
+        self._flusher_pid = os.getpid()
+
+        def flush_periodically():
+            while True:
+                time.sleep(self.window)
+                if time.time() >= self._next_flush:
+                    self.flush()
+
+        thread = threading.Thread(
+            target=flush_periodically, name="error-flusher")
+        thread.daemon = True
+        thread.start()
+
+    def _serialize(self, keyname, code, summary):
+        samples = [sample for sample in summary.samples if sample]
+        while True:
+            message = self.dumps({
+                "ip": summary.ip,
+                "time": summary.first_time.isoformat(),
+                "event": {
+                    "key": keyname,
+                    "error": code,
+                    "count": summary.count,
+                    "first_time": summary.first_time.isoformat(),
+                    "last_time": summary.last_time.isoformat(),
+                    "samples": samples,
+                },
+            })
+            if len(message) <= self.max_message_size or not samples:
+                return message
+            samples.pop()
+
+    def flush(self):
+        """Publish the summaries of everything since the last flush."""
+        with self._lock:
+            summaries, self._summaries = self._summaries, {}
+            self._next_flush = time.time() + self.window
+
+        for (keyname, code), summary in sorted(summaries.iteritems()):
+            message = self._serialize(keyname, code, summary)
+            try:
+                self.error_queue.put(message, timeout=0)
+            except MessageQueueError as exc:
+                _LOG.warning("failed to publish error summary: %r", exc)
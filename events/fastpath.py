@@ -0,0 +1,71 @@
+"""A shortcut around Pyramid for the ingest endpoint.
+
+Pyramid's router does a lot per request: making the request object with all
+its mixins, running tweens, matching routes, looking up the view and its
+predicates. None of it is needed for ``/v1``, and for the small batches which
+make up most traffic it is a noticeable share of the time spent on each
+request.
+
+:py:class:`FastPathMiddleware` calls the
+:py:class:`~events.collector.EventCollector` views for ``POST /v1`` and
+``OPTIONS /v1`` directly from the WSGI environ and passes every other
+request on to the Pyramid application. The views return the same response
+objects whichever way they're called, so clients can't tell the difference.
+
+"""
+
+from pyramid.httpexceptions import HTTPException
+from webob.request import BaseRequest
+
+from .const import MAXIMUM_BATCH_SIZE
+
+
+class LeanRequest(BaseRequest):
+    """Just enough of a request for the collector's views.
+
+    The body is read straight from ``wsgi.input`` rather than copied into a
+    seekable buffer first. At most max_body_size bytes are read, so an
+    oversized body is never read in full just to be rejected.
+
+    """
+
+    max_body_size = MAXIMUM_BATCH_SIZE
+
+    _body = None
+
+    @property
+    def body(self):
+        if self._body is None:
+            length = self.content_length
+            if length is None and self.is_body_readable:
+                # chunked, so the size wasn't checked up front. anything
+                # longer is truncated here and so fails the MAC check.
+                length = self.max_body_size
+            elif not length:
+                length = 0
+            self._body = self.body_file_raw.read(
+                min(length, self.max_body_size))
+        return self._body
+
+
+class FastPathMiddleware(object):
+    """Route the collector's own endpoint around the wrapped application."""
+
+    def __init__(self, app, collector, path="/v1"):
+        self.app = app
+        self.collector = collector
+        self.path = path
+
+    def __call__(self, environ, start_response):
+        if environ.get("PATH_INFO") == self.path:
+            method = environ["REQUEST_METHOD"]
+            if method == "POST":
+                response = self.collector.process_request(LeanRequest(environ))
+                return response(environ, start_response)
+            elif method == "OPTIONS":
+                try:
+                    response = self.collector.check_cors(LeanRequest(environ))
+                except HTTPException as exc:
+                    response = exc
+                return response(environ, start_response)
+        return self.app(environ, start_response)
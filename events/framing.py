@@ -0,0 +1,116 @@
+"""Framing of multiple events into a single message queue message.
+
+Putting each event on the queue individually costs one system call per event
+on both the collector and the injector side. Instead, the collector packs as
+many events as will fit under the queue's maximum message size into a single
+frame:
+
+    +-------+---------+-------+---------------+--------+---------------+-----
+    | magic | version | count | length (1)    | event  | length (2)    | ...
+    | 2B    | 1B      | 2B    | 4B            | ...    | 4B            |
+    +-------+---------+-------+---------------+--------+---------------+-----
+
+All integers are unsigned and big-endian. A message that doesn't start with
+the magic bytes is a bare, unframed event. These are what collectors used to
+write before framing existed and are still what a lone event is sent as.
+
+"""
+
+import struct
+
+
+_MAGIC = b"\xffF"
+_HEADER = struct.Struct("!2sBH")
+_LENGTH = struct.Struct("!I")
+
+FRAME_VERSION = 1
+FRAME_OVERHEAD = _HEADER.size
+RECORD_OVERHEAD = _LENGTH.size
+_MAXIMUM_RECORDS = 0xffff
+
+
+class FramingError(Exception):
+    """Raised when a message looks like a frame but cannot be decoded."""
+    pass
+
+
+def is_frame(message):
+    """Return whether or not message is a multi-event frame."""
+    return message[:len(_MAGIC)] == _MAGIC
+
+
+def _build_frame(items):
+    parts = [_HEADER.pack(_MAGIC, FRAME_VERSION, len(items))]
+    for item in items:
+        parts.append(_LENGTH.pack(len(item)))
+        parts.append(item)
+    return b"".join(parts)
+
+
+def pack_messages(items, max_message_size):
+    """Pack serialized events into as few queue messages as possible.
+
+    Returns a list of messages, each no larger than max_message_size. Events
+    which can't share a message with anything else are sent unframed so that
+    a maximum-size event still fits in the queue.
+
+    """
+    messages = []
+    pending = []
+    pending_size = FRAME_OVERHEAD
+
+    for item in items:
+        record_size = RECORD_OVERHEAD + len(item)
+        if pending and (pending_size + record_size > max_message_size or
+                        len(pending) == _MAXIMUM_RECORDS):
+            messages.append(_finish(pending))
+            pending = []
+            pending_size = FRAME_OVERHEAD
+        pending.append(item)
+        pending_size += record_size
+
+    if pending:
+        messages.append(_finish(pending))
+    return messages
+
+
+def _finish(pending):
+    if len(pending) == 1:
+        return pending[0]
+    return _build_frame(pending)
+
+
+def unpack_message(message):
+    """Return the list of serialized events contained in a queue message.
+
+    Unframed messages are returned as a single-item list.
+
+    """
+    if not is_frame(message):
+        return [message]
+
+    try:
+        _, version, count = _HEADER.unpack_from(message)
+    except struct.error:
+        raise FramingError("truncated frame header")
+
+    if version != FRAME_VERSION:
+        raise FramingError("unknown frame version %d" % version)
+
+    items = []
+    offset = _HEADER.size
+    for _ in xrange(count):
+        try:
+            length, = _LENGTH.unpack_from(message, offset)
+        except struct.error:
+            raise FramingError("truncated record length")
+        offset += _LENGTH.size
+        end = offset + length
+        if end > len(message):
+            raise FramingError("truncated record")
+        items.append(message[offset:end])
+        offset = end
+
+    if offset != len(message):
+        raise FramingError("trailing data after last record")
+    return items
@@ -0,0 +1,110 @@
+"""Operational endpoints: the load balancer health check and debug stats."""
+
+from baseplate.crypto import constant_time_compare
+from pyramid.httpexceptions import HTTPForbidden
+
+from .stats import summarize_latencies
+
+
+DEFAULT_DEGRADED_WATERMARK = 0.8
+DEFAULT_DEGRADED_STATUS = 503
+
+
+class HealthCheck(object):
+    """Reports the depth of the message queues and whether that's healthy.
+
+    The collector is considered degraded once any queue is fuller than
+    degraded_watermark (a fraction of its capacity) or events are being
+    spilled to disk. The response then has the degraded_status code so that
+    the load balancer can take the node out of rotation before its workers
+    block on a full queue.
+
+    queues is a list of (name, queue) pairs, the queues being transports (see
+    :py:mod:`events.transport`), and spill_log an optional
+    :py:class:`~events.spill.SpillLog`.
+
+    error_queues are queues which are only put on without blocking, like
+    /errors. They are reported too, but since a flood of bad requests can
+    fill them without holding up any worker, they only count as degraded
+    above errors_degraded_watermark, if any.
+
+    """
+
+    def __init__(self, queues, degraded_watermark=DEFAULT_DEGRADED_WATERMARK,
+                 degraded_status=DEFAULT_DEGRADED_STATUS, spill_log=None,
+                 error_queues=(), errors_degraded_watermark=None):
+        self.queues = queues
+        self.degraded_watermark = degraded_watermark
+        self.degraded_status = degraded_status
+        self.spill_log = spill_log
+        self.error_queues = error_queues
+        self.errors_degraded_watermark = errors_degraded_watermark
+
+    def __call__(self, request):
+        degraded = False
+
+        queues = {}
+        for watermark, named_queues in (
+                (self.degraded_watermark, self.queues),
+                (self.errors_degraded_watermark, self.error_queues)):
+            for name, queue in named_queues:
+                depth = queue.depth
+                capacity = queue.capacity
+                queues[name] = {"depth": depth, "capacity": capacity}
+                if watermark is not None and depth >= watermark * capacity:
+                    degraded = True
+
+        result = {
+            "mood": u"\U0001F357",
+            "queues": queues,
+        }
+
+        if self.spill_log:
+            result["spill"] = {
+                "depth": self.spill_log.depth,
+                "bytes": self.spill_log.bytes,
+            }
+            if self.spill_log.depth:
+                degraded = True
+
+        if degraded:
+            result["status"] = "degraded"
+            request.response.status_int = self.degraded_status
+        else:
+            result["status"] = "ok"
+        return result
+
+
+class DebugStats(object):
+    """Reports this worker's request counters.
+
+    Requests must carry an ``Authorization: Bearer <secret>`` header. If a
+    :py:class:`~events.instrumentation.StageProfiler` is given, percentiles
+    of its recent stage timings are included too.
+
+    """
+
+    def __init__(self, secret, request_stats, profiler=None):
+        self.secret = secret
+        self.request_stats = request_stats
+        self.profiler = profiler
+
+    def __call__(self, request):
+        authorization = request.headers.get("Authorization", "")
+        if not constant_time_compare(authorization, "Bearer " + self.secret):
+            raise HTTPForbidden()
+
+        result = self.request_stats.snapshot()
+
+        if self.profiler:
+            stage_latencies = {}
+            for sample in self.profiler.recent():
+                for stage, elapsed_ms in sample["stages_ms"].iteritems():
+                    stage_latencies.setdefault(stage, []).append(
+                        elapsed_ms / 1000.)
+            result["stage_latency_ms"] = {
+                stage: summarize_latencies(latencies)
+                for stage, latencies in stage_latencies.iteritems()
+            }
+
+        return result
@@ -1,42 +1,377 @@
 """Backend process that consumes from a message queue and writes to Kafka."""
+import errno
 import itertools
 import logging
 import logging.config
 import os
+import select
 import time
 
-import baseplate
 import paste.deploy.loadwsgi
-from baseplate.message_queue import MessageQueue
+from baseplate.message_queue import TimedOutError
 
-from kafka import KafkaProducer
 from kafka.common import KafkaError, KafkaTimeoutError
 
-from .const import MAXIMUM_QUEUE_LENGTH, MAXIMUM_MESSAGE_SIZE
+from .compact import CompactEnvelopeError, is_compact, render_compact_event
+from .framing import FramingError, unpack_message
+from .metrics import make_metrics_client
+from .retry import DEFAULT_BASE_DELAY as DEFAULT_RETRY_BASE_DELAY
+from .retry import DEFAULT_MAX_ATTEMPTS as DEFAULT_RETRY_MAX_ATTEMPTS
+from .retry import DEFAULT_MAX_DELAY as DEFAULT_RETRY_MAX_DELAY
+from .retry import DEFAULT_MAX_PENDING as DEFAULT_RETRY_MAX_PENDING
+from .retry import RetryScheduler
+from .ring import ConsumerLockedError
+from .shutdown import (
+    DEFAULT_SHUTDOWN_TIMEOUT,
+    InFlightTracker,
+    ShutdownFlag,
+    instance_spill_path,
+    requeue_or_spill,
+    take_spilled,
+)
+from .sinks import FileSink, make_sink
+from .transport import make_queue
+from .tuning import DEFAULT_INTERVAL as DEFAULT_TUNING_INTERVAL
+from .tuning import ProducerTuner
 
 
 _LOG = logging.getLogger(__name__)
 _RETRY_DELAY_SECS = 1
+_FLUSH_POLL_SECS = 1
 
 
 def process_queue(queue, topic_name, kafka_producer, success_cb, err_cb,
-                  metrics_client=None):
-    """ Take messages off a queue and send to Kafka topic."""
-    while True:
-        message = queue.get()
-        while True:
+                  metrics_client=None, tuner=None, retry_scheduler=None,
+                  shutdown=None):
+    """ Take messages off a queue and send to Kafka topic.
+
+    Messages may either be single events or frames of several events; each
+    event is sent to Kafka individually, in its JSON envelope even if it was
+    queued in a compact one.
+
+    If a :py:class:`~events.tuning.ProducerTuner` is given, it is told about
+    each send and acknowledgement, and this returns when it wants the
+    producer recreated with new settings.
+
+    If a :py:class:`~events.retry.RetryScheduler` is given, failed events are
+    handed to it instead of err_cb and it is given the chance to resend them
+    between messages.
+
+    If a :py:class:`~events.shutdown.ShutdownFlag` is given, this returns
+    without taking any more messages once shutdown is requested.
+
+    """
+    while not (shutdown and shutdown.requested):
+        try:
+            if retry_scheduler:
+                message = _get_or_retry(
+                    queue, kafka_producer, success_cb, retry_scheduler)
+            else:
+                message = queue.get()
+        except select.error as exc:
+            # the signal handler has run; check whether it was for shutdown
+            if exc.args[0] == errno.EINTR:
+                continue
+            raise
+
+        if message is not None:
+            for event in _unpack(message, metrics_client):
+                _send_event(queue, topic_name, kafka_producer, event,
+                            success_cb, err_cb, metrics_client, tuner,
+                            retry_scheduler)
+
+        if tuner and tuner.should_retune():
+            return
+
+
+def _get_or_retry(queue, kafka_producer, success_cb, retry_scheduler):
+    """Resend due retries then wait for a message until the next is due.
+
+    This returns None if no message arrived in that time or if there are so
+    many retries pending that no new messages should be taken.
+
+    """
+    retry_scheduler.resend_due(kafka_producer, success_cb)
+    timeout = retry_scheduler.time_until_due()
+    if retry_scheduler.is_full():
+        time.sleep(timeout)
+        return None
+
+    try:
+        return queue.get(timeout=timeout)
+    except TimedOutError:
+        return None
+
+
+def _unpack(message, metrics_client):
+    try:
+        events = unpack_message(message)
+    except FramingError as exc:
+        _LOG.warning("dropping undecodable message: %s", exc)
+        if metrics_client:
+            metrics_client.counter("injector.bad_frame").increment()
+        return []
+
+    rendered = []
+    for event in events:
+        if is_compact(event):
             try:
-                kafka_producer.send(topic_name, message) \
-                              .add_callback(success_cb) \
-                              .add_errback(err_cb(message, queue))
-            except KafkaTimeoutError:
-                # In the event of a kafka error in send attempt,
-                #   retry sending after a delay
+                event = render_compact_event(event)
+            except CompactEnvelopeError as exc:
+                _LOG.warning("dropping undecodable event: %s", exc)
                 if metrics_client:
-                    metrics_client.counter("injector.pre_send_error").increment()
-                time.sleep(_RETRY_DELAY_SECS)
-            else:
+                    metrics_client.counter("injector.bad_envelope").increment()
+                continue
+        rendered.append(event)
+    return rendered
+
+
+def _send_event(queue, topic_name, kafka_producer, event, success_cb, err_cb,
+                metrics_client, tuner=None, retry_scheduler=None):
+    if retry_scheduler:
+        errback = retry_scheduler.errback(topic_name, event)
+    else:
+        errback = err_cb(event, queue)
+
+    while True:
+        try:
+            future = kafka_producer.send(topic_name, event) \
+                                   .add_callback(success_cb) \
+                                   .add_errback(errback)
+        except KafkaTimeoutError:
+            # In the event of a kafka error in send attempt,
+            #   retry sending after a delay
+            if metrics_client:
+                metrics_client.counter("injector.pre_send_error").increment()
+            if retry_scheduler:
+                retry_scheduler.schedule(topic_name, event, attempts=0)
+                return
+            time.sleep(_RETRY_DELAY_SECS)
+        else:
+            break
+
+    if tuner:
+        tuner.record_send(len(event))
+        sent_at = time.time()
+        future.add_callback(lambda _: tuner.record_ack(time.time() - sent_at))
+
+
+def drain_queue(queue, max_messages, linger_secs, timeout=None):
+    """Take a batch of messages off a queue.
+
+    This blocks until at least one message is available (or for up to
+    timeout seconds, returning an empty list if nothing arrived) and then
+    collects more until either max_messages have been gathered or
+    linger_secs have passed since the first one arrived.
+
+    """
+    try:
+        messages = [queue.get(timeout=timeout)]
+    except TimedOutError:
+        return []
+
+    deadline = time.time() + linger_secs
+    while len(messages) < max_messages:
+        try:
+            messages.append(queue.get(timeout=0))
+        except TimedOutError:
+            time_remaining = deadline - time.time()
+            if time_remaining <= 0:
+                break
+
+            try:
+                messages.append(queue.get(timeout=time_remaining))
+            except TimedOutError:
                 break
+            except select.error as exc:
+                # don't lose the messages already taken if a signal arrives
+                if exc.args[0] == errno.EINTR:
+                    break
+                raise
+    return messages
+
+
+def process_queue_batched(queue, topic_name, kafka_producer, success_cb,
+                          err_cb, metrics_client=None, max_messages=500,
+                          linger_secs=0.05, tuner=None, retry_scheduler=None,
+                          shutdown=None):
+    """ Take batches of messages off a queue and send them to Kafka topic.
+
+    Each drained batch is handed to the producer and flushed as a unit. The
+    callbacks are then invoked once per batch rather than once per message:
+    success_cb with the number of events delivered and err_cb with a list of
+    (event, exception) pairs for the ones which failed and the queue.
+
+    As with :py:func:`process_queue`, this returns when the tuner, if any,
+    wants the producer recreated or shutdown is requested, and failures go to
+    the retry_scheduler, if any, rather than err_cb. A flush that is still
+    waiting on Kafka when shutdown is requested is abandoned; the events it
+    was waiting for are left to the caller to close and requeue.
+
+    """
+    while not (shutdown and shutdown.requested):
+        try:
+            if retry_scheduler:
+                retry_scheduler.resend_due(
+                    kafka_producer, lambda _: success_cb(1))
+                if retry_scheduler.is_full():
+                    time.sleep(retry_scheduler.time_until_due())
+                    messages = []
+                else:
+                    messages = drain_queue(
+                        queue, max_messages, linger_secs,
+                        timeout=retry_scheduler.time_until_due())
+            else:
+                messages = drain_queue(queue, max_messages, linger_secs)
+        except select.error as exc:
+            if exc.args[0] == errno.EINTR:
+                continue
+            raise
+
+        events = []
+        for message in messages:
+            events.extend(_unpack(message, metrics_client))
+
+        futures = []
+        for event in events:
+            while True:
+                try:
+                    futures.append(
+                        (event, kafka_producer.send(topic_name, event)))
+                except KafkaTimeoutError:
+                    if metrics_client:
+                        metrics_client.counter(
+                            "injector.pre_send_error").increment()
+                    if retry_scheduler:
+                        retry_scheduler.schedule(topic_name, event, attempts=0)
+                        break
+                    time.sleep(_RETRY_DELAY_SECS)
+                else:
+                    break
+
+        sent_at = time.time()
+        flushed = _flush(kafka_producer, shutdown)
+        ack_latency = time.time() - sent_at
+
+        delivered = 0
+        failures = []
+        for event, future in futures:
+            if not future.is_done:
+                # abandoned for shutdown; main() requeues it
+                continue
+            elif future.failed():
+                failures.append((event, future.exception))
+            else:
+                delivered += 1
+
+        if delivered:
+            success_cb(delivered)
+        if failures:
+            if retry_scheduler:
+                for event, exc in failures:
+                    retry_scheduler.errback(topic_name, event)(exc)
+            else:
+                err_cb(failures, queue)
+
+        if not flushed:
+            return
+
+        if tuner:
+            for event in events:
+                tuner.record_send(len(event))
+            tuner.record_ack(ack_latency, count=len(futures))
+            if tuner.should_retune():
+                return
+
+
+def _flush(kafka_producer, shutdown=None):
+    """Flush the producer, giving up if shutdown is requested meanwhile.
+
+    Without a shutdown flag this waits as long as it takes. Returns whether
+    the flush completed.
+
+    """
+    if not shutdown:
+        kafka_producer.flush()
+        return True
+
+    while True:
+        try:
+            kafka_producer.flush(timeout=_FLUSH_POLL_SECS)
+            return True
+        except AssertionError:
+            # kafka-python 1.0.2 asserts when a flush times out
+            if shutdown.requested:
+                return False
+
+
+def process_queues(queues, kafka_producer, success_cb, err_cb,
+                   metrics_client=None, quantum=100, tuner=None,
+                   retry_scheduler=None, shutdown=None):
+    """ Take messages off several queues and send each to its Kafka topic.
+
+    queues is a list of (queue, topic_name) pairs. The queues are watched
+    together with select(2) and are served in turns: each turn, every queue
+    with messages waiting gets up to quantum messages taken off it. This
+    keeps a busy queue from starving a quiet one.
+
+    As with :py:func:`process_queue`, this returns when the tuner, if any,
+    wants the producer recreated or shutdown is requested, and failures go to
+    the retry_scheduler, if any, rather than err_cb.
+
+    """
+    descriptors = {queue.fileno(): (queue, topic_name)
+                   for queue, topic_name in queues}
+
+    while not (shutdown and shutdown.requested):
+        select_args = [list(descriptors), [], []]
+        if retry_scheduler:
+            retry_scheduler.resend_due(kafka_producer, success_cb)
+            select_args.append(retry_scheduler.time_until_due())
+            if retry_scheduler.is_full():
+                select_args[0] = []
+
+        try:
+            readable, _, _ = select.select(*select_args)
+        except select.error as exc:
+            if exc.args[0] == errno.EINTR:
+                continue
+            raise
+
+        for fd in readable:
+            queue, topic_name = descriptors[fd]
+            for _ in xrange(quantum):
+                try:
+                    message = queue.get(timeout=0)
+                except TimedOutError:
+                    break
+
+                for event in _unpack(message, metrics_client):
+                    _send_event(queue, topic_name, kafka_producer, event,
+                                success_cb, err_cb, metrics_client, tuner,
+                                retry_scheduler)
+
+        if tuner and tuner.should_retune():
+            return
+
+
+def claim_queues(queues):
+    """Make this process the consumer of each of the queues.
+
+    Returns whether it could. A transport which allows only one consumer (see
+    :py:mod:`events.ring`) won't let a second injector take its messages; that
+    is logged rather than raised since restarting won't help.
+
+    """
+    for queue, topic_name in queues:
+        try:
+            queue.fileno()
+        except ConsumerLockedError as exc:
+            _LOG.error("%s, only one injector may consume it (set "
+                       "INJECTOR_COUNT=1)", exc)
+            return False
+    return True
+
 
 def main():
     """Run a consumer.
@@ -46,7 +381,12 @@ def main():
     * CONFIG_URI: A PasteDeploy URI pointing at the configuration for the
       application.
     * QUEUE: The name of the queue to consume (currently one of "events" or
-      "errors").
+      "errors"). This may also be a comma-delimited list of queues, in which
+      case they are all consumed by this one process and share a single
+      Kafka producer.
+
+    INJECTOR_INSTANCE may also be set to tell apart several injectors of the
+    same queues, each of which gets its own shutdown spill file.
 
     """
     config_uri = os.environ["CONFIG_URI"]
@@ -54,56 +394,145 @@ def main():
 
     logging.config.fileConfig(config["__file__"])
 
-    queue_name = os.environ["QUEUE"]
-    queue = MessageQueue(
-        "/" + queue_name,
-        max_messages=MAXIMUM_QUEUE_LENGTH[queue_name],
-        max_message_size=MAXIMUM_MESSAGE_SIZE[queue_name],
-    )
+    queue_names = [name.strip() for name in os.environ["QUEUE"].split(",")
+                   if name.strip()]
+    queues = []
+    for queue_name in queue_names:
+        queue = make_queue(config, queue_name)
+        queues.append((queue, config["topic." + queue_name]))
 
-    metrics_client = baseplate.make_metrics_client(config)
+    if not claim_queues(queues):
+        return
 
-    topic_name = config["topic." + queue_name]
+    metrics_client = make_metrics_client(config)
 
     # Details at http://kafka-python.readthedocs.org/en/1.0.2/apidoc/KafkaProducer.html
+    compression_type = config.get("kafka.compression_type", "gzip")
     producer_options = {
-        "compression_type": 'gzip',
-        "batch_size": 20,
-        "linger_ms": 10,
+        "compression_type": None if compression_type == "none" else compression_type,
+        "batch_size": int(config.get("kafka.batch_size", 16384)),
+        "linger_ms": int(config.get("kafka.linger_ms", 10)),
         "retries": int(config["kafka_retries"]),
         "retry_backoff_ms": _RETRY_DELAY_SECS * 1000,
         "api_version": "0.8.2"
     }
 
-    def producer_error_cb(msg, queue):
-        def requeue_msg(exc):
-            _LOG.warning("failed to send message=%s due to error=%s", msg, exc)
-            metrics_client.counter("injector.error").increment()
-            queue.put(msg)
-        return requeue_msg
+    tuner = None
+    if config.get("kafka.adaptive", "false").lower() == "true":
+        tuner = ProducerTuner(
+            batch_size=producer_options["batch_size"],
+            linger_ms=producer_options["linger_ms"],
+            metrics_client=metrics_client,
+            interval=float(config.get(
+                "kafka.adaptive.interval", DEFAULT_TUNING_INTERVAL)),
+        )
+
+    dead_letter = None
+    if config.get("retry.dead_letter_path"):
+        dead_letter = FileSink(config["retry.dead_letter_path"])
+    retry_scheduler = RetryScheduler(
+        dead_letter=dead_letter,
+        metrics_client=metrics_client,
+        max_attempts=int(config.get(
+            "retry.max_attempts", DEFAULT_RETRY_MAX_ATTEMPTS)),
+        base_delay=float(config.get(
+            "retry.base_delay_ms", DEFAULT_RETRY_BASE_DELAY * 1000)) / 1000.,
+        max_delay=float(config.get(
+            "retry.max_delay_ms", DEFAULT_RETRY_MAX_DELAY * 1000)) / 1000.,
+        max_pending=int(config.get(
+            "retry.max_pending", DEFAULT_RETRY_MAX_PENDING)),
+    )
 
     def producer_success_cb(success_val):
         metrics_client.counter("collected.injector").increment()
 
-    while True:
+    def batch_success_cb(delivered):
+        metrics_client.counter("collected.injector").increment(delivered)
+
+    drain_max_messages = int(config.get("drain.max_messages", 1))
+    drain_linger_secs = float(config.get("drain.linger_ms", 0)) / 1000.
+
+    shutdown = ShutdownFlag()
+    shutdown.install()
+    shutdown_spill_path = instance_spill_path(
+        config.get("shutdown.spill_path"), queue_names,
+        os.environ.get("INJECTOR_INSTANCE"))
+    shutdown_timeout = float(config.get(
+        "shutdown.timeout", DEFAULT_SHUTDOWN_TIMEOUT))
+
+    # resend whatever couldn't be put back on the queues last time around
+    for topic_name, event in take_spilled(shutdown_spill_path):
+        retry_scheduler.schedule(topic_name, event, attempts=0)
+
+    kafka_producer = None
+    while not shutdown.requested:
+        if tuner:
+            producer_options.update(tuner.options)
+
         try:
-            kafka_brokers = [broker.strip() for broker in config['kafka_brokers'].split(',')]
-            kafka_producer = KafkaProducer(bootstrap_servers=kafka_brokers,
-                                           **producer_options)
+            kafka_producer = InFlightTracker(
+                make_sink(config, producer_options))
         except KafkaError as exc:
             _LOG.warning("could not connect: %s", exc)
             metrics_client.counter("injector.connection_error").increment()
             time.sleep(_RETRY_DELAY_SECS)
             continue
 
-        process_queue(queue,
-                      topic_name,
-                      kafka_producer,
-                      producer_success_cb,
-                      producer_error_cb,
-                      metrics_client=metrics_client)
+        if len(queues) > 1:
+            process_queues(queues,
+                           kafka_producer,
+                           producer_success_cb,
+                           None,
+                           metrics_client=metrics_client,
+                           quantum=int(config.get("multi_queue.quantum", 100)),
+                           tuner=tuner,
+                           retry_scheduler=retry_scheduler,
+                           shutdown=shutdown)
+        elif drain_max_messages > 1:
+            queue, topic_name = queues[0]
+            process_queue_batched(queue,
+                                  topic_name,
+                                  kafka_producer,
+                                  batch_success_cb,
+                                  None,
+                                  metrics_client=metrics_client,
+                                  max_messages=drain_max_messages,
+                                  linger_secs=drain_linger_secs,
+                                  tuner=tuner,
+                                  retry_scheduler=retry_scheduler,
+                                  shutdown=shutdown)
+        else:
+            queue, topic_name = queues[0]
+            process_queue(queue,
+                          topic_name,
+                          kafka_producer,
+                          producer_success_cb,
+                          None,
+                          metrics_client=metrics_client,
+                          tuner=tuner,
+                          retry_scheduler=retry_scheduler,
+                          shutdown=shutdown)
+
+        if not shutdown.requested:
+            kafka_producer.close()
+
+    if kafka_producer:
+        # give the producer until the deadline to deliver what it has,
+        # anything it gives up on is failed over to the retry scheduler.
+        kafka_producer.close(timeout=shutdown_timeout)
+        unsent = (kafka_producer.take_unacknowledged() +
+                  retry_scheduler.take_pending())
+    else:
+        unsent = retry_scheduler.take_pending()
+
+    _LOG.info("returning %d unsent events to the queues", len(unsent))
+    requeue_or_spill(
+        unsent,
+        {topic_name: queue for queue, topic_name in queues},
+        spill_path=shutdown_spill_path,
+        metrics_client=metrics_client,
+    )
 
-        kafka_producer.stop()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,114 @@
+"""Sampled timing of the stages of handling a request.
+
+When a request is sampled, the collector marks the end of each stage of its
+work on a :py:class:`StageTimer`. Afterwards, the time spent in each stage and
+the size of the payload before and after decompression are sent to the
+metrics client as timers and kept in a ring buffer of recent samples for
+inspection from within the process.
+
+Requests that aren't sampled get a timer which does nothing, so the cost of
+leaving this enabled at a low sample rate is a random number per request.
+
+"""
+
+import collections
+import random
+import time
+
+from .metrics import record_timing
+
+
+DEFAULT_SAMPLE_RATE = 0.
+DEFAULT_RING_SIZE = 1024
+
+
+class StageTimer(object):
+    """Measures the time between successive stages of a request."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.stages = []
+        self.keyname = None
+        self.compressed_bytes = None
+        self.inflated_bytes = None
+        self._last = self.started
+
+    def mark(self, stage):
+        """Record that stage has just finished."""
+        now = time.time()
+        self.stages.append((stage, now - self._last))
+        self._last = now
+
+    @property
+    def total(self):
+        return self._last - self.started
+
+
+class _NullStageTimer(object):
+    # stand-in for requests which aren't sampled. the keyname and size
+    # attributes are accepted and ignored.
+    __slots__ = ()
+
+    def mark(self, stage):
+        pass
+
+    def __setattr__(self, name, value):
+        pass
+
+
+NULL_STAGE_TIMER = _NullStageTimer()
+
+
+class StageProfiler(object):
+    """Hands out stage timers for a sample of requests and reports them.
+
+    Stage times are sent as ``stage.<stage>`` timers (plus ``stage.total``)
+    and payload sizes as ``payload.compressed_bytes`` and
+    ``payload.inflated_bytes``.
+
+    """
+
+    def __init__(self, metrics_client, sample_rate=DEFAULT_SAMPLE_RATE,
+                 ring_size=DEFAULT_RING_SIZE, seed=None):
+        self.metrics_client = metrics_client
+        self.sample_rate = sample_rate
+        self.samples = collections.deque(maxlen=ring_size)
+        self.random = random.Random(seed)
+
+    def start(self):
+        """Return a timer for a new request."""
+        if self.sample_rate and self.random.random() < self.sample_rate:
+            return StageTimer()
+        return NULL_STAGE_TIMER
+
+    def record(self, timer, status):
+        """Report the stages of a finished request."""
+        if timer is NULL_STAGE_TIMER:
+            return
+
+        for stage, elapsed in timer.stages:
+            record_timing(self.metrics_client,
+                          "stage." + stage, elapsed * 1000.)
+        record_timing(self.metrics_client,
+                      "stage.total", timer.total * 1000.)
+
+        for name in ("compressed_bytes", "inflated_bytes"):
+            size = getattr(timer, name)
+            if size is not None:
+                record_timing(self.metrics_client,
+                              "payload." + name, size)
+
+        self.samples.append({
+            "time": timer.started,
+            "key": timer.keyname,
+            "status": status,
+            "stages_ms": collections.OrderedDict(
+                (stage, elapsed * 1000.) for stage, elapsed in timer.stages),
+            "total_ms": timer.total * 1000.,
+            "compressed_bytes": timer.compressed_bytes,
+            "inflated_bytes": timer.inflated_bytes,
+        })
+
+    def recent(self):
+        """Return the samples in the ring buffer, oldest first."""
+        return list(self.samples)
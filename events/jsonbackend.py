@@ -0,0 +1,114 @@
+"""Interchangeable JSON implementations.
+
+The collector's JSON work is scanning batches for the span of each event (see
+:py:mod:`events.envelope`) and serializing envelopes. Both go through a
+:py:class:`JSONBackend` so that a faster implementation can be swapped in
+where one is installed. Every backend must produce exactly the same
+envelopes and accept exactly the same batches; ``tests/jsonbackend_tests.py``
+checks that for each available backend.
+
+Decoding is strict for every backend: ``NaN``, ``Infinity`` and
+``-Infinity`` are rejected since they aren't JSON and would break consumers
+downstream.
+
+More implementations can be supported with :py:func:`register_backend`. They
+have to offer a scanner compatible with the stdlib's
+``JSONDecoder.scan_once`` (decode one value starting at an offset and say
+where it ended), which rules out libraries like ujson that can only decode
+whole documents.
+
+"""
+
+import json
+import logging
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+
+DEFAULT_BACKEND = "stdlib"
+
+_LOG = logging.getLogger(__name__)
+_BACKENDS = {}
+
+
+class JSONBackend(object):
+    """A JSON implementation.
+
+    * ``loads(string)`` decodes a document.
+    * ``dumps(obj)`` encodes an object with the stdlib's default formatting.
+    * ``scan_once(string, idx)`` decodes the value starting at idx and
+      returns it along with the index just past it. It raises
+      :py:exc:`StopIteration` if there is no value at idx and
+      :py:exc:`ValueError` if the value is invalid.
+
+    """
+
+    def __init__(self, name, loads, dumps, scan_once):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+        self.scan_once = scan_once
+
+
+def _reject_constant(name):
+    raise ValueError("%s is not valid JSON" % name)
+
+
+def register_backend(name, factory):
+    """Register a function which returns a :py:class:`JSONBackend`.
+
+    A factory of None registers a backend that is known but not installed.
+
+    """
+    _BACKENDS[name.lower()] = factory
+
+
+def get_backend(name=DEFAULT_BACKEND):
+    """Return a backend by name.
+
+    A known backend that isn't installed is replaced by the default one
+    (with a warning) rather than keeping the collector from starting.
+
+    :raises: :py:exc:`ValueError` if there is no such backend.
+
+    """
+    try:
+        factory = _BACKENDS[name.lower()]
+    except KeyError:
+        raise ValueError("unknown JSON backend: %r" % name)
+
+    if factory is None:
+        _LOG.warning("JSON backend %r is not installed, using %r",
+                     name, DEFAULT_BACKEND)
+        factory = _BACKENDS[DEFAULT_BACKEND]
+    return factory()
+
+
+def available_backends():
+    """Return the names of all the usable backends."""
+    return sorted(name for name, factory in _BACKENDS.iteritems()
+                  if factory is not None)
+
+
+def make_stdlib_backend():
+    """The json module, with its C accelerations."""
+    decoder = json.JSONDecoder(parse_constant=_reject_constant)
+    encoder = json.JSONEncoder(allow_nan=False)
+    return JSONBackend("stdlib", decoder.decode, encoder.encode,
+                       decoder.scan_once)
+
+
+def make_simplejson_backend():
+    """simplejson, which has its own (often faster) C accelerations."""
+    decoder = simplejson.JSONDecoder(parse_constant=_reject_constant)
+    encoder = simplejson.JSONEncoder(allow_nan=False)
+    return JSONBackend("simplejson", decoder.decode, encoder.encode,
+                       decoder.scan_once)
+
+
+register_backend("stdlib", make_stdlib_backend)
+register_backend(
+    "simplejson", make_simplejson_backend if simplejson else None)
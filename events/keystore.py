@@ -0,0 +1,136 @@
+"""Storage of the HMAC keys used to sign event batches."""
+
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import signal
+import time
+
+
+_LOG = logging.getLogger(__name__)
+
+
+def _make_prototype(secret):
+    # the key pads are computed here once; copies of the prototype start from
+    # that state rather than hashing the key again for every request.
+    return hmac.new(secret, digestmod=hashlib.sha256)
+
+
+def parse_key_file(path):
+    """Read keys from a key file.
+
+    The file has one key per line in the form ``KeyName = base64secret``.
+    Blank lines and lines starting with ``#`` or ``;`` are ignored.
+
+    """
+    keys = {}
+    with open(path) as key_file:
+        for line_number, line in enumerate(key_file, start=1):
+            line = line.strip()
+            if not line or line[0] in "#;":
+                continue
+
+            try:
+                name, value = line.split("=", 1)
+                keys[name.strip()] = base64.b64decode(value.strip())
+            except (ValueError, TypeError):
+                raise ValueError(
+                    "%s:%d: malformed key entry" % (path, line_number))
+    return keys
+
+
+class Keystore(object):
+    """A set of named HMAC keys.
+
+    The static keys given are always present. If a key_file is given, keys
+    are also loaded from it and it is reloaded whenever its modification time
+    changes (checked at most every check_interval seconds) or, if
+    :py:meth:`install_sighup_handler` was called, when the process gets
+    SIGHUP. Keys from the file take precedence over static ones.
+
+    A reload builds a whole new set of keys and swaps it in at once, so a
+    request is always checked against a consistent set. The current secrets
+    are in the keys dict, by name.
+
+    """
+
+    def __init__(self, keys, key_file=None, check_interval=5.):
+        self.static_keys = dict(keys)
+        self.key_file = key_file
+        self.check_interval = check_interval
+
+        self.keys = {}
+        self._prototypes = {}
+        self._file_mtime = None
+        self._next_check = 0
+        self._reload_requested = False
+        self.reload()
+
+    def __contains__(self, keyname):
+        return keyname in self._prototypes
+
+    def reload(self):
+        """Rebuild the set of keys from the static keys and the key file."""
+        keys = dict(self.static_keys)
+        if self.key_file:
+            mtime = os.stat(self.key_file).st_mtime
+            keys.update(parse_key_file(self.key_file))
+            self._file_mtime = mtime
+
+        self._prototypes = {
+            name: _make_prototype(secret) for name, secret in keys.iteritems()}
+        self.keys = keys
+
+    def _maybe_reload(self):
+        now = time.time()
+        if not self._reload_requested and now < self._next_check:
+            return
+        self._next_check = now + self.check_interval
+
+        try:
+            if (self._reload_requested or
+                    os.stat(self.key_file).st_mtime != self._file_mtime):
+                self._reload_requested = False
+                self.reload()
+                _LOG.info("reloaded keys from %s", self.key_file)
+        except (EnvironmentError, ValueError) as exc:
+            _LOG.warning("failed to reload keys, keeping old ones: %s", exc)
+
+    def new_mac(self, keyname):
+        """Return a fresh HMAC-SHA256 object for the named key.
+
+        :raises: :py:exc:`KeyError` if there is no such key.
+
+        """
+        if self.key_file:
+            self._maybe_reload()
+        return self._prototypes[keyname].copy()
+
+    def install_sighup_handler(self):
+        """Reload the key file on the next lookup after SIGHUP."""
+        def request_reload(signum, frame):
+            self._reload_requested = True
+        signal.signal(signal.SIGHUP, request_reload)
+
+
+def make_keystore(settings):
+    """Return a :py:class:`Keystore` of the keys configured in settings.
+
+    These are the ``key.<name>`` settings, with base64 encoded secrets, and
+    the ``key_file``, if any.
+
+    """
+    keys = {}
+    for setting, value in settings.iteritems():
+        key_prefix = "key."
+        if setting.startswith(key_prefix):
+            key_name = setting[len(key_prefix):]
+            keys[key_name] = base64.b64decode(value)
+
+    return Keystore(
+        keys,
+        key_file=settings.get("key_file") or None,
+        check_interval=float(settings.get("key_file.check_interval", 5)),
+    )
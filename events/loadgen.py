@@ -0,0 +1,357 @@
+"""Signed-traffic load generator for the event collector.
+
+This produces realistic, correctly signed event batches using the keys from
+the collector's own configuration file and sends them either to an
+in-process instance of the WSGI app or to a running collector over HTTP,
+including the gunicorn unix socket. For example, to drive the local
+collector at 200 requests per second for a minute:
+
+    event-loadgen /etc/events.ini --target unix:/run/events.socket \\
+        --rps 200 --duration 60
+
+or as fast as 16 concurrent clients can go:
+
+    event-loadgen /etc/events.ini --target unix:/run/events.socket \\
+        --concurrency 16 --duration 60
+
+When the target is ``wsgi``, the app is loaded in-process from the
+configuration file. It then uses the real message queues, so something needs
+to be consuming them for a long run.
+
+"""
+
+import argparse
+import collections
+from cStringIO import StringIO
+import gzip
+import hashlib
+import hmac
+import httplib
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+import urlparse
+
+import paste.deploy
+import paste.deploy.loadwsgi
+import webob
+
+from .keystore import make_keystore
+from .stats import summarize_latencies
+
+
+INVALID_KINDS = ["bad_mac", "bad_json", "not_a_list", "no_useragent"]
+
+
+def load_keys(settings, names=None):
+    """Return the (name, secret) pairs of the signing keys in settings.
+
+    These are loaded as the collector does, from ``key.*`` and ``key_file``.
+
+    """
+    keys = make_keystore(settings).keys
+    return [(name, keys[name]) for name in sorted(keys)
+            if not names or name in names]
+
+
+class BatchGenerator(object):
+    """Makes signed requests with randomized batches of events.
+
+    Batch sizes are uniform between 1 and max_batch_size events. Event sizes
+    are log-normally distributed around event_size bytes. gzip_ratio of the
+    requests are gzipped and invalid_ratio are broken in one of the ways in
+    :py:data:`INVALID_KINDS`.
+
+    """
+
+    def __init__(self, keys, max_batch_size=20, event_size=500,
+                 event_size_sigma=0.5, gzip_ratio=0., invalid_ratio=0.,
+                 signature="header", seed=None):
+        self.keys = keys
+        self.max_batch_size = max_batch_size
+        self.event_size = event_size
+        self.event_size_sigma = event_size_sigma
+        self.gzip_ratio = gzip_ratio
+        self.invalid_ratio = invalid_ratio
+        self.signature = signature
+        self.random = random.Random(seed)
+
+    def _make_event(self):
+        size = int(self.random.lognormvariate(0, self.event_size_sigma) *
+                   self.event_size)
+        return {
+            "event_topic": "loadgen",
+            "event_type": "synthetic",
+            "client_time": int(time.time() * 1000),
+            "uuid": "%032x" % self.random.getrandbits(128),
+            "payload": "x" * max(size - 150, 0),
+        }
+
+    def make_request(self):
+        """Return (path, headers, body, kind) for a new request."""
+        kind = "valid"
+        if self.random.random() < self.invalid_ratio:
+            kind = self.random.choice(INVALID_KINDS)
+
+        batch = [self._make_event()
+                 for _ in xrange(self.random.randint(1, self.max_batch_size))]
+        if kind == "not_a_list":
+            body = json.dumps(batch[0])
+        elif kind == "bad_json":
+            body = json.dumps(batch)[:-1]
+        else:
+            body = json.dumps(batch)
+
+        keyname, secret = self.random.choice(self.keys)
+        mac = hmac.new(secret, body, hashlib.sha256).hexdigest()
+        if kind == "bad_mac":
+            mac = mac[::-1]
+
+        headers = {"Content-Type": "application/json"}
+        if kind != "no_useragent":
+            headers["User-Agent"] = "event-loadgen/1.0"
+
+        if self.random.random() < self.gzip_ratio:
+            f = StringIO()
+            with gzip.GzipFile(fileobj=f, mode="wb") as gz:
+                gz.write(body)
+            body = f.getvalue()
+            headers["Content-Encoding"] = "gzip"
+
+        path = "/v1"
+        if self.signature == "header":
+            headers["X-Signature"] = "key=%s, mac=%s" % (keyname, mac)
+        else:
+            path += "?key=%s&mac=%s" % (keyname, mac)
+
+        return path, headers, body, kind
+
+
+class WSGITarget(object):
+    """Sends requests to a WSGI application in this process."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def send(self, path, headers, body):
+        request = webob.Request.blank(
+            path, method="POST", headers=headers, body=body)
+        request.environ["REMOTE_ADDR"] = "127.0.0.1"
+        return request.get_response(self.app).status_int
+
+
+class _UnixHTTPConnection(httplib.HTTPConnection):
+    def __init__(self, path, timeout):
+        httplib.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class HTTPTarget(object):
+    """Sends requests over HTTP to a unix:/path socket or http:// URL.
+
+    Each thread keeps its own persistent connection.
+
+    """
+
+    def __init__(self, target, timeout=10):
+        self.target = target
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _connect(self):
+        if self.target.startswith("unix:"):
+            return _UnixHTTPConnection(self.target[len("unix:"):], self.timeout)
+        parsed = urlparse.urlparse(self.target)
+        return httplib.HTTPConnection(
+            parsed.hostname, parsed.port or 80, timeout=self.timeout)
+
+    def send(self, path, headers, body):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = self._connect()
+
+        try:
+            connection.request("POST", path, body, headers)
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            self.local.connection = None
+            raise
+
+
+class Results(object):
+    """Thread-safe collection of request outcomes."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.statuses = collections.Counter()
+        self.kinds = collections.Counter()
+
+    def record(self, latency, status, kind):
+        with self.lock:
+            self.latencies.append(latency)
+            self.statuses[status] += 1
+            self.kinds[kind] += 1
+
+
+def _send_one(target, generator_lock, generator, results, scheduled_at=None):
+    with generator_lock:
+        path, headers, body, kind = generator.make_request()
+
+    # in open-loop mode, latency counts from when the request was due so that
+    # a slow server can't hide its backlog
+    start = scheduled_at or time.time()
+    try:
+        status = target.send(path, headers, body)
+    except Exception as exc:
+        status = "error:" + type(exc).__name__
+    results.record(time.time() - start, status, kind)
+
+
+def run_closed_loop(target, generator, concurrency, duration):
+    """Send requests back to back from concurrency threads."""
+    results = Results()
+    generator_lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def client():
+        while time.time() < deadline:
+            _send_one(target, generator_lock, generator, results)
+
+    threads = [threading.Thread(target=client) for _ in xrange(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def run_open_loop(target, generator, rps, duration, concurrency):
+    """Start requests at a fixed rate, served by concurrency threads."""
+    results = Results()
+    generator_lock = threading.Lock()
+    schedule = collections.deque()
+    condition = threading.Condition()
+    done = []
+
+    def client():
+        while True:
+            with condition:
+                while not schedule and not done:
+                    condition.wait()
+                if not schedule:
+                    return
+                scheduled_at = schedule.popleft()
+            _send_one(target, generator_lock, generator, results,
+                      scheduled_at=scheduled_at)
+
+    threads = [threading.Thread(target=client) for _ in xrange(concurrency)]
+    for thread in threads:
+        thread.start()
+
+    start = time.time()
+    interval = 1. / rps
+    for i in xrange(int(rps * duration)):
+        scheduled_at = start + i * interval
+        delay = scheduled_at - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        with condition:
+            schedule.append(scheduled_at)
+            condition.notify()
+
+    with condition:
+        done.append(True)
+        condition.notify_all()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def report(results, elapsed, out=sys.stdout):
+    """Print a summary of a run."""
+    total = len(results.latencies)
+    print >> out, "requests: %d in %.1fs (%.1f req/s)" % (
+        total, elapsed, total / elapsed)
+    print >> out, "statuses: %s" % ", ".join(
+        "%s=%d" % item for item in sorted(results.statuses.items()))
+    print >> out, "kinds: %s" % ", ".join(
+        "%s=%d" % item for item in sorted(results.kinds.items()))
+    latencies = summarize_latencies(
+        results.latencies, fractions=(0.5, 0.9, 0.99, 0.999))
+    print >> out, "latency ms: %s" % ", ".join(
+        "%s=%.2f" % (name, value)
+        for name, value in sorted(latencies.items(), key=lambda i: float(i[0][1:]))
+        if value is not None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("config", help="the collector's ini file")
+    parser.add_argument("--target", default="wsgi",
+                        help='"wsgi", "unix:/path/to.socket" or "http://host:port"')
+    parser.add_argument("--key", action="append", dest="keys",
+                        help="only sign with this key (may be repeated)")
+    load = parser.add_mutually_exclusive_group()
+    load.add_argument("--rps", type=float,
+                      help="open loop: start this many requests per second")
+    load.add_argument("--concurrency", type=int, default=4,
+                      help="closed loop: number of concurrent clients")
+    parser.add_argument("--threads", type=int, default=32,
+                        help="client threads used in open loop mode")
+    parser.add_argument("--duration", type=float, default=10.)
+    parser.add_argument("--max-batch-size", type=int, default=20)
+    parser.add_argument("--event-size", type=int, default=500)
+    parser.add_argument("--event-size-sigma", type=float, default=0.5)
+    parser.add_argument("--gzip-ratio", type=float, default=0.)
+    parser.add_argument("--invalid-ratio", type=float, default=0.)
+    parser.add_argument("--signature", choices=["header", "query"],
+                        default="header")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    config_uri = "config:" + os.path.abspath(args.config)
+    keys = load_keys(paste.deploy.loadwsgi.appconfig(config_uri), args.keys)
+    if not keys:
+        parser.error("no matching keys found in %s" % args.config)
+
+    generator = BatchGenerator(
+        keys,
+        max_batch_size=args.max_batch_size,
+        event_size=args.event_size,
+        event_size_sigma=args.event_size_sigma,
+        gzip_ratio=args.gzip_ratio,
+        invalid_ratio=args.invalid_ratio,
+        signature=args.signature,
+        seed=args.seed,
+    )
+
+    if args.target == "wsgi":
+        target = WSGITarget(paste.deploy.loadapp(config_uri))
+    else:
+        target = HTTPTarget(args.target)
+
+    start = time.time()
+    if args.rps:
+        results = run_open_loop(
+            target, generator, args.rps, args.duration, args.threads)
+    else:
+        results = run_closed_loop(
+            target, generator, args.concurrency, args.duration)
+    report(results, time.time() - start)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+"""Locally aggregated metrics.
+
+baseplate's metrics client sends a statsd packet for every counter increment
+and timer, which adds up to a lot of packets at the rate the collector and
+injectors handle events. The aggregating client here has the same interface
+but accumulates metrics in memory instead:
+
+* counters are summed per name (sampled increments are scaled up first, as
+  statsd would),
+* gauges keep their latest value or the sum of their relative changes,
+* timers keep every sample so that statsd still sees the full distribution.
+
+Everything is sent together, packed into as few packets as possible, once
+per flush_interval seconds, when more than max_pending timer samples are
+waiting, and on :py:meth:`~AggregatingMetricsClient.flush` (e.g. at exit).
+
+"""
+
+import atexit
+import os
+import threading
+import time
+
+import baseplate
+
+
+DEFAULT_FLUSH_INTERVAL = 1.
+DEFAULT_MAX_PENDING = 1000
+
+# keep each packet within a typical ethernet MTU after IP/UDP headers
+MAXIMUM_PACKET_SIZE = 1432
+
+
+def _metric_join(*nodes):
+    return ".".join(node.strip(".") for node in nodes)
+
+
+def _format_value(value):
+    return "{:g}".format(value)
+
+
+class _Counter(object):
+    def __init__(self, aggregator, name):
+        self.aggregator = aggregator
+        self.name = name
+
+    def increment(self, delta=1, sample_rate=1.0):
+        if sample_rate and sample_rate != 1.0:
+            delta = float(delta) / sample_rate
+        self.aggregator.add_count(self.name, delta)
+
+    def decrement(self, delta=1, sample_rate=1.0):
+        self.increment(delta=-delta, sample_rate=sample_rate)
+
+
+class _Gauge(object):
+    def __init__(self, aggregator, name):
+        self.aggregator = aggregator
+        self.name = name
+
+    def increment(self, delta=1):
+        self.aggregator.change_gauge(self.name, delta)
+
+    def decrement(self, delta=1):
+        self.increment(-delta)
+
+    def replace(self, new_value):
+        assert new_value >= 0, "gauges cannot be replaced with negative numbers"
+        self.aggregator.replace_gauge(self.name, new_value)
+
+
+class _Timer(object):
+    def __init__(self, aggregator, name):
+        self.aggregator = aggregator
+        self.name = name
+        self.start_time = None
+        self.stopped = False
+
+    def start(self):
+        assert not self.start_time, "timer already started"
+        assert not self.stopped, "time already stopped"
+        self.start_time = time.time()
+
+    def stop(self):
+        assert self.start_time, "timer not started"
+        assert not self.stopped, "time already stopped"
+        elapsed = (time.time() - self.start_time) * 1000.
+        self.aggregator.add_timing(self.name, elapsed)
+        self.stopped = True
+
+    def __enter__(self):
+        self.start()
+
+    def __exit__(self, exc_type, value, traceback):
+        self.stop()
+
+
+class AggregatingMetricsClient(object):
+    """A drop-in replacement for :py:class:`baseplate.metrics.Client`.
+
+    Metrics are sent with the transport and namespace of the wrapped client.
+
+    """
+
+    def __init__(self, client, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 max_pending=DEFAULT_MAX_PENDING):
+        self.transport = client.transport
+        self.namespace = client.namespace
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._timers = {}
+        self._pending_timings = 0
+        self._next_flush = time.time() + flush_interval
+        self._flusher_pid = None
+
+    def _name(self, name):
+        return _metric_join(self.namespace, name.encode("ascii"))
+
+    def counter(self, name):
+        return _Counter(self, self._name(name))
+
+    def gauge(self, name):
+        return _Gauge(self, self._name(name))
+
+    def timer(self, name):
+        return _Timer(self, self._name(name))
+
+    def batch(self):
+        # everything is batched already, but some callers ask explicitly
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, value, traceback):
+        pass
+
+    def add_count(self, name, delta):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + delta
+        self._maybe_flush()
+
+    def change_gauge(self, name, delta):
+        with self._lock:
+            replaced, value = self._gauges.get(name, (False, 0))
+            self._gauges[name] = (replaced, value + delta)
+        self._maybe_flush()
+
+    def replace_gauge(self, name, value):
+        with self._lock:
+            self._gauges[name] = (True, value)
+        self._maybe_flush()
+
+    def add_timing(self, name, elapsed_ms):
+        with self._lock:
+            self._timers.setdefault(name, []).append(elapsed_ms)
+            self._pending_timings += 1
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        # the flusher thread doesn't survive forking, so (re)start it lazily
+        # in whichever process is recording metrics.
+        if self._flusher_pid != os.getpid():
+            self._start_flusher()
+
+        if (self._pending_timings >= self.max_pending or
+                time.time() >= self._next_flush):
+            self.flush()
+
+    def _start_flusher(self):
+        self._flusher_pid = os.getpid()
+
+        def flush_periodically():
+            while True:
+                time.sleep(self.flush_interval)
+                if time.time() >= self._next_flush:
+                    self.flush()
+
+        thread = threading.Thread(
+            target=flush_periodically, name="metrics-flusher")
+        thread.daemon = True
+        thread.start()
+
+    def _serialize(self, counters, gauges, timers):
+        for name, delta in sorted(counters.iteritems()):
+            if delta:
+                yield name + ":" + _format_value(delta) + "|c"
+
+        for name, (replaced, value) in sorted(gauges.iteritems()):
+            if replaced:
+                if value < 0:
+                    # statsd can't set a negative gauge directly
+                    yield name + ":0|g"
+                    yield name + ":" + _format_value(value) + "|g"
+                else:
+                    yield name + ":" + _format_value(value) + "|g"
+            elif value:
+                yield name + ":" + "{:+g}".format(value) + "|g"
+
+        for name, samples in sorted(timers.iteritems()):
+            for elapsed in samples:
+                yield name + ":" + _format_value(elapsed) + "|ms"
+
+    def flush(self):
+        """Send everything accumulated so far."""
+        with self._lock:
+            counters, self._counters = self._counters, {}
+            gauges, self._gauges = self._gauges, {}
+            timers, self._timers = self._timers, {}
+            self._pending_timings = 0
+            self._next_flush = time.time() + self.flush_interval
+
+        packet = []
+        packet_size = 0
+        for line in self._serialize(counters, gauges, timers):
+            if packet and packet_size + 1 + len(line) > MAXIMUM_PACKET_SIZE:
+                self.transport.send("\n".join(packet))
+                packet = []
+                packet_size = 0
+            packet.append(line)
+            packet_size += len(line) + 1
+        if packet:
+            self.transport.send("\n".join(packet))
+
+
+def make_metrics_client(settings):
+    """Return a metrics client configured from settings.
+
+    This is :py:func:`baseplate.make_metrics_client` unless
+    ``metrics.aggregate`` is true, in which case the client is wrapped in an
+    :py:class:`AggregatingMetricsClient` (tuned by ``metrics.flush_interval``
+    and ``metrics.max_pending``) which is also flushed at exit.
+
+    """
+    client = baseplate.make_metrics_client(settings)
+    if settings.get("metrics.aggregate", "false").lower() != "true":
+        return client
+
+    aggregating_client = AggregatingMetricsClient(
+        client,
+        flush_interval=float(settings.get(
+            "metrics.flush_interval", DEFAULT_FLUSH_INTERVAL)),
+        max_pending=int(settings.get(
+            "metrics.max_pending", DEFAULT_MAX_PENDING)),
+    )
+    atexit.register(aggregating_client.flush)
+    return aggregating_client
+
+
+def record_timing(metrics_client, name, value):
+    """Send a timer metric whose value has already been measured.
+
+    baseplate's timers can only measure time themselves, but statsd timers
+    are also the way to get a distribution of any other value (e.g. sizes).
+
+    """
+    if isinstance(metrics_client, AggregatingMetricsClient):
+        metrics_client.add_timing(metrics_client._name(name), value)
+    else:
+        timer_name = _metric_join(
+            metrics_client.namespace, name.encode("ascii"))
+        metrics_client.transport.send(
+            timer_name + ":" + _format_value(value) + "|ms")
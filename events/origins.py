@@ -0,0 +1,59 @@
+"""Matching of request origins against the CORS whitelist."""
+
+import collections
+import urlparse
+
+
+DEFAULT_CACHE_SIZE = 1024
+
+
+class OriginMatcher(object):
+    """A precompiled origin whitelist.
+
+    The whitelist is a list of domains, any subdomain of which is also
+    allowed, or ``["*"]`` to allow all origins. It is compiled into a set of
+    domains so that checking an origin costs one lookup per label in its
+    hostname rather than a scan of the whole whitelist. Verdicts for the most
+    recently seen cache_size origins are remembered.
+
+    """
+
+    def __init__(self, whitelist, cache_size=DEFAULT_CACHE_SIZE):
+        self.allow_all = list(whitelist) == ["*"]
+        self.domains = frozenset(whitelist)
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+
+    def _check(self, origin):
+        try:
+            parsed = urlparse.urlparse(origin)
+            port = parsed.port
+        except ValueError:
+            return False
+
+        if parsed.scheme not in ("http", "https"):
+            return False
+
+        if port is not None and port not in (80, 443):
+            return False
+
+        hostname = parsed.hostname
+        while hostname:
+            if hostname in self.domains:
+                return True
+            _, _, hostname = hostname.partition(".")
+        return False
+
+    def is_allowed(self, origin):
+        """Check if the reported origin of a request is on the whitelist."""
+        if self.allow_all:
+            return True
+
+        try:
+            verdict = self._cache.pop(origin)
+        except KeyError:
+            verdict = self._check(origin)
+            if len(self._cache) >= self.cache_size:
+                self._cache.popitem(last=False)
+        self._cache[origin] = verdict
+        return verdict
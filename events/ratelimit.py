@@ -0,0 +1,106 @@
+"""Per-key rate limits, enforced across all of a host's workers.
+
+Without limits, a single misbehaving client (a buggy app release resending in
+a loop, say) can fill the event queue and push the whole pipeline into
+backpressure, starving every other key. :py:class:`RateLimiter` gives each
+key a pair of token buckets, one counting events and one counting bytes,
+which refill at the key's configured rates and hold up to burst seconds'
+worth. A batch is only accepted if both buckets can cover it.
+
+The buckets are kept in a :py:class:`~events.shm.SharedHashTable` so that the
+limits apply to a host's traffic as a whole rather than per worker.
+
+"""
+
+import time
+
+from .shm import SharedHashTable
+
+
+DEFAULT_PATH = "/dev/shm/event-collector-ratelimit"
+DEFAULT_CAPACITY = 4096
+DEFAULT_BURST = 10.
+
+# event tokens, byte tokens, time of last update, events rate, bytes rate
+_VALUE_FORMAT = "!ddddd"
+
+
+def parse_limits(value):
+    """Parse an "events/sec, bytes/sec" setting. 0 means unlimited."""
+    events_per_second, bytes_per_second = (
+        float(x) for x in value.split(","))
+    return events_per_second, bytes_per_second
+
+
+class RateLimiter(object):
+    """Token-bucket limits on the events and bytes each key may send.
+
+    limits is a dict of key name to (events per second, bytes per second)
+    and default_limits applies to every other key. A rate of 0 is no limit.
+
+    """
+
+    def __init__(self, limits, default_limits=(0, 0), burst=DEFAULT_BURST,
+                 path=DEFAULT_PATH, capacity=DEFAULT_CAPACITY):
+        self.limits = limits
+        self.default_limits = default_limits
+        self.burst = burst
+        self.table = SharedHashTable(
+            path, capacity, _VALUE_FORMAT, reclaimable=self._is_full)
+
+    def _is_full(self, value):
+        # a bucket which has had time to refill is the same as no bucket, but
+        # one left in debt by an oversized batch takes longer than burst.
+        event_tokens, byte_tokens, updated, events_rate, bytes_rate = value
+        elapsed = max(time.time() - updated, 0)
+        for tokens, rate in ((event_tokens, events_rate),
+                             (byte_tokens, bytes_rate)):
+            capacity = rate * self.burst
+            if rate and self._refill(tokens, rate, elapsed) < capacity:
+                return False
+        return True
+
+    def _refill(self, tokens, rate, elapsed):
+        return min(tokens + rate * elapsed, rate * self.burst)
+
+    def _shortfall(self, tokens, rate, cost):
+        if not rate:
+            return 0
+        # a batch bigger than the whole bucket is allowed through once the
+        # bucket is full, leaving it in debt.
+        needed = min(cost, rate * self.burst)
+        return max(needed - tokens, 0) / rate
+
+    def acquire(self, keyname, events, size):
+        """Take the tokens for a batch of events totalling size bytes.
+
+        Returns 0 if the batch is within the key's limits, otherwise the
+        number of seconds until it would be (and nothing is taken).
+
+        """
+        events_rate, bytes_rate = self.limits.get(keyname, self.default_limits)
+        if not (events_rate or bytes_rate):
+            return 0
+
+        now = time.time()
+
+        def take(current):
+            if current:
+                event_tokens, byte_tokens, updated, _, _ = current
+                elapsed = max(now - updated, 0)
+                event_tokens = self._refill(event_tokens, events_rate, elapsed)
+                byte_tokens = self._refill(byte_tokens, bytes_rate, elapsed)
+            else:
+                event_tokens = events_rate * self.burst
+                byte_tokens = bytes_rate * self.burst
+
+            wait = max(self._shortfall(event_tokens, events_rate, events),
+                       self._shortfall(byte_tokens, bytes_rate, size))
+            if not wait:
+                if events_rate:
+                    event_tokens -= events
+                if bytes_rate:
+                    byte_tokens -= size
+            return (event_tokens, byte_tokens, now,
+                    events_rate, bytes_rate), wait
+        return self.table.update(keyname.encode("utf-8"), take)
@@ -0,0 +1,178 @@
+"""Delayed retries of events that Kafka failed to accept.
+
+Delivery failures are reported on the Kafka producer's I/O thread, which
+must never block: if it does, nothing else gets delivered either. So the
+errbacks made here only record the failed event in a heap ordered by when it
+is next due, and the injector's consumer loop calls
+:py:meth:`RetryScheduler.resend_due` to send the events whose time has come.
+
+Each event is retried with exponential backoff plus jitter. Once it has
+failed max_attempts times, it is given up on and written to the dead-letter
+sink (if there is one) rather than being retried forever.
+
+"""
+
+import heapq
+import logging
+import random
+import threading
+import time
+
+from kafka.common import KafkaTimeoutError
+
+
+_LOG = logging.getLogger(__name__)
+
+DEFAULT_MAX_ATTEMPTS = 10
+DEFAULT_BASE_DELAY = 0.5
+DEFAULT_MAX_DELAY = 60.
+DEFAULT_JITTER = 0.5
+DEFAULT_MAX_PENDING = 10000
+
+# how long the consumer may wait for new messages when no retry is due, so
+# that failures reported in the meantime aren't left waiting for traffic
+_IDLE_POLL_INTERVAL = 1.
+
+
+class RetryScheduler(object):
+    """Schedules failed events to be resent after a backoff.
+
+    The delay before attempt n+1 is ``base_delay * 2 ** (n - 1)`` capped at
+    max_delay, less a random fraction (up to jitter) of it so that a burst of
+    failures doesn't come back as a burst of retries.
+
+    dead_letter is a sink (see :py:mod:`events.sinks`) which receives the
+    events that run out of attempts. If it is None, they are only logged.
+
+    """
+
+    def __init__(self, dead_letter=None, metrics_client=None,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY,
+                 jitter=DEFAULT_JITTER, max_pending=DEFAULT_MAX_PENDING,
+                 seed=None):
+        self.dead_letter = dead_letter
+        self.metrics_client = metrics_client
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.max_pending = max_pending
+        self.random = random.Random(seed)
+
+        self._lock = threading.Lock()
+        self._pending = []
+        self._dead = []
+        self._sequence = 0
+
+    @property
+    def pending_count(self):
+        """The number of events waiting to be retried."""
+        return len(self._pending)
+
+    def _count(self, name, delta=1):
+        if self.metrics_client:
+            self.metrics_client.counter(name).increment(delta)
+
+    def delay(self, attempts):
+        """Return how long to wait after an event's attempts-th failure."""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return delay * (1. - self.jitter * self.random.random())
+
+    def schedule(self, topic_name, event, attempts):
+        """Schedule an event which has failed attempts times to be resent.
+
+        This never blocks so it is safe to call from the producer's thread.
+
+        """
+        with self._lock:
+            if attempts >= self.max_attempts:
+                self._dead.append((topic_name, event))
+                return
+
+            due = time.time() + self.delay(attempts)
+            self._sequence += 1
+            heapq.heappush(
+                self._pending, (due, self._sequence, topic_name, event, attempts))
+
+    def errback(self, topic_name, event, attempts=1):
+        """Return a future errback which schedules the event for retry."""
+        def retry_later(exc):
+            _LOG.warning("failed to send message=%s due to error=%s (attempt %d)",
+                         event, exc, attempts)
+            self._count("injector.error")
+            self.schedule(topic_name, event, attempts)
+        return retry_later
+
+    def is_full(self):
+        """Return whether the consumer should stop taking new messages."""
+        return len(self._pending) >= self.max_pending
+
+    def time_until_due(self):
+        """Return how long the consumer can wait before calling resend_due."""
+        with self._lock:
+            if self._dead:
+                return 0
+            if not self._pending:
+                return _IDLE_POLL_INTERVAL
+            return min(max(self._pending[0][0] - time.time(), 0),
+                       _IDLE_POLL_INTERVAL)
+
+    def _pop_due(self, now):
+        with self._lock:
+            if self._pending and self._pending[0][0] <= now:
+                return heapq.heappop(self._pending)
+            return None
+
+    def resend_due(self, kafka_producer, success_cb=None):
+        """Send the events whose retry is due and dead-letter expired ones.
+
+        This is for the consumer loop to call; it may block on the dead-letter
+        sink but never on the producer.
+
+        """
+        with self._lock:
+            dead, self._dead = self._dead, []
+        for topic_name, event in dead:
+            _LOG.error("giving up on message=%s after %d attempts",
+                       event, self.max_attempts)
+            self._count("injector.dead_letter")
+            if self.dead_letter:
+                self.dead_letter.send(topic_name, event)
+        if dead and self.dead_letter:
+            self.dead_letter.flush()
+
+        now = time.time()
+        while True:
+            entry = self._pop_due(now)
+            if not entry:
+                break
+
+            _, _, topic_name, event, attempts = entry
+            self._count("injector.retry")
+            try:
+                future = kafka_producer.send(topic_name, event)
+            except KafkaTimeoutError:
+                # the producer's buffer is full so there's no point trying
+                # the rest now either. this isn't the event's fault so it
+                # doesn't count as an attempt.
+                self._count("injector.pre_send_error")
+                self.schedule(topic_name, event, attempts)
+                break
+
+            if success_cb:
+                future.add_callback(success_cb)
+            future.add_errback(self.errback(topic_name, event, attempts + 1))
+
+    def take_pending(self):
+        """Remove and return the (topic_name, event) of everything pending.
+
+        This includes events due to be dead-lettered, so that nothing is lost
+        if the injector is shutting down before they were handled.
+
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+            dead, self._dead = self._dead, []
+        return [(topic_name, event)
+                for _, _, topic_name, event, _ in sorted(pending)] + dead
@@ -0,0 +1,405 @@
+"""A shared-memory ring buffer for passing messages to the injector.
+
+:py:class:`RingQueue` is a drop-in alternative to
+:py:class:`~baseplate.message_queue.MessageQueue` (see
+:py:mod:`events.transport`) which keeps the queue in a memory-mapped file,
+normally under ``/dev/shm``, instead of the kernel. Putting a message is a
+copy into shared memory rather than a system call, and the queue's size is
+bounded by bytes rather than by the ``fs.mqueue`` limits.
+
+Many producers (the collector's workers) and one consumer (an injector)
+share the file. Without an atomic compare-and-swap in Python, producers
+can't safely share one ring, so the file is split into lanes, each a
+single-producer/single-consumer ring. A producer process claims a free lane
+the first time it puts a message, by taking an ``fcntl`` lock on a byte of
+the file which it holds until it exits, and the consumer serves the lanes in
+turns::
+
+    +--------+-----------------+-----+-----------------+--------+-----+--------
+    | header | lane 0 tail/head| ... | lane N tail/head| lane 0 | ... | lane N
+    +--------+-----------------+-----+-----------------+--------+-----+--------
+
+Each lane's tail is written only by its producer and its head only by the
+consumer. Both are counts of bytes ever written to and read from the lane,
+so tail - head is how much is waiting. A message is a 4 byte length followed
+by its bytes; one that doesn't fit before the end of the lane starts over at
+the beginning, after a wrap marker if there's room for one.
+
+The tail only moves after a message has been written, so a producer that
+dies mid-put leaves nothing half-written behind and its lane is reclaimed by
+the next process to come along. The head moves after each get, so a
+restarted consumer carries on where the last one stopped. A lane whose
+positions don't make sense (e.g. the file was truncated) is emptied rather
+than trusted. This relies on aligned 8 byte stores being atomic and stores
+becoming visible in order, as they do on x86-64.
+
+Waiting for messages without polling shared memory needs a wakeup that both
+the collector and the injector can reach; a producer rings a doorbell, a
+FIFO next to the ring, when a lane goes from empty to non-empty and the
+consumer selects on it. As with the message queues, this means a RingQueue
+is select(2)-able via :py:meth:`~RingQueue.fileno`.
+
+The file is shared like those of :py:mod:`events.shm`, with the same rules:
+a process must not open the same ring twice, and every process sharing a
+ring has to open it with the same lanes and lane_size.
+
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import select
+import stat
+import struct
+import threading
+import time
+
+from baseplate.message_queue import TimedOutError
+from baseplate.retry import RetryPolicy
+
+from .shm import INIT_LOCK, LayoutMismatchError, open_shared_file
+
+
+_LOG = logging.getLogger(__name__)
+
+DEFAULT_LANES = 16
+DEFAULT_LANE_SIZE = 4 * 1024 * 1024
+
+_MAGIC = "evring01"
+_HEADER = struct.Struct("!8sII")
+_HEADER_SIZE = 64
+# the tail and head are on separate cache lines so that the producer and
+# consumer don't contend for them.
+_LANE_HEADER_SIZE = 128
+_TAIL_OFFSET = 0
+_HEAD_OFFSET = 64
+_POSITION = struct.Struct("=Q")
+_LENGTH = struct.Struct("=I")
+_WRAP = 0xffffffff
+
+# byte offsets of the consumer's and producers' fcntl locks.
+_CONSUMER_LOCK = INIT_LOCK + 1
+_FIRST_LANE_LOCK = INIT_LOCK + 2
+
+# how long to wait between looks at a full lane, and the longest the consumer
+# sleeps before checking the lanes in case a doorbell was missed.
+_PUT_RETRY_INTERVAL = 0.001
+_POLL_INTERVAL = 0.05
+
+# how many messages in a row the consumer takes from a lane before its turn
+# passes to the next one.
+_LANE_QUANTUM = 64
+
+
+class NoFreeLaneError(TimedOutError):
+    """Raised when every lane already has a producer."""
+
+    def __init__(self, path):
+        super(NoFreeLaneError, self).__init__()
+        self.args = ("All lanes of %s are in use." % path,)
+
+
+class ConsumerLockedError(Exception):
+    """Raised when another process is already consuming the ring."""
+    pass
+
+
+class RingQueue(object):
+    """A multi-producer, single-consumer queue in a memory-mapped file.
+
+    Each producer process gets one of lanes lanes of lane_size bytes, which
+    limits how many processes can put messages at once. Messages may be up to
+    max_message_size bytes, which can't be more than about half a lane.
+
+    """
+
+    def __init__(self, path, max_message_size, lanes=DEFAULT_LANES,
+                 lane_size=DEFAULT_LANE_SIZE):
+        # keep positions and lengths aligned
+        lane_size -= lane_size % 8
+        if max_message_size > lane_size // 2 - _LENGTH.size:
+            raise ValueError("lane_size %d is too small for %d byte messages"
+                             % (lane_size, max_message_size))
+
+        self.path = path
+        self.doorbell_path = path + ".doorbell"
+        self.max_message_size = max_message_size
+        self.lanes = lanes
+        self.lane_size = lane_size
+        self._data_offset = _HEADER_SIZE + lanes * _LANE_HEADER_SIZE
+
+        self._lock = threading.Lock()
+        self._lane = None
+        self._lane_pid = None
+        self._doorbell_fd = None
+        self._doorbell_pid = None
+        self._consumer_fd = None
+        self._consumer_pid = None
+        self._next_lane = 0
+        self._lane_turns = 0
+
+        header = _HEADER.pack(_MAGIC, lanes, lane_size)
+        size = self._data_offset + lanes * lane_size
+
+        self._make_doorbell()
+        self._fd, self._map = open_shared_file(path, header, size)
+
+    def _make_doorbell(self):
+        try:
+            os.mkfifo(self.doorbell_path, 0o600)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+            if not stat.S_ISFIFO(os.stat(self.doorbell_path).st_mode):
+                raise LayoutMismatchError(
+                    "%s exists and isn't a FIFO" % self.doorbell_path)
+
+    def _lane_header(self, lane):
+        return _HEADER_SIZE + lane * _LANE_HEADER_SIZE
+
+    def _positions(self, lane):
+        base = self._lane_header(lane)
+        tail, = _POSITION.unpack_from(self._map, base + _TAIL_OFFSET)
+        head, = _POSITION.unpack_from(self._map, base + _HEAD_OFFSET)
+        return tail, head
+
+    @property
+    def capacity(self):
+        """The size of a lane, in bytes."""
+        return self.lane_size
+
+    @property
+    def depth(self):
+        """How many bytes are waiting in the fullest lane."""
+        depth = 0
+        for lane in xrange(self.lanes):
+            tail, head = self._positions(lane)
+            depth = max(depth, min(tail - head, self.lane_size))
+        return depth
+
+    # producer
+
+    def _claim_lane(self):
+        pid = os.getpid()
+        if self._lane_pid == pid:
+            return self._lane
+
+        # locks aren't inherited, so a forked child needs a lane of its own
+        for lane in xrange(self.lanes):
+            try:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1,
+                            _FIRST_LANE_LOCK + lane)
+            except IOError as exc:
+                if exc.errno in (errno.EACCES, errno.EAGAIN):
+                    continue
+                raise
+            self._lane = lane
+            self._lane_pid = pid
+            return lane
+
+        raise NoFreeLaneError(self.path)
+
+    def _append(self, lane, message):
+        tail, head = self._positions(lane)
+        offset = tail % self.lane_size
+        record_size = _LENGTH.size + len(message)
+        padding = self.lane_size - offset
+        if padding >= record_size:
+            padding = 0
+        if tail - head + padding + record_size > self.lane_size:
+            return False
+
+        start = self._data_offset + lane * self.lane_size
+        if padding:
+            if padding >= _LENGTH.size:
+                _LENGTH.pack_into(self._map, start + offset, _WRAP)
+            offset = 0
+        position = start + offset + _LENGTH.size
+        self._map[position:position + len(message)] = message
+        _LENGTH.pack_into(self._map, start + offset, len(message))
+
+        new_tail = tail + padding + record_size
+        base = self._lane_header(lane)
+        _POSITION.pack_into(self._map, base + _TAIL_OFFSET, new_tail)
+
+        # the head is looked at again now that the message is visible: if the
+        # consumer had caught up with the old tail, it may be asleep.
+        _, head = self._positions(lane)
+        if head == tail:
+            self._ring_doorbell()
+        return True
+
+    def _ring_doorbell(self):
+        pid = os.getpid()
+        if self._doorbell_pid != pid:
+            self._doorbell_fd = None
+            self._doorbell_pid = pid
+
+        if self._doorbell_fd is None:
+            try:
+                self._doorbell_fd = os.open(
+                    self.doorbell_path, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as exc:
+                # no consumer is listening, it'll look when it starts
+                if exc.errno in (errno.ENXIO, errno.ENOENT):
+                    return
+                raise
+
+        try:
+            os.write(self._doorbell_fd, "\0")
+        except OSError as exc:
+            if exc.errno == errno.EPIPE:
+                # the consumer went away, reopen next time
+                os.close(self._doorbell_fd)
+                self._doorbell_fd = None
+            elif exc.errno != errno.EAGAIN:
+                raise
+
+    def put(self, message, timeout=None):
+        """Add a message to the queue.
+
+        :param float timeout: If this process's lane is full, the call will
+            block up to ``timeout`` seconds or forever if ``None``.
+        :raises: :py:exc:`~baseplate.message_queue.TimedOutError` The lane
+            was full for the allowed duration of the call.
+        :raises: :py:exc:`NoFreeLaneError` Too many processes are producing.
+        :raises: :py:exc:`ValueError` The message is too big.
+
+        """
+        if len(message) > self.max_message_size:
+            raise ValueError("The message is longer than the queue's maximum "
+                             "message size.")
+
+        with self._lock:
+            lane = self._claim_lane()
+            for time_remaining in RetryPolicy.new(budget=timeout):
+                if self._append(lane, message):
+                    return
+                if time_remaining != 0:
+                    time.sleep(_PUT_RETRY_INTERVAL)
+
+        raise TimedOutError
+
+    # consumer
+
+    def _open_consumer(self):
+        if self._consumer_pid == os.getpid():
+            return self._consumer_fd
+
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1,
+                        _CONSUMER_LOCK)
+        except IOError as exc:
+            if exc.errno in (errno.EACCES, errno.EAGAIN):
+                raise ConsumerLockedError(
+                    "%s already has a consumer" % self.path)
+            raise
+
+        for lane in xrange(self.lanes):
+            tail, head = self._positions(lane)
+            if not 0 <= tail - head <= self.lane_size:
+                _LOG.warning("lane %d of %s is inconsistent (head %d, tail "
+                             "%d), discarding its contents", lane, self.path,
+                             head, tail)
+                base = self._lane_header(lane)
+                _POSITION.pack_into(self._map, base + _HEAD_OFFSET, tail)
+
+        # opened for writing too so that it never reads as closed when
+        # producers come and go.
+        self._consumer_fd = os.open(
+            self.doorbell_path, os.O_RDWR | os.O_NONBLOCK)
+        self._consumer_pid = os.getpid()
+        return self._consumer_fd
+
+    def _drain_doorbell(self):
+        try:
+            while os.read(self._consumer_fd, 4096):
+                pass
+        except OSError as exc:
+            if exc.errno != errno.EAGAIN:
+                raise
+
+    def _take(self):
+        for i in xrange(self.lanes):
+            lane = (self._next_lane + i) % self.lanes
+            tail, head = self._positions(lane)
+            if tail == head:
+                continue
+
+            start = self._data_offset + lane * self.lane_size
+            offset = head % self.lane_size
+            length = _WRAP
+            if self.lane_size - offset >= _LENGTH.size:
+                length, = _LENGTH.unpack_from(self._map, start + offset)
+            if length == _WRAP:
+                head += self.lane_size - offset
+                offset = 0
+                length, = _LENGTH.unpack_from(self._map, start)
+
+            position = start + offset + _LENGTH.size
+            message = self._map[position:position + length]
+
+            base = self._lane_header(lane)
+            _POSITION.pack_into(self._map, base + _HEAD_OFFSET,
+                                head + _LENGTH.size + length)
+            # stay on a busy lane for a while rather than looking at every
+            # other lane between each of its messages.
+            if lane != self._next_lane:
+                self._next_lane = lane
+                self._lane_turns = 0
+            self._lane_turns += 1
+            if self._lane_turns >= _LANE_QUANTUM:
+                self._next_lane = (lane + 1) % self.lanes
+                self._lane_turns = 0
+            return message
+        return None
+
+    def get(self, timeout=None):
+        """Read a message from the queue.
+
+        Only one process may consume a ring.
+
+        :param float timeout: If the queue is empty, the call will block up to
+            ``timeout`` seconds or forever if ``None``.
+        :raises: :py:exc:`~baseplate.message_queue.TimedOutError` The queue
+            was empty for the allowed duration of the call.
+        :raises: :py:exc:`ConsumerLockedError` Another process is consuming.
+
+        """
+        doorbell = self._open_consumer()
+        for time_remaining in RetryPolicy.new(budget=timeout):
+            message = self._take()
+            if message is None:
+                # the doorbell is only drained once everything's been taken
+                # so that it stays readable while messages are waiting.
+                self._drain_doorbell()
+                message = self._take()
+            if message is not None:
+                return message
+
+            if time_remaining is None:
+                time_remaining = _POLL_INTERVAL
+            if time_remaining > 0:
+                select.select([doorbell], [], [],
+                              min(time_remaining, _POLL_INTERVAL))
+
+        raise TimedOutError
+
+    def fileno(self):
+        """Return a descriptor that's readable when messages may be waiting.
+
+        This makes the calling process the ring's consumer.
+
+        """
+        return self._open_consumer()
+
+    def close(self):
+        """Close the ring, releasing this process's lane and consumer lock."""
+        for fd in (self._doorbell_fd, self._consumer_fd):
+            if fd is not None:
+                os.close(fd)
+        self._doorbell_fd = self._consumer_fd = None
+        self._consumer_pid = None
+        self._map.close()
+        os.close(self._fd)
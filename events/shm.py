@@ -0,0 +1,182 @@
+"""A hash table in shared memory for state shared by all workers on a host.
+
+Each gunicorn worker is a separate process, so anything that has to be
+tracked across all of a host's traffic (recently seen batches, rate limits)
+can't live in a Python dict. :py:class:`SharedHashTable` keeps fixed-size
+records in a memory-mapped file, normally under ``/dev/shm``, which every
+worker maps.
+
+The table is set-associative: a key's MD5 picks one bucket of a few slots
+(ways) and the key can only be stored in that bucket. A key replaces, in
+order of preference, its own slot, an empty slot, a slot whose value the
+table's reclaimable function says can go, and finally an arbitrary slot of
+the bucket. Memory use is fixed, and the table behaves like a cache: under
+pressure, old entries are forgotten rather than new ones refused.
+
+Buckets are guarded by striped locks. Each stripe is an ``fcntl`` lock on a
+byte of the file for the other processes plus a :py:class:`threading.Lock`
+for the other threads of this process, since fcntl locks are per process.
+
+Files shared this way are opened with :py:func:`open_shared_file`. Because
+closing any descriptor of a file drops all the process's fcntl locks on it,
+a process must not open the same file twice. The file starts with a header
+describing its layout, so every process sharing it has to open it with the
+same parameters (for a table, the capacity, ways and value format); to
+change them, use a new path (or remove the old file while no one uses it).
+
+"""
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+
+DEFAULT_WAYS = 8
+DEFAULT_STRIPES = 64
+
+_MAGIC = "evshmtb1"
+_HEADER = struct.Struct("!8sIIIi")
+_HEADER_SIZE = 64
+_DIGEST_SIZE = 16
+_EMPTY_DIGEST = "\0" * _DIGEST_SIZE
+_INDEX = struct.Struct("!Q")
+
+# byte offsets of the fcntl locks. they are independent of the file's data.
+# byte 0 is taken by open_shared_file for every kind of shared file.
+INIT_LOCK = 0
+_FIRST_STRIPE_LOCK = 1
+
+
+class LayoutMismatchError(Exception):
+    """Raised when a shared file exists with a different layout."""
+    pass
+
+
+def open_shared_file(path, header, size):
+    """Open and map a file shared by the processes of a host.
+
+    The file is created size bytes long, starting with header, if it doesn't
+    exist yet. Returns a tuple of its descriptor and its map. The fcntl lock
+    on byte :py:data:`INIT_LOCK` is used to serialize this, so callers must
+    keep it free.
+
+    :raises: :py:exc:`LayoutMismatchError` if the file exists with another
+        header or size.
+
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.lockf(fd, fcntl.LOCK_EX, 1, INIT_LOCK)
+        try:
+            if os.fstat(fd).st_size == 0:
+                os.ftruncate(fd, size)
+            shared = mmap.mmap(fd, os.fstat(fd).st_size)
+
+            existing = shared[:len(header)]
+            if existing == "\0" * len(header):
+                # new, or its creator died before getting this far
+                shared[:len(header)] = header
+            elif existing != header or len(shared) != size:
+                shared.close()
+                raise LayoutMismatchError(
+                    "%s has a different layout, remove it or use another "
+                    "path" % path)
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN, 1, INIT_LOCK)
+    except:
+        os.close(fd)
+        raise
+    return fd, shared
+
+
+class SharedHashTable(object):
+    """A fixed-size table of struct-packed values keyed by strings.
+
+    value_format is a :py:mod:`struct` format describing each value, which
+    the table deals with as tuples. If given, reclaimable is a function
+    called with a stored value which returns whether its slot can be reused
+    for another key (e.g. because it expired).
+
+    """
+
+    def __init__(self, path, capacity, value_format, ways=DEFAULT_WAYS,
+                 reclaimable=None, stripes=DEFAULT_STRIPES):
+        self.path = path
+        self.value_struct = struct.Struct(value_format)
+        self.ways = ways
+        self.bucket_count = max(1, (capacity + ways - 1) // ways)
+        self.slot_size = _DIGEST_SIZE + self.value_struct.size
+        self.reclaimable = reclaimable
+        self.stripes = min(stripes, self.bucket_count)
+        self._thread_locks = [threading.Lock() for _ in xrange(self.stripes)]
+
+        header = _HEADER.pack(_MAGIC, self.bucket_count, ways,
+                              self.value_struct.size, zlib.crc32(value_format))
+        size = _HEADER_SIZE + self.bucket_count * ways * self.slot_size
+
+        self._fd, self._map = open_shared_file(path, header, size)
+
+    @property
+    def capacity(self):
+        return self.bucket_count * self.ways
+
+    def update(self, key, function):
+        """Atomically read and replace the value stored for key.
+
+        function is called, with the bucket locked, with the current value
+        or None if there isn't one. It must return a tuple of the new value
+        (or None to leave the table as it is) and a result which is then
+        returned by update.
+
+        """
+        digest = hashlib.md5(key).digest()
+        index, = _INDEX.unpack_from(digest)
+        bucket = index % self.bucket_count
+        stripe = bucket % self.stripes
+        lock_offset = _FIRST_STRIPE_LOCK + stripe
+        with self._thread_locks[stripe]:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, lock_offset)
+            try:
+                return self._update_bucket(bucket, index, digest, function)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, lock_offset)
+
+    def _update_bucket(self, bucket, index, digest, function):
+        table = self._map
+        value_struct = self.value_struct
+        base = _HEADER_SIZE + bucket * self.ways * self.slot_size
+
+        current = None
+        target = None
+        for way in xrange(self.ways):
+            offset = base + way * self.slot_size
+            slot_digest = table[offset:offset + _DIGEST_SIZE]
+            if slot_digest == digest:
+                current = value_struct.unpack_from(table, offset + _DIGEST_SIZE)
+                target = offset
+                break
+            elif target is None and (
+                    slot_digest == _EMPTY_DIGEST or
+                    (self.reclaimable and self.reclaimable(
+                        value_struct.unpack_from(
+                            table, offset + _DIGEST_SIZE)))):
+                # keep looking in case the key is further along
+                target = offset
+
+        if target is None:
+            # the bucket is full of live entries, evict one of them
+            target = base + (index >> 32) % self.ways * self.slot_size
+
+        value, result = function(current)
+        if value is not None:
+            table[target:target + _DIGEST_SIZE] = digest
+            value_struct.pack_into(table, target + _DIGEST_SIZE, *value)
+        return result
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
@@ -0,0 +1,157 @@
+"""Graceful shutdown of the injector.
+
+On SIGTERM or SIGINT the injector stops taking messages off its queues,
+gives the producer a deadline to deliver what it has buffered and then puts
+anything still unacknowledged back where it came from: onto its queue if
+there's room or otherwise into a local spill file which is replayed the
+next time the injector starts.
+
+"""
+
+import errno
+import itertools
+import logging
+import os
+import signal
+import threading
+
+from baseplate.message_queue import TimedOutError
+
+from .sinks import FileSink, read_file_sink
+
+
+_LOG = logging.getLogger(__name__)
+
+DEFAULT_SHUTDOWN_TIMEOUT = 10.
+
+
+class ShutdownFlag(object):
+    """Records that the process has been asked to shut down."""
+
+    def __init__(self):
+        self.requested = False
+
+    def request(self, signum=None, frame=None):
+        if not self.requested:
+            _LOG.info("shutting down (signal %s)", signum)
+        self.requested = True
+
+    def install(self, signals=(signal.SIGTERM, signal.SIGINT)):
+        """Request shutdown when any of these signals is received."""
+        for signum in signals:
+            signal.signal(signum, self.request)
+
+
+class InFlightTracker(object):
+    """A sink wrapper that remembers the events not yet resolved.
+
+    Events are forgotten as soon as their future resolves either way; failed
+    ones are the errback's responsibility from then on.
+
+    """
+
+    def __init__(self, sink):
+        self.sink = sink
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._ids = itertools.count()
+
+    @property
+    def in_flight_count(self):
+        """The number of events sent but not yet resolved."""
+        return len(self._in_flight)
+
+    def send(self, topic, value):
+        future = self.sink.send(topic, value)
+        send_id = next(self._ids)
+        with self._lock:
+            self._in_flight[send_id] = (topic, value)
+        # added before anyone else's callbacks so that the event is out of
+        # here before an errback could take responsibility for it
+        future.add_both(self._resolved, send_id)
+        return future
+
+    def _resolved(self, send_id, _):
+        with self._lock:
+            self._in_flight.pop(send_id, None)
+
+    def flush(self, timeout=None):
+        self.sink.flush(timeout=timeout)
+
+    def close(self, timeout=None):
+        self.sink.close(timeout=timeout)
+
+    def take_unacknowledged(self):
+        """Remove and return the (topic, event) of each unresolved send."""
+        with self._lock:
+            in_flight, self._in_flight = self._in_flight, {}
+        return [in_flight[send_id] for send_id in sorted(in_flight)]
+
+
+def requeue_or_spill(events, queues_by_topic, spill_path=None,
+                     metrics_client=None):
+    """Put unsent (topic, event)s back on their queues or in the spill file.
+
+    Returns the number of events that couldn't be saved either way.
+
+    """
+    spill = None
+    lost = 0
+    for topic, event in events:
+        try:
+            queues_by_topic[topic].put(event, timeout=0)
+            continue
+        except (KeyError, TimedOutError):
+            pass
+
+        if spill_path:
+            if not spill:
+                spill = FileSink(spill_path)
+            spill.send(topic, event)
+        else:
+            _LOG.error("lost message=%s on shutdown", event)
+            lost += 1
+
+    if spill:
+        spill.close()
+    if metrics_client and lost:
+        metrics_client.counter("injector.shutdown_lost").increment(lost)
+    return lost
+
+
+def instance_spill_path(spill_path, queue_names, instance=None):
+    """Return the spill file of one injector instance.
+
+    Every instance stops at the same time, so each needs its own file rather
+    than appending to a shared one.
+
+    """
+    if not spill_path:
+        return None
+    parts = [spill_path, "+".join(queue_names)]
+    if instance:
+        parts.append(instance)
+    return ".".join(parts)
+
+
+def take_spilled(spill_path):
+    """Remove and return the (topic, event)s spilled by a previous shutdown.
+
+    The file is claimed by renaming it first, so that if it is somehow shared,
+    only one process replays it.
+
+    """
+    if not spill_path:
+        return []
+
+    claimed_path = "%s.replaying.%d" % (spill_path, os.getpid())
+    try:
+        os.rename(spill_path, claimed_path)
+    except OSError as exc:
+        if exc.errno == errno.ENOENT:
+            return []
+        raise
+
+    events = list(read_file_sink(claimed_path))
+    os.unlink(claimed_path)
+    return events
@@ -0,0 +1,212 @@
+"""Destinations for the injector to send events to.
+
+A sink has the subset of the :py:class:`kafka.KafkaProducer` interface that
+the injector uses:
+
+* ``send(topic, value)`` returns a :py:class:`kafka.future.Future` which
+  resolves when the event is delivered (or fails).
+  :py:exc:`~kafka.common.KafkaTimeoutError` may be raised if the event can't
+  be accepted right now.
+* ``flush()`` blocks until everything sent so far is resolved.
+* ``close(timeout=None)`` waits up to timeout seconds for outstanding
+  events to be resolved, fails the rest, and releases the sink's resources.
+
+so a real producer can be used directly, and the others can stand in for it
+when Kafka isn't wanted or available.
+
+"""
+
+import heapq
+import random
+import threading
+import time
+
+from kafka import KafkaProducer
+from kafka.common import KafkaError, KafkaTimeoutError
+from kafka.future import Future
+
+
+class NullSink(object):
+    """A sink which immediately acknowledges and discards everything."""
+
+    def send(self, topic, value):
+        return Future().success(None)
+
+    def flush(self, timeout=None):
+        pass
+
+    def close(self, timeout=None):
+        pass
+
+
+class FileSink(object):
+    """A sink which appends events to a local file.
+
+    Each event is written as a line of ``topic length`` followed by the
+    event itself and a newline.
+
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "ab")
+
+    def send(self, topic, value):
+        self.file.write("%s %d\n%s\n" % (topic, len(value), value))
+        return Future().success(None)
+
+    def flush(self, timeout=None):
+        self.file.flush()
+
+    def close(self, timeout=None):
+        self.file.close()
+
+
+def read_file_sink(path):
+    """Yield the (topic, value) of each event written by a FileSink."""
+    with open(path, "rb") as f:
+        while True:
+            header = f.readline()
+            if not header:
+                break
+            topic, length = header.rsplit(" ", 1)
+            value = f.read(int(length))
+            f.read(1)  # the newline after the value
+            yield topic, value
+
+
+class FakeBrokerError(KafkaError):
+    """The failure injected by :py:class:`FakeBrokerSink`."""
+    retriable = True
+
+
+class FakeBrokerSink(object):
+    """An in-process stand-in for a Kafka cluster.
+
+    Events are acknowledged from a background thread after ack_latency
+    seconds (plus up to ack_jitter more). A failure_rate fraction of events
+    fail instead and a timeout_rate fraction of sends raise
+    :py:exc:`~kafka.common.KafkaTimeoutError` as a producer with a full
+    buffer would.
+
+    The time each event took to be acknowledged is kept in ``ack_latencies``
+    for benchmarking.
+
+    """
+
+    def __init__(self, ack_latency=0.005, ack_jitter=0., failure_rate=0.,
+                 timeout_rate=0., seed=None):
+        self.ack_latency = ack_latency
+        self.ack_jitter = ack_jitter
+        self.failure_rate = failure_rate
+        self.timeout_rate = timeout_rate
+        self.random = random.Random(seed)
+        self.ack_latencies = []
+
+        self._pending = []
+        self._sequence = 0
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._acknowledge, name="fake-broker")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def send(self, topic, value):
+        if self.random.random() < self.timeout_rate:
+            raise KafkaTimeoutError("fake broker timeout")
+
+        future = Future()
+        now = time.time()
+        due = now + self.ack_latency + self.random.random() * self.ack_jitter
+        failed = self.random.random() < self.failure_rate
+        with self._condition:
+            self._sequence += 1
+            heapq.heappush(
+                self._pending, (due, self._sequence, now, future, failed))
+            self._condition.notify_all()
+        return future
+
+    def _acknowledge(self):
+        with self._condition:
+            while not self._closed:
+                if not self._pending:
+                    self._condition.wait()
+                    continue
+
+                due, _, sent_at, future, failed = self._pending[0]
+                now = time.time()
+                if now < due:
+                    self._condition.wait(due - now)
+                    continue
+
+                heapq.heappop(self._pending)
+                self.ack_latencies.append(now - sent_at)
+                if failed:
+                    future.failure(FakeBrokerError("fake broker failure"))
+                else:
+                    future.success(None)
+                self._condition.notify_all()
+
+    def flush(self, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._condition:
+            while self._pending:
+                if deadline is None:
+                    self._condition.wait()
+                    continue
+
+                time_remaining = deadline - time.time()
+                # like KafkaProducer.flush in kafka-python 1.0.2
+                assert time_remaining > 0, "Timeout waiting for future"
+                self._condition.wait(time_remaining)
+
+    def close(self, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._condition:
+            while self._pending:
+                if deadline is None:
+                    self._condition.wait()
+                    continue
+
+                time_remaining = deadline - time.time()
+                if time_remaining <= 0:
+                    break
+                self._condition.wait(time_remaining)
+
+            self._closed = True
+            abandoned, self._pending = self._pending, []
+            self._condition.notify_all()
+        self._thread.join()
+
+        for _, _, _, future, _ in abandoned:
+            future.failure(FakeBrokerError("fake broker closed"))
+
+
+def make_sink(config, producer_options):
+    """Return the sink selected by the ``sink`` setting.
+
+    One of ``kafka`` (the default), ``file``, ``null`` or ``fake``.
+
+    :raises: :py:exc:`~kafka.common.KafkaError` if the Kafka producer
+        couldn't be created.
+
+    """
+    sink_type = config.get("sink", "kafka")
+    if sink_type == "kafka":
+        kafka_brokers = [broker.strip()
+                         for broker in config["kafka_brokers"].split(",")]
+        return KafkaProducer(bootstrap_servers=kafka_brokers,
+                             **producer_options)
+    elif sink_type == "file":
+        return FileSink(config["sink.path"])
+    elif sink_type == "null":
+        return NullSink()
+    elif sink_type == "fake":
+        return FakeBrokerSink(
+            ack_latency=float(config.get("sink.fake.ack_latency_ms", 5)) / 1000.,
+            ack_jitter=float(config.get("sink.fake.ack_jitter_ms", 0)) / 1000.,
+            failure_rate=float(config.get("sink.fake.failure_rate", 0)),
+            timeout_rate=float(config.get("sink.fake.timeout_rate", 0)),
+        )
+    else:
+        raise ValueError("unknown sink type: %r" % sink_type)
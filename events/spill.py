@@ -0,0 +1,325 @@
+"""Disk-backed overflow for a full message queue.
+
+When the injectors fall behind and the event queue fills up, blocking on it
+would stall every worker. Instead, messages which don't fit on the queue are
+appended to a local spill log and replayed onto the queue, in order, by a
+background drainer once there is room again.
+
+A spill log is a directory holding:
+
+* ``lock``: flocked by the process which owns the log.
+* ``cursor``: the segment number and offset of the next record to replay.
+* ``NNNNNNNNNNNN.spill``: fixed-size, memory-mapped segment files. Records
+  are a 4 byte big-endian length followed by the message. A zero length marks
+  the end of the records in a segment.
+
+Segments are filled with zeros when they are created rather than left
+sparse, so that a full disk fails the append that needed a new segment with
+ENOSPC instead of killing the process with SIGBUS when the mapping is later
+written to. A log can also be limited to a number of bytes of segments.
+
+The message of a record is written before its length, so a crash part way
+through an append leaves the log ending cleanly at the previous record.
+Replay is at-least-once: a crash between a message reaching the queue and
+the cursor moving past it will replay that message again.
+
+"""
+
+import errno
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from baseplate.message_queue import TimedOutError
+
+
+_LOG = logging.getLogger(__name__)
+
+_RECORD_HEADER = struct.Struct("!I")
+_CURSOR = struct.Struct("!QQ")
+_SEGMENT_SUFFIX = ".spill"
+
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+DEFAULT_MAXIMUM_SLOTS = 64
+DEFAULT_DRAIN_INTERVAL = 0.1
+
+_PREALLOCATE_CHUNK = 1024 * 1024
+
+# how many messages to replay per acquisition of the queue lock
+_DRAIN_CHUNK = 1000
+
+
+class SpillLogLockedError(Exception):
+    """Raised when a spill log is already owned by another process."""
+    pass
+
+
+class SpillLogFullError(Exception):
+    """Raised when a spill log would need more than its max_bytes."""
+    pass
+
+
+def _preallocate(fd, size):
+    offset = os.lseek(fd, 0, os.SEEK_END)
+    zeros = "\0" * _PREALLOCATE_CHUNK
+    while offset < size:
+        offset += os.write(fd, zeros[:size - offset])
+
+
+def _map_file(path, size):
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        _preallocate(fd, size)
+        return mmap.mmap(fd, os.fstat(fd).st_size)
+    finally:
+        os.close(fd)
+
+
+def _read_length(segment, offset):
+    if offset + _RECORD_HEADER.size > len(segment):
+        return 0
+    length, = _RECORD_HEADER.unpack_from(segment, offset)
+    return length
+
+
+class SpillLog(object):
+    """An append-only, segmented log of messages with a replay cursor.
+
+    If max_bytes is given, appends which would need more than that many
+    bytes of segments (though always at least one) raise
+    :py:exc:`SpillLogFullError`.
+
+    """
+
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE,
+                 max_bytes=None):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+
+        try:
+            os.makedirs(directory)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+        self._lock_file = open(os.path.join(directory, "lock"), "a")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            self._lock_file.close()
+            raise SpillLogLockedError(directory)
+
+        self._cursor = _map_file(
+            os.path.join(directory, "cursor"), _CURSOR.size)
+        self._recover()
+
+    @classmethod
+    def open_free_slot(cls, base_directory, max_slots=DEFAULT_MAXIMUM_SLOTS,
+                       **kwargs):
+        """Open the first numbered spill log under base_directory not in use.
+
+        This lets each worker process have its own log while logs left behind
+        by dead workers are picked up and replayed by their replacements.
+
+        """
+        for slot in xrange(max_slots):
+            try:
+                return cls(os.path.join(base_directory, str(slot)), **kwargs)
+            except SpillLogLockedError:
+                continue
+        raise SpillLogLockedError(base_directory)
+
+    def _segment_path(self, sequence):
+        return os.path.join(
+            self.directory, "%012d%s" % (sequence, _SEGMENT_SUFFIX))
+
+    def _open_segment(self, sequence):
+        return _map_file(self._segment_path(sequence), self.segment_size)
+
+    def _save_cursor(self):
+        _CURSOR.pack_into(
+            self._cursor, 0, self._read_sequence, self._read_offset)
+
+    def _recover(self):
+        self._read_sequence, self._read_offset = _CURSOR.unpack_from(
+            self._cursor)
+
+        sequences = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith(_SEGMENT_SUFFIX):
+                sequence = int(filename[:-len(_SEGMENT_SUFFIX)])
+                if sequence < self._read_sequence:
+                    os.unlink(os.path.join(self.directory, filename))
+                else:
+                    sequences.append(sequence)
+
+        self.depth = 0
+        self.bytes = 0
+        self._write_sequence = max(sequences + [self._read_sequence])
+        for sequence in sorted(sequences):
+            segment = self._open_segment(sequence)
+            offset = self._read_offset if sequence == self._read_sequence else 0
+            while True:
+                length = _read_length(segment, offset)
+                if not length:
+                    break
+                self.depth += 1
+                self.bytes += length
+                offset += _RECORD_HEADER.size + length
+
+            if sequence == self._write_sequence:
+                self._write_segment = segment
+                self._write_offset = offset
+            else:
+                segment.close()
+
+        if not sequences:
+            self._write_segment = self._open_segment(self._write_sequence)
+            self._write_offset = 0
+
+        self._read_segment = self._open_segment(self._read_sequence)
+
+    def append(self, message):
+        """Add a message to the end of the log."""
+        record_size = _RECORD_HEADER.size + len(message)
+        if record_size > self.segment_size:
+            raise ValueError("message too large for spill segment")
+
+        if self._write_offset + record_size > len(self._write_segment):
+            segments = self._write_sequence + 2 - self._read_sequence
+            if (self.max_bytes is not None and
+                    segments * self.segment_size > self.max_bytes):
+                raise SpillLogFullError(self.directory)
+
+            segment = self._open_segment(self._write_sequence + 1)
+            self._write_segment.close()
+            self._write_sequence += 1
+            self._write_segment = segment
+            self._write_offset = 0
+
+        segment = self._write_segment
+        start = self._write_offset + _RECORD_HEADER.size
+        segment[start:start + len(message)] = message
+        _RECORD_HEADER.pack_into(segment, self._write_offset, len(message))
+
+        self._write_offset += record_size
+        self.depth += 1
+        self.bytes += len(message)
+
+    def peek(self):
+        """Return the oldest message not yet replayed, or None if empty."""
+        while self.depth:
+            length = _read_length(self._read_segment, self._read_offset)
+            if length:
+                start = self._read_offset + _RECORD_HEADER.size
+                return self._read_segment[start:start + length]
+
+            # this segment is used up, move on to the next one
+            self._read_segment.close()
+            os.unlink(self._segment_path(self._read_sequence))
+            self._read_sequence += 1
+            self._read_offset = 0
+            self._save_cursor()
+            self._read_segment = self._open_segment(self._read_sequence)
+        return None
+
+    def pop(self):
+        """Mark the message returned by :py:meth:`peek` as replayed."""
+        length = _read_length(self._read_segment, self._read_offset)
+        assert length, "nothing to pop"
+        self._read_offset += _RECORD_HEADER.size + length
+        self._save_cursor()
+        self.depth -= 1
+        self.bytes -= length
+
+    def close(self):
+        """Unmap the log and release its lock."""
+        self._read_segment.close()
+        self._write_segment.close()
+        self._cursor.close()
+        self._lock_file.close()
+
+
+class SpillingQueue(object):
+    """A message queue wrapper which spills to disk rather than blocking.
+
+    Puts never wait on the queue. If the queue is full, or there are already
+    spilled messages waiting (to keep things in order), the message goes to
+    the spill log instead. :py:meth:`drain` moves spilled messages back onto
+    the queue as room becomes available.
+
+    """
+
+    def __init__(self, queue, spill_log):
+        self.queue = queue
+        self.spill_log = spill_log
+        self.lock = threading.Lock()
+
+    def put(self, message, timeout=None):
+        with self.lock:
+            if not self.spill_log.depth:
+                try:
+                    self.queue.put(message, timeout=0)
+                    return
+                except TimedOutError:
+                    pass
+
+            try:
+                self.spill_log.append(message)
+                return
+            except SpillLogFullError:
+                pass
+            except (EnvironmentError, ValueError) as exc:
+                _LOG.warning("failed to spill message: %r", exc)
+
+        # the spill log isn't usable, fall back to waiting on the queue
+        self.queue.put(message, timeout=timeout)
+
+    def drain(self):
+        """Replay spilled messages onto the queue until it is full.
+
+        Returns the number of messages replayed.
+
+        """
+        replayed = 0
+        while True:
+            with self.lock:
+                for _ in xrange(_DRAIN_CHUNK):
+                    message = self.spill_log.peek()
+                    if message is None:
+                        return replayed
+
+                    try:
+                        self.queue.put(message, timeout=0)
+                    except TimedOutError:
+                        return replayed
+
+                    self.spill_log.pop()
+                    replayed += 1
+
+
+def start_drainer(spilling_queue, metrics_client,
+                  interval=DEFAULT_DRAIN_INTERVAL):
+    """Start a daemon thread which periodically drains the spill log."""
+    def drain_forever():
+        while True:
+            try:
+                spilling_queue.drain()
+            except Exception:
+                _LOG.exception("failed to drain spill log")
+
+            metrics_client.gauge("spill.depth").replace(
+                spilling_queue.spill_log.depth)
+            metrics_client.gauge("spill.bytes").replace(
+                spilling_queue.spill_log.bytes)
+            time.sleep(interval)
+
+    thread = threading.Thread(target=drain_forever, name="spill-drainer")
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -0,0 +1,87 @@
+"""Small helpers for summarizing measurements."""
+
+import collections
+import os
+import time
+
+
+DEFAULT_WINDOW = 1024
+
+
+def percentile(sorted_values, fraction):
+    """Return the value at the given fraction (0-1) of a sorted list.
+
+    This uses the nearest-rank method. An empty list gives None.
+
+    """
+    if not sorted_values:
+        return None
+    rank = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[rank]
+
+
+def summarize_latencies(latencies, fractions=(0.5, 0.9, 0.99)):
+    """Return a dict of percentile name to value, in milliseconds."""
+    ordered = sorted(latencies)
+    summary = {}
+    for fraction in fractions:
+        value = percentile(ordered, fraction)
+        name = "p%g" % (fraction * 100)
+        summary[name] = None if value is None else value * 1000.
+    return summary
+
+
+class RequestStats(object):
+    """Cheap in-process counters of the requests a worker has handled.
+
+    Every request is counted by key and response status, and the times and
+    latencies of the most recent window of requests are kept for rates and
+    percentiles.
+
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        self.started = time.time()
+        self.requests = 0
+        self.statuses_by_key = collections.defaultdict(collections.Counter)
+        self.recent = collections.deque(maxlen=window)
+
+    def record(self, keyname, status, latency):
+        self.requests += 1
+        self.statuses_by_key[keyname][status] += 1
+        self.recent.append((time.time(), latency))
+
+    def snapshot(self):
+        """Return a JSON-serializable summary of the counters."""
+        now = time.time()
+        uptime = now - self.started
+
+        recent_rate = None
+        if len(self.recent) > 1:
+            span = now - self.recent[0][0]
+            if span > 0:
+                recent_rate = len(self.recent) / span
+
+        keys = {}
+        for keyname, statuses in self.statuses_by_key.iteritems():
+            accepted = sum(count for status, count in statuses.iteritems()
+                           if status < 400)
+            keys[keyname] = {
+                "accepted": accepted,
+                "rejected": sum(statuses.values()) - accepted,
+                "statuses": {str(status): count
+                             for status, count in statuses.iteritems()},
+            }
+
+        return {
+            "pid": os.getpid(),
+            "uptime": uptime,
+            "requests": self.requests,
+            "requests_per_second": {
+                "lifetime": self.requests / uptime if uptime > 0 else None,
+                "recent": recent_rate,
+            },
+            "latency_ms": summarize_latencies(
+                [latency for _, latency in self.recent]),
+            "keys": keys,
+        }
@@ -0,0 +1,75 @@
+"""The queues between the collector and the injector.
+
+A transport is anything with the interface of
+:py:class:`~baseplate.message_queue.MessageQueue` plus a little more:
+
+* ``put(message, timeout=None)`` and ``get(timeout=None)``, raising
+  :py:exc:`~baseplate.message_queue.TimedOutError` (or another
+  :py:exc:`~baseplate.message_queue.MessageQueueError`) when they can't.
+* ``fileno()``, a descriptor that select(2) says is readable when there may
+  be messages to get.
+* ``depth`` and ``capacity``, how full the queue is in units of the
+  transport's choosing. Only their ratio means anything across transports.
+
+The ``transport`` setting picks one for both the collector and the
+injector, which have to agree:
+
+* ``mq`` (the default): POSIX message queues.
+* ``ring``: :py:class:`~events.ring.RingQueue`, a ring buffer in shared
+  memory with one file per queue in ``transport.ring.directory``.
+
+"""
+
+import os
+
+from baseplate.message_queue import MessageQueue
+
+from .const import MAXIMUM_QUEUE_LENGTH, MAXIMUM_MESSAGE_SIZE
+from .ring import DEFAULT_LANES as DEFAULT_RING_LANES
+from .ring import DEFAULT_LANE_SIZE as DEFAULT_RING_LANE_SIZE
+from .ring import RingQueue
+
+
+DEFAULT_RING_DIRECTORY = "/dev/shm"
+
+
+class MessageQueueTransport(MessageQueue):
+    """A POSIX message queue, measured in messages."""
+
+    @property
+    def depth(self):
+        return self.queue.current_messages
+
+    @property
+    def capacity(self):
+        return self.queue.max_messages
+
+    def fileno(self):
+        return self.queue.mqd
+
+
+def make_queue(config, name):
+    """Return the queue called name with the configured transport.
+
+    :raises: :py:exc:`ValueError` if the transport is unknown.
+
+    """
+    transport = config.get("transport", "mq")
+    if transport == "mq":
+        return MessageQueueTransport(
+            "/" + name,
+            max_messages=MAXIMUM_QUEUE_LENGTH[name],
+            max_message_size=MAXIMUM_MESSAGE_SIZE[name],
+        )
+    elif transport == "ring":
+        directory = config.get(
+            "transport.ring.directory", DEFAULT_RING_DIRECTORY)
+        return RingQueue(
+            os.path.join(directory, "event-collector-" + name),
+            max_message_size=MAXIMUM_MESSAGE_SIZE[name],
+            lanes=int(config.get("transport.ring.lanes", DEFAULT_RING_LANES)),
+            lane_size=int(config.get(
+                "transport.ring.lane_size", DEFAULT_RING_LANE_SIZE)),
+        )
+    else:
+        raise ValueError("unknown transport: %r" % transport)
@@ -0,0 +1,141 @@
+"""Self-tuning of the Kafka producer's batching parameters.
+
+The right batch size and linger time depend on how fast events are coming in,
+how big they are and how long the brokers take to acknowledge them, all of
+which change over the course of a day. The tuner watches those and
+periodically recommends new settings.
+
+kafka-python only reads these settings when a producer is created, so the
+injector applies a recommendation by recreating its producer. To keep that
+rare, a new recommendation only takes effect when it differs from the current
+settings by at least a factor of two.
+
+"""
+
+import threading
+import time
+
+
+DEFAULT_INTERVAL = 60.
+DEFAULT_MINIMUM_BATCH_SIZE = 16 * 1024
+DEFAULT_MAXIMUM_BATCH_SIZE = 1024 * 1024
+DEFAULT_MINIMUM_LINGER_MS = 5
+DEFAULT_MAXIMUM_LINGER_MS = 500
+
+_RETUNE_FACTOR = 2.
+
+
+def _clamp(value, minimum, maximum):
+    return max(minimum, min(maximum, value))
+
+
+def _next_power_of_two(value):
+    power = 1
+    while power < value:
+        power <<= 1
+    return power
+
+
+def _differs(current, recommended):
+    ratio = float(max(current, recommended)) / max(min(current, recommended), 1)
+    return ratio >= _RETUNE_FACTOR
+
+
+class ProducerTuner(object):
+    """Recommends producer batch_size and linger_ms from observed traffic.
+
+    The linger time is set to half the observed acknowledgement latency:
+    waiting that long to fill a batch is cheap next to the round trip the
+    batch will cost anyway. The batch size is then made big enough to hold
+    the records that arrive during that linger time.
+
+    Acknowledgements are recorded from the producer's I/O thread, so the
+    window's counters are guarded by a lock.
+
+    """
+
+    def __init__(self, batch_size, linger_ms, metrics_client=None,
+                 interval=DEFAULT_INTERVAL,
+                 min_batch_size=DEFAULT_MINIMUM_BATCH_SIZE,
+                 max_batch_size=DEFAULT_MAXIMUM_BATCH_SIZE,
+                 min_linger_ms=DEFAULT_MINIMUM_LINGER_MS,
+                 max_linger_ms=DEFAULT_MAXIMUM_LINGER_MS):
+        self.batch_size = batch_size
+        self.linger_ms = linger_ms
+        self.metrics_client = metrics_client
+        self.interval = interval
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.min_linger_ms = min_linger_ms
+        self.max_linger_ms = max_linger_ms
+        self._lock = threading.Lock()
+        self._reset_window(time.time())
+
+    def _reset_window(self, now):
+        self._window_start = now
+        self._records = 0
+        self._bytes = 0
+        self._acks = 0
+        self._ack_latency = 0.
+
+    @property
+    def options(self):
+        """The producer options currently recommended."""
+        return {"batch_size": self.batch_size, "linger_ms": self.linger_ms}
+
+    def record_send(self, size):
+        """Note that a record of size bytes was handed to the producer."""
+        with self._lock:
+            self._records += 1
+            self._bytes += size
+
+    def record_ack(self, latency, count=1):
+        """Note that count records were acknowledged after latency secs."""
+        with self._lock:
+            self._acks += count
+            self._ack_latency += latency * count
+
+    def recommend(self, elapsed):
+        """Return the (batch_size, linger_ms) suited to the current window."""
+        if not self._records or not self._acks:
+            return self.batch_size, self.linger_ms
+
+        rate = self._records / elapsed
+        record_size = float(self._bytes) / self._records
+        ack_ms = self._ack_latency / self._acks * 1000.
+
+        linger_ms = int(_clamp(
+            ack_ms / 2., self.min_linger_ms, self.max_linger_ms))
+        batch_size = int(_clamp(
+            _next_power_of_two(rate * linger_ms / 1000. * record_size),
+            self.min_batch_size, self.max_batch_size))
+        return batch_size, linger_ms
+
+    def should_retune(self):
+        """Return whether the producer should be recreated with new options.
+
+        Once per interval, this works out a new recommendation, reports it as
+        gauges and adopts it if it is different enough from the current one.
+
+        """
+        now = time.time()
+        elapsed = now - self._window_start
+        if elapsed < self.interval:
+            return False
+
+        with self._lock:
+            batch_size, linger_ms = self.recommend(elapsed)
+            self._reset_window(now)
+
+        if self.metrics_client:
+            self.metrics_client.gauge(
+                "injector.producer.batch_size").replace(batch_size)
+            self.metrics_client.gauge(
+                "injector.producer.linger_ms").replace(linger_ms)
+
+        if (_differs(self.batch_size, batch_size) or
+                _differs(self.linger_ms, linger_ms)):
+            self.batch_size = batch_size
+            self.linger_ms = linger_ms
+            return True
+        return False
@@ -15,5 +15,8 @@ setup(
         "paste.app_factory": [
             "main = events.collector:make_app",
         ],
+        "console_scripts": [
+            "event-loadgen = events.loadgen:main",
+        ],
     },
 )
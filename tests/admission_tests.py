@@ -0,0 +1,69 @@
+import unittest
+
+import mock
+
+from events import admission
+
+
+class FakeSampler(object):
+    def __init__(self, fill):
+        self._fill = fill
+
+    def fill(self):
+        return self._fill
+
+
+class QueueDepthSamplerTests(unittest.TestCase):
+    def setUp(self):
+        self.message_queue = mock.Mock()
+        self.message_queue.depth = 5
+        self.message_queue.capacity = 10
+
+    @mock.patch("events.admission.time.time")
+    def test_sample_is_cached(self, time):
+        time.return_value = 100.
+        sampler = admission.QueueDepthSampler(
+            self.message_queue, sample_interval=0.01)
+        self.assertEqual(sampler.fill(), 0.5)
+
+        self.message_queue.depth = 10
+        time.return_value = 100.005
+        self.assertEqual(sampler.fill(), 0.5)
+
+        time.return_value = 100.02
+        self.assertEqual(sampler.fill(), 1.)
+
+
+class AdmissionControllerTests(unittest.TestCase):
+    def make_controller(self, *fills):
+        return admission.AdmissionController(
+            [FakeSampler(fill) for fill in fills],
+            watermark=0.8,
+            priority_watermark=0.95,
+            priority_keys=["Important"],
+        )
+
+    def test_admit_below_watermark(self):
+        controller = self.make_controller(0.5, 0.1)
+        self.assertFalse(controller.should_shed("Regular"))
+
+    def test_shed_if_any_queue_is_full(self):
+        controller = self.make_controller(0.1, 0.85)
+        self.assertTrue(controller.should_shed("Regular"))
+
+    def test_priority_keys_shed_last(self):
+        controller = self.make_controller(0.9)
+        self.assertTrue(controller.should_shed("Regular"))
+        self.assertFalse(controller.should_shed("Important"))
+
+        controller = self.make_controller(0.97)
+        self.assertTrue(controller.should_shed("Important"))
+
+    def test_errors_queue_has_own_watermark(self):
+        controller = admission.AdmissionController(
+            [FakeSampler(0.1)], watermark=0.8,
+            error_samplers=[FakeSampler(1.)])
+        self.assertFalse(controller.should_shed("Regular"))
+
+        controller.errors_watermark = 0.99
+        self.assertTrue(controller.should_shed("Regular"))
@@ -1,12 +1,27 @@
 from cStringIO import StringIO
 import datetime
 import gzip
+import json
+import os
+import shutil
+import tempfile
 import unittest
+import zlib
 
 import baseplate
 from pyramid import testing
 
 from events import collector
+from events.admission import AdmissionController
+from events.compact import render_compact_event
+from events.dedup import DuplicateFilter
+from events.errors import ErrorAggregator
+from events.framing import unpack_message
+from events.instrumentation import StageProfiler
+from events.keystore import Keystore
+from events.origins import OriginMatcher
+from events.ratelimit import RateLimiter
+from events.stats import RequestStats
 
 
 class SignatureTests(unittest.TestCase):
@@ -59,22 +74,21 @@ class CollectorUnitTests(unittest.TestCase):
                 return datetime.datetime(2015, 11, 17, 12, 34, 56)
         datetime.datetime = MockDatetime
 
-        keystore = {
+        keystore = Keystore({
             "TestKey1": "test",
-        }
+        })
         self.event_sink = MockSink()
         self.error_sink = MockSink()
 
         self.metrics = MockMetricsTransport()
         metrics_client = baseplate.metrics.Client(self.metrics, "collector")
 
-        self.allowed_origins = []
         self.collector = collector.EventCollector(
             keystore,
             metrics_client,
             self.event_sink,
             self.error_sink,
-            self.allowed_origins,
+            OriginMatcher([]),
         )
 
     def test_simple_batch(self):
@@ -130,6 +144,56 @@ class CollectorUnitTests(unittest.TestCase):
         self.assertEqual(self.error_sink.events, [])
         self.assertEqual(response.headers.get("Access-Control-Allow-Origin"), None)
 
+    def test_deflate_batch(self):
+        request = testing.DummyRequest()
+        request.headers["User-Agent"] = "TestApp/1.0"
+        request.headers["X-Signature"] = "key=TestKey1, mac=d7aab40b9db8ae0e0b40d98e9c50b2cfc80ca06127b42fbbbdf146752b47a5ed"
+        request.headers["Content-Encoding"] = "deflate"
+        request.environ["REMOTE_ADDR"] = "1.2.3.4"
+        request.client_addr = "2.3.4.5"
+        request.body = zlib.compress('[{"event1": "value"}, {"event2": "value"}]')
+        request.content_length = len(request.body)
+        response = self.collector.process_request(request)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.event_sink.events), 2)
+        self.assertEqual(self.error_sink.events, [])
+
+    def test_max_inflated_length_enforced(self):
+        self.collector.max_inflated_size = 1024
+
+        request = testing.DummyRequest()
+        request.headers["User-Agent"] = "TestApp/1.0"
+        request.headers["X-Signature"] = "key=TestKey1, mac=INVALID"
+        request.headers["Content-Encoding"] = "gzip"
+        request.environ["REMOTE_ADDR"] = "1.2.3.4"
+        request.client_addr = "2.3.4.5"
+        f = StringIO()
+        gzip.GzipFile(fileobj=f, mode='wb').write("[" + " " * 2048 + "]")
+        request.body = f.getvalue()
+        request.content_length = len(request.body)
+        response = self.collector.process_request(request)
+
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(len(self.event_sink.events), 0)
+        self.assertEqual(len(self.error_sink.events), 1)
+        self.metrics.assert_counter_with_value(
+            "collector.client-error.TestKey1.TOO_BIG", 1)
+
+    def test_invalid_gzip(self):
+        request = testing.DummyRequest()
+        request.headers["User-Agent"] = "TestApp/1.0"
+        request.headers["X-Signature"] = "key=TestKey1, mac=INVALID"
+        request.headers["Content-Encoding"] = "gzip"
+        request.environ["REMOTE_ADDR"] = "1.2.3.4"
+        request.client_addr = "2.3.4.5"
+        request.body = "not actually gzipped"
+        request.content_length = len(request.body)
+        response = self.collector.process_request(request)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(self.event_sink.events), 0)
+
     def test_max_length_enforced(self):
         request = testing.DummyRequest()
         request.headers["X-Signature"] = "key=TestKey1, mac=f8d929da113ab741eb173359f2bf28074f0ede5a2565a86389c35dd2c7ff7f6c"
@@ -159,6 +223,22 @@ class CollectorUnitTests(unittest.TestCase):
         self.metrics.assert_counter_with_value(
             "collector.client-error.TestKey1.INVALID_PAYLOAD", 1)
 
+    def test_non_finite_number(self):
+        request = testing.DummyRequest()
+        request.headers["User-Agent"] = "TestApp/1.0"
+        request.headers["X-Signature"] = "key=TestKey1, mac=c8c4c0d9169f502b6f15acca70c651fccf73a39cee6394b5dc3c7779d15fa820"
+        request.headers["Date"] = "Wed, 25 Nov 2015 06:25:24 GMT"
+        request.environ["REMOTE_ADDR"] = "1.2.3.4"
+        request.client_addr = "2.3.4.5"
+        request.body = '[{"a": NaN}]'
+        request.content_length = len(request.body)
+        response = self.collector.process_request(request)
+        self.assertEquals(response.status_code, 400)
+        self.assertEqual(len(self.event_sink.events), 0)
+        self.assertEqual(len(self.error_sink.events), 1)
+        self.metrics.assert_counter_with_value(
+            "collector.client-error.TestKey1.INVALID_PAYLOAD", 1)
+
     def test_bad_utf8(self):
         request = testing.DummyRequest()
         request.headers["User-Agent"] = "TestApp/1.0"
@@ -220,6 +300,29 @@ class CollectorUnitTests(unittest.TestCase):
         self.metrics.assert_counter_with_value(
             "collector.client-error.UNKNOWN.INVALID_MAC", 1)
 
+    def test_aggregated_errors(self):
+        self.collector.error_aggregator = ErrorAggregator(
+            self.error_sink, window=60)
+
+        request = testing.DummyRequest()
+        request.headers["User-Agent"] = "TestApp/1.0"
+        request.headers["X-Signature"] = "key=TestKey1, mac=INVALID"
+        request.environ["REMOTE_ADDR"] = "1.2.3.4"
+        request.client_addr = "2.3.4.5"
+        request.body = '[{"event1": "value"}]'
+        request.content_length = len(request.body)
+        for _ in xrange(3):
+            response = self.collector.process_request(request)
+            self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.error_sink.events, [])
+        self.metrics.assert_counter_with_value(
+            "collector.client-error.TestKey1.INVALID_MAC", 1)
+        self.assertEqual(len(self.metrics.metrics), 3)
+
+        self.collector.error_aggregator.flush()
+        summary, = self.error_sink.events
+        self.assertEqual(json.loads(summary)["event"]["count"], 3)
+
     def test_invalid_mac(self):
         request = testing.DummyRequest()
         request.headers["User-Agent"] = "TestApp/1.0"
@@ -299,8 +402,203 @@ class CollectorUnitTests(unittest.TestCase):
             self.event_sink.events)
         self.assertEqual(self.error_sink.events, [])
 
+    def test_framed_batch(self):
+        self.collector.frame_events = True
+
+        request = testing.DummyRequest()
+        request.headers["User-Agent"] = "TestApp/1.0"
+        request.headers["X-Signature"] = "key=TestKey1, mac=d7aab40b9db8ae0e0b40d98e9c50b2cfc80ca06127b42fbbbdf146752b47a5ed"
+        request.environ["REMOTE_ADDR"] = "1.2.3.4"
+        request.client_addr = "2.3.4.5"
+        request.body = '[{"event1": "value"}, {"event2": "value"}]'
+        request.content_length = len(request.body)
+        response = self.collector.process_request(request)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.event_sink.events), 1)
+        self.assertEqual(
+            [
+                '{"ip": "2.3.4.5", "event": {"event1": "value"}, "time": "2015-11-17T12:34:56"}',
+                '{"ip": "2.3.4.5", "event": {"event2": "value"}, "time": "2015-11-17T12:34:56"}',
+            ],
+            unpack_message(self.event_sink.events[0]))
+        self.metrics.assert_counter_with_value(
+            "collector.collected.http.TestKey1", 2)
+
+    def test_compact_envelopes(self):
+        self.collector.compact_envelopes = True
+
+        request = testing.DummyRequest()
+        request.headers["User-Agent"] = "TestApp/1.0"
+        request.headers["X-Signature"] = "key=TestKey1, mac=d7aab40b9db8ae0e0b40d98e9c50b2cfc80ca06127b42fbbbdf146752b47a5ed"
+        request.environ["REMOTE_ADDR"] = "1.2.3.4"
+        request.client_addr = "2.3.4.5"
+        request.body = '[{"event1": "value"}, {"event2": "value"}]'
+        request.content_length = len(request.body)
+        response = self.collector.process_request(request)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [
+                '{"ip": "2.3.4.5", "event": {"event1": "value"}, "time": "2015-11-17T12:34:56"}',
+                '{"ip": "2.3.4.5", "event": {"event2": "value"}, "time": "2015-11-17T12:34:56"}',
+            ],
+            [render_compact_event(event) for event in self.event_sink.events])
+
+    def test_shed_when_queue_full(self):
+        class FullSampler(object):
+            def fill(self):
+                return 0.95
+        self.collector.admission_controller = AdmissionController(
+            [FullSampler()], watermark=0.9, priority_watermark=0.99,
+            priority_keys=["PriorityKey"], retry_after=7)
+
+        request = testing.DummyRequest()
+        request.headers["User-Agent"] = "TestApp/1.0"
+        request.headers["X-Signature"] = "key=TestKey1, mac=d7aab40b9db8ae0e0b40d98e9c50b2cfc80ca06127b42fbbbdf146752b47a5ed"
+        request.environ["REMOTE_ADDR"] = "1.2.3.4"
+        request.client_addr = "2.3.4.5"
+        request.body = '[{"event1": "value"}, {"event2": "value"}]'
+        request.content_length = len(request.body)
+        response = self.collector.process_request(request)
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers["Retry-After"], "7")
+        self.assertEqual(self.event_sink.events, [])
+        self.assertEqual(self.error_sink.events, [])
+        self.metrics.assert_counter_with_value("collector.shed.TestKey1", 1)
+
+    def test_full_error_queue_does_not_shed(self):
+        class Sampler(object):
+            def __init__(self, fill):
+                self._fill = fill
+
+            def fill(self):
+                return self._fill
+        self.collector.admission_controller = AdmissionController(
+            [Sampler(0.1)], watermark=0.9, error_samplers=[Sampler(1.)])
+
+        request = testing.DummyRequest()
+        request.headers["User-Agent"] = "TestApp/1.0"
+        request.headers["X-Signature"] = "key=TestKey1, mac=d7aab40b9db8ae0e0b40d98e9c50b2cfc80ca06127b42fbbbdf146752b47a5ed"
+        request.environ["REMOTE_ADDR"] = "1.2.3.4"
+        request.client_addr = "2.3.4.5"
+        request.body = '[{"event1": "value"}, {"event2": "value"}]'
+        request.content_length = len(request.body)
+        response = self.collector.process_request(request)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.event_sink.events), 2)
+
+    def test_duplicate_batch(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.collector.duplicate_filter = DuplicateFilter(
+            os.path.join(directory, "dedup"), capacity=64)
+        self.addCleanup(self.collector.duplicate_filter.table.close)
+
+        def post():
+            request = testing.DummyRequest()
+            request.headers["User-Agent"] = "TestApp/1.0"
+            request.headers["X-Signature"] = "key=TestKey1, mac=d7aab40b9db8ae0e0b40d98e9c50b2cfc80ca06127b42fbbbdf146752b47a5ed"
+            request.environ["REMOTE_ADDR"] = "1.2.3.4"
+            request.client_addr = "2.3.4.5"
+            request.body = '[{"event1": "value"}, {"event2": "value"}]'
+            request.content_length = len(request.body)
+            return self.collector.process_request(request)
+
+        self.assertEqual(post().status_code, 200)
+        self.assertEqual(post().status_code, 200)
+        self.assertEqual(len(self.event_sink.events), 2)
+        self.metrics.assert_counter_with_value(
+            "collector.duplicate.TestKey1", 1)
+
+    def test_rate_limited(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.collector.rate_limiter = RateLimiter(
+            {"TestKey1": (3, 0)}, burst=1,
+            path=os.path.join(directory, "ratelimit"), capacity=64)
+        self.addCleanup(self.collector.rate_limiter.table.close)
+
+        def post():
+            request = testing.DummyRequest()
+            request.headers["User-Agent"] = "TestApp/1.0"
+            request.headers["X-Signature"] = "key=TestKey1, mac=d7aab40b9db8ae0e0b40d98e9c50b2cfc80ca06127b42fbbbdf146752b47a5ed"
+            request.environ["REMOTE_ADDR"] = "1.2.3.4"
+            request.client_addr = "2.3.4.5"
+            request.body = '[{"event1": "value"}, {"event2": "value"}]'
+            request.content_length = len(request.body)
+            return self.collector.process_request(request)
+
+        self.assertEqual(post().status_code, 200)
+        response = post()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers["Retry-After"], "1")
+        self.assertEqual(len(self.event_sink.events), 2)
+        self.metrics.assert_counter_with_value(
+            "collector.client-error.TestKey1.RATE_LIMITED", 1)
+
+    def test_stage_timing(self):
+        self.collector.profiler = StageProfiler(
+            self.collector.metrics_client, sample_rate=1)
+
+        request = testing.DummyRequest()
+        request.headers["User-Agent"] = "TestApp/1.0"
+        request.headers["X-Signature"] = "key=TestKey1, mac=d7aab40b9db8ae0e0b40d98e9c50b2cfc80ca06127b42fbbbdf146752b47a5ed"
+        request.headers["Content-Encoding"] = "deflate"
+        request.environ["REMOTE_ADDR"] = "1.2.3.4"
+        request.client_addr = "2.3.4.5"
+        request.body = zlib.compress('[{"event1": "value"}, {"event2": "value"}]')
+        request.content_length = len(request.body)
+        response = self.collector.process_request(request)
+
+        self.assertEqual(response.status_code, 200)
+        sample, = self.collector.profiler.recent()
+        self.assertEqual(sample["key"], "TestKey1")
+        self.assertEqual(sample["status"], 200)
+        self.assertEqual(sample["inflated_bytes"], 42)
+        self.assertEqual(list(sample["stages_ms"]), [
+            "signature", "keystore", "body_read", "inflate", "hmac", "json",
+            "envelope", "enqueue"])
+        timers = [metric.split(":")[0] for metric in self.metrics.metrics
+                  if metric.endswith("|ms")]
+        self.assertIn("collector.stage.inflate", timers)
+        self.assertIn("collector.payload.compressed_bytes", timers)
+
+    def test_request_stats(self):
+        self.collector.request_stats = RequestStats()
+
+        request = testing.DummyRequest()
+        request.headers["User-Agent"] = "TestApp/1.0"
+        request.headers["X-Signature"] = "key=TestKey1, mac=invalid"
+        request.environ["REMOTE_ADDR"] = "1.2.3.4"
+        request.client_addr = "2.3.4.5"
+        request.body = '[{"event1": "value"}, {"event2": "value"}]'
+        request.content_length = len(request.body)
+        self.collector.process_request(request)
+
+        keys = self.collector.request_stats.snapshot()["keys"]
+        self.assertEqual(keys, {
+            "TestKey1": {"accepted": 0, "rejected": 1,
+                         "statuses": {"403": 1}}})
+
+    def test_unicode_key_in_urlparams(self):
+        request = testing.DummyRequest()
+        request.headers["User-Agent"] = "TestApp/1.0"
+        request.GET["key"] = u"TestKey1"
+        request.GET["mac"] = u"d7aab40b9db8ae0e0b40d98e9c50b2cfc80ca06127b42fbbbdf146752b47a5ed"
+        request.environ["REMOTE_ADDR"] = "1.2.3.4"
+        request.client_addr = "2.3.4.5"
+        request.body = '[{"event1": "value"}, {"event2": "value"}]'
+        request.content_length = len(request.body)
+        response = self.collector.process_request(request)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.event_sink.events), 2)
+
     def test_cors_if_open(self):
-        self.allowed_origins.append("*")
+        self.collector.allowed_origins = OriginMatcher(["*"])
 
         request = testing.DummyRequest()
         request.headers["User-Agent"] = "TestApp/1.0"
@@ -316,7 +614,7 @@ class CollectorUnitTests(unittest.TestCase):
         self.assertEqual(response.headers.get("Access-Control-Allow-Origin"), "*")
 
     def test_cors_if_authorized(self):
-        self.allowed_origins.append("example.com")
+        self.collector.allowed_origins = OriginMatcher(["example.com"])
 
         request = testing.DummyRequest()
         request.headers["User-Agent"] = "TestApp/1.0"
@@ -332,7 +630,7 @@ class CollectorUnitTests(unittest.TestCase):
         self.assertEqual(response.headers.get("Access-Control-Allow-Origin"), "*")
 
     def test_no_cors_if_unauthorized(self):
-        self.allowed_origins.append("example.com")
+        self.collector.allowed_origins = OriginMatcher(["example.com"])
 
         request = testing.DummyRequest()
         request.headers["User-Agent"] = "TestApp/1.0"
@@ -350,7 +648,7 @@ class CollectorUnitTests(unittest.TestCase):
     def test_text_plain(self):
         # we need text/plain to work, even though it's gross and icky here, so
         # that we can avoid a CORS preflight
-        self.allowed_origins.append("example.com")
+        self.collector.allowed_origins = OriginMatcher(["example.com"])
 
         request = testing.DummyRequest()
         request.headers["User-Agent"] = "TestApp/1.0"
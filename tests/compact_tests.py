@@ -0,0 +1,85 @@
+import datetime
+import unittest
+
+from events import compact, envelope
+from events.framing import is_frame, pack_messages, unpack_message
+
+
+TIMESTAMPS = [
+    datetime.datetime(2015, 11, 17, 12, 34, 56),
+    datetime.datetime(2015, 11, 17, 12, 34, 56, 789),
+    datetime.datetime(1969, 12, 31, 23, 59, 59, 999999),
+]
+
+IPS = [
+    "2.3.4.5",
+    "2001:db8::1",
+    "2001:DB8:0:0::1",  # not in canonical form, so kept as text
+    "::ffff:1.2.3.4",
+    "not an ip",
+    u"caf\xe9",
+    "",
+    None,
+]
+
+EVENTS = [
+    '{"event1": "value"}',
+    '{"padded": "' + "x" * 1000 + '"}',
+    '[1, 2.50, "\\u00e9"]',
+]
+
+
+class CompactEnvelopeTests(unittest.TestCase):
+    def json_envelope(self, ip, timestamp, event):
+        prefix, suffix = envelope.make_envelope_affixes(ip, timestamp)
+        return prefix + event + suffix
+
+    def test_renders_identical_json_envelopes(self):
+        for ip in IPS:
+            for timestamp in TIMESTAMPS:
+                headers = compact.make_compact_headers(ip, timestamp)
+                for event in EVENTS:
+                    for compress_min_size in (0, 1):
+                        packed = compact.pack_compact_event(
+                            headers, event, compress_min_size)
+                        self.assertTrue(compact.is_compact(packed))
+                        self.assertEqual(
+                            compact.render_compact_event(packed),
+                            self.json_envelope(ip, timestamp, event),
+                            "%r %r %r" % (ip, timestamp, event))
+
+    def test_smaller(self):
+        headers = compact.make_compact_headers("2.3.4.5", TIMESTAMPS[0])
+        for event in EVENTS:
+            self.assertLess(
+                len(compact.pack_compact_event(headers, event)),
+                len(self.json_envelope("2.3.4.5", TIMESTAMPS[0], event)))
+
+    def test_compression(self):
+        headers = compact.make_compact_headers("2.3.4.5", TIMESTAMPS[0])
+        packed = compact.pack_compact_event(headers, EVENTS[1], 100)
+        self.assertLess(len(packed), 100)
+        # not worth it
+        packed = compact.pack_compact_event(headers, EVENTS[0], 1)
+        self.assertEqual(packed, headers[0] + EVENTS[0])
+
+    def test_unrepresentable_ip(self):
+        self.assertIsNone(
+            compact.make_compact_headers("x" * 256, TIMESTAMPS[0]))
+
+    def test_distinguishable(self):
+        headers = compact.make_compact_headers("2.3.4.5", TIMESTAMPS[0])
+        packed = compact.pack_compact_event(headers, EVENTS[0])
+        self.assertFalse(is_frame(packed))
+        self.assertFalse(compact.is_compact(EVENTS[0]))
+        frame, = pack_messages([packed, packed], 1024)
+        self.assertFalse(compact.is_compact(frame))
+        self.assertEqual(unpack_message(frame), [packed, packed])
+
+    def test_invalid(self):
+        headers = compact.make_compact_headers("2.3.4.5", TIMESTAMPS[0])
+        bad_version = headers[0][:2] + "\x09" + headers[0][3:]
+        for message in (headers[0][:5], headers[0][:-1], headers[1] + "!!",
+                        bad_version + "{}"):
+            with self.assertRaises(compact.CompactEnvelopeError):
+                compact.render_compact_event(message)
@@ -0,0 +1,75 @@
+from cStringIO import StringIO
+import gzip
+import unittest
+import zlib
+
+from events import compression
+
+
+def gzip_compress(data):
+    f = StringIO()
+    with gzip.GzipFile(fileobj=f, mode="wb") as gz:
+        gz.write(data)
+    return f.getvalue()
+
+
+class DecodeBodyTests(unittest.TestCase):
+    def decode(self, body, encoding, max_size=1024 * 1024, **kwargs):
+        decoder = compression.get_decoder(encoding)
+        return compression.decode_body(body, decoder, max_size, **kwargs)
+
+    def test_gzip(self):
+        self.assertEqual(self.decode(gzip_compress("hello"), "gzip"), "hello")
+
+    def test_gzip_multiple_members(self):
+        body = gzip_compress("hello ") + gzip_compress("world")
+        self.assertEqual(self.decode(body, "gzip"), "hello world")
+
+    def test_gzip_truncated(self):
+        body = gzip_compress("hello" * 100)
+        with self.assertRaises(compression.DecompressionError):
+            self.decode(body[:-4], "gzip")
+
+    def test_gzip_garbage(self):
+        with self.assertRaises(compression.DecompressionError):
+            self.decode("not gzip at all", "gzip")
+
+    def test_zlib_deflate(self):
+        self.assertEqual(
+            self.decode(zlib.compress("hello"), "deflate"), "hello")
+
+    def test_raw_deflate(self):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        body = compressor.compress("hello") + compressor.flush()
+        self.assertEqual(self.decode(body, "deflate"), "hello")
+
+    def test_encoding_is_case_insensitive(self):
+        self.assertIs(compression.get_decoder("GZIP"),
+                      compression.get_decoder("gzip"))
+
+    def test_unknown_encoding(self):
+        self.assertIsNone(compression.get_decoder("br"))
+
+    def test_register_decoder(self):
+        def decode_reversed(body, chunk_size):
+            yield body[::-1]
+        compression.register_decoder("x-reversed", decode_reversed)
+        self.assertEqual(self.decode("olleh", "x-reversed"), "hello")
+
+    def test_too_big_stops_early(self):
+        body = gzip_compress("x" * 10 * 1024 * 1024)
+        chunks = []
+        with self.assertRaises(compression.TooBigError):
+            self.decode(body, "gzip", max_size=100 * 1024,
+                        chunk_callback=chunks.append, chunk_size=16 * 1024)
+        self.assertLessEqual(sum(len(c) for c in chunks), 100 * 1024)
+
+    def test_chunk_callback(self):
+        data = "".join(chr(i % 251) for i in xrange(200 * 1024))
+        chunks = []
+        decoded = self.decode(gzip_compress(data), "gzip",
+                              chunk_callback=chunks.append,
+                              chunk_size=16 * 1024)
+        self.assertEqual(decoded, data)
+        self.assertEqual("".join(chunks), data)
+        self.assertTrue(all(len(c) <= 16 * 1024 for c in chunks))
@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from events import dedup
+
+
+class DuplicateFilterTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "dedup")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_filter(self, **kwargs):
+        duplicates = dedup.DuplicateFilter(self.path, capacity=64, **kwargs)
+        self.addCleanup(duplicates.table.close)
+        return duplicates
+
+    def test_remembered_batches_are_duplicates(self):
+        duplicates = self.make_filter(ttl=60)
+        self.assertFalse(duplicates.is_duplicate("TestKey1", "abc"))
+        self.assertFalse(duplicates.is_duplicate("TestKey1", "abc"))
+        duplicates.remember("TestKey1", "abc")
+        self.assertTrue(duplicates.is_duplicate("TestKey1", "abc"))
+        self.assertFalse(duplicates.is_duplicate("TestKey2", "abc"))
+        self.assertFalse(duplicates.is_duplicate("TestKey1", "abd"))
+
+    def test_expiration(self):
+        duplicates = self.make_filter(ttl=0.01)
+        duplicates.remember("TestKey1", "abc")
+        time.sleep(0.02)
+        self.assertFalse(duplicates.is_duplicate("TestKey1", "abc"))
+
+    def test_shared_between_processes(self):
+        # a process must not open the same table twice
+        pid = os.fork()
+        if pid == 0:
+            try:
+                dedup.DuplicateFilter(self.path, capacity=64).remember(
+                    "TestKey1", "abc")
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+        duplicates = self.make_filter()
+        self.assertTrue(duplicates.is_duplicate("TestKey1", "abc"))
+
+    def test_unicode_keyname(self):
+        duplicates = self.make_filter()
+        duplicates.remember(u"TestKey\xe9", "abc")
+        self.assertTrue(duplicates.is_duplicate(u"TestKey\xe9", "abc"))
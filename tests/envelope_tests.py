@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import datetime
+import json
+import unittest
+
+from pyramid import testing
+
+from events import collector, envelope
+
+
+CONFORMANCE_BATCHES = [
+    '[]',
+    '[{"event1": "value"}, {"event2": "value"}]',
+    '  [ {"a": 1} ,{"b": [1, 2, {"c": null}]}\n]\n',
+    '[1, 2.5, -3e10, "string", true, false, null]',
+    '[{"unicode": "caf\xc3\xa9 \xf0\x9f\x8d\x97"}]',
+    '[{"escaped": "\\u00e9\\ud83c\\udf57 \\"quoted\\" \\\\ \\n"}]',
+    '[{"big": 123456789012345678901234567890}]',
+    '[{"nested": {"deeper": {"deepest": [[], {}]}}}]',
+    '[{"dup": 1, "dup": 2}]',
+]
+
+INVALID_BATCHES = [
+    '',
+    '!!!',
+    '[',
+    '[1,]',
+    '[1 2]',
+    '[1] extra',
+    '[{"blah": "\x8b"}]',
+    '[{"a": 1}',
+    '[,]',
+]
+
+
+class ConformanceTests(unittest.TestCase):
+    """Check the raw span envelope against the decode/re-encode path."""
+
+    def setUp(self):
+        self.start_time = datetime.datetime(2015, 11, 17, 12, 34, 56)
+        self.request = testing.DummyRequest()
+        self.request.client_addr = "2.3.4.5"
+        self.request.environ["events.start_time"] = self.start_time
+
+    def reference_envelopes(self, body):
+        return [collector.wrap_and_serialize_event(self.request, item)
+                for item in json.loads(body)]
+
+    def fast_envelopes(self, body):
+        prefix, suffix = envelope.make_envelope_affixes(
+            self.request.client_addr, self.start_time)
+        return [prefix + raw + suffix for raw in envelope.split_batch(body)]
+
+    def test_semantically_identical(self):
+        for body in CONFORMANCE_BATCHES:
+            reference = self.reference_envelopes(body)
+            fast = self.fast_envelopes(body)
+            self.assertEqual(
+                [json.loads(e) for e in reference],
+                [json.loads(e) for e in fast],
+                "envelopes differ for %r" % body)
+
+    def test_byte_identical_for_canonical_input(self):
+        body = '[{"event1": "value"}, {"event2": [1, 2]}]'
+        self.assertEqual(
+            self.reference_envelopes(body), self.fast_envelopes(body))
+
+    def test_invalid_json(self):
+        for body in INVALID_BATCHES:
+            with self.assertRaises(ValueError):
+                json.loads(body)
+            with self.assertRaises(ValueError):
+                envelope.split_batch(body)
+
+    def test_not_a_batch(self):
+        for body in ('{"event1": "value"}', '"string"', '1', 'null'):
+            with self.assertRaises(envelope.NotABatchError):
+                envelope.split_batch(body)
+
+    def test_missing_ip(self):
+        self.request.client_addr = None
+        body = '[{"a": 1}]'
+        self.assertEqual(
+            self.reference_envelopes(body), self.fast_envelopes(body))
@@ -0,0 +1,97 @@
+import base64
+import datetime
+import json
+import os
+import time
+import unittest
+import zlib
+
+from baseplate.message_queue import TimedOutError
+from pyramid import testing
+
+from events import errors
+
+
+class MockQueue(object):
+    def __init__(self, full=False):
+        self.messages = []
+        self.full = full
+
+    def put(self, message, timeout=None):
+        if self.full:
+            raise TimedOutError
+        self.messages.append(message)
+
+
+def make_request(body, second=0, ip="1.2.3.4"):
+    request = testing.DummyRequest()
+    request.client_addr = ip
+    request.body = body
+    request.environ["events.start_time"] = datetime.datetime(
+        2015, 11, 17, 12, 34, second)
+    return request
+
+
+class ErrorAggregatorTests(unittest.TestCase):
+    def setUp(self):
+        self.queue = MockQueue()
+        self.aggregator = errors.ErrorAggregator(
+            self.queue, window=60, samples=2, sample_size=10)
+
+    def summaries(self):
+        return [json.loads(message) for message in self.queue.messages]
+
+    def test_nothing_until_flushed(self):
+        self.aggregator.add(make_request("body"), "TestKey1", "INVALID_MAC")
+        self.assertEqual(self.queue.messages, [])
+
+    def test_summary(self):
+        for second in xrange(5):
+            request = make_request("x" * 100, second, ip="1.1.1.%d" % second)
+            self.aggregator.add(request, "TestKey1", "INVALID_MAC")
+        self.aggregator.add(make_request("!!!"), "TestKey1", "INVALID_PAYLOAD")
+        self.aggregator.flush()
+
+        mac_summary, payload_summary = self.summaries()
+        self.assertEqual(mac_summary["ip"], "1.1.1.0")
+        self.assertEqual(mac_summary["time"], "2015-11-17T12:34:00")
+        event = mac_summary["event"]
+        self.assertEqual(event["key"], "TestKey1")
+        self.assertEqual(event["error"], "INVALID_MAC")
+        self.assertEqual(event["count"], 5)
+        self.assertEqual(event["first_time"], "2015-11-17T12:34:00")
+        self.assertEqual(event["last_time"], "2015-11-17T12:34:04")
+        self.assertEqual(len(event["samples"]), 2)
+        sample = event["samples"][1]
+        self.assertEqual(sample["ip"], "1.1.1.1")
+        self.assertEqual(sample["size"], 100)
+        self.assertEqual(
+            zlib.decompress(base64.b64decode(sample["raw_batch_deflate"])),
+            "x" * 10)
+
+        self.assertEqual(payload_summary["event"]["count"], 1)
+
+        # the window starts over
+        self.aggregator.flush()
+        self.assertEqual(len(self.queue.messages), 2)
+
+    def test_flushes_when_window_ends(self):
+        self.aggregator._next_flush = time.time()
+        self.aggregator.add(make_request("body"), "TestKey1", "INVALID_MAC")
+        self.assertEqual(len(self.queue.messages), 1)
+
+    def test_samples_dropped_to_fit(self):
+        self.aggregator.sample_size = 1000
+        self.aggregator.max_message_size = 2200
+        for _ in xrange(2):
+            self.aggregator.add(make_request(os.urandom(1000)),
+                                "TestKey1", "INVALID_MAC")
+        self.aggregator.flush()
+        summary, = self.summaries()
+        self.assertEqual(summary["event"]["count"], 2)
+        self.assertEqual(len(summary["event"]["samples"]), 1)
+
+    def test_full_queue(self):
+        self.queue.full = True
+        self.aggregator.add(make_request("body"), "TestKey1", "INVALID_MAC")
+        self.aggregator.flush()
@@ -0,0 +1,127 @@
+from cStringIO import StringIO
+import unittest
+
+import baseplate
+from pyramid.config import Configurator
+from webob import Request
+
+from events import collector
+from events.const import MAXIMUM_BATCH_SIZE
+from events.fastpath import FastPathMiddleware, LeanRequest
+from events.keystore import Keystore
+from events.origins import OriginMatcher
+
+from collector_tests import MockMetricsTransport, MockSink
+
+
+BATCH = '[{"event1": "value"}, {"event2": "value"}]'
+BATCH_MAC = "d7aab40b9db8ae0e0b40d98e9c50b2cfc80ca06127b42fbbbdf146752b47a5ed"
+
+
+def make_request(path="/v1", method="POST", body=BATCH, mac=BATCH_MAC,
+                 **headers):
+    request = Request.blank(path, method=method, headers=headers)
+    request.environ["REMOTE_ADDR"] = "1.2.3.4"
+    if method == "POST":
+        request.headers["User-Agent"] = "TestApp/1.0"
+        request.headers["X-Signature"] = "key=TestKey1, mac=" + mac
+        request.body = body
+    return request
+
+
+class FastPathMiddlewareTests(unittest.TestCase):
+    def setUp(self):
+        self.event_sink = MockSink()
+        self.collector = collector.EventCollector(
+            Keystore({"TestKey1": "test"}),
+            baseplate.metrics.Client(MockMetricsTransport(), "collector"),
+            self.event_sink,
+            MockSink(),
+            OriginMatcher(["example.com"]),
+        )
+
+        config = Configurator()
+        config.add_route("v1", "/v1", request_method="POST")
+        config.add_route("v1_options", "/v1", request_method="OPTIONS")
+        config.add_view(self.collector.process_request, route_name="v1")
+        config.add_view(self.collector.check_cors, route_name="v1_options")
+        config.add_route("health", "/health")
+        config.add_view(lambda request: {"ok": True}, route_name="health",
+                        renderer="json")
+        self.pyramid_app = config.make_wsgi_app()
+        self.fast_app = FastPathMiddleware(self.pyramid_app, self.collector)
+
+    def assertSameResponse(self, request):
+        expected = request.copy().get_response(self.pyramid_app)
+        expected_events = self.event_sink.events[:]
+        del self.event_sink.events[:]
+
+        actual = request.copy().get_response(self.fast_app)
+        self.assertEqual(actual.status, expected.status)
+        self.assertEqual(sorted(actual.headerlist), sorted(expected.headerlist))
+        self.assertEqual(actual.body, expected.body)
+        self.assertEqual(len(self.event_sink.events), len(expected_events))
+        return actual
+
+    def test_batch(self):
+        response = self.assertSameResponse(
+            make_request(Origin="https://www.example.com"))
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(len(self.event_sink.events), 2)
+
+    def test_errors(self):
+        self.assertSameResponse(make_request(mac="0" * 64))
+        self.assertSameResponse(
+            make_request(body="!!!", mac="f8d929da113ab741eb173359f2bf28074f0ede5a2565a86389c35dd2c7ff7f6c"))
+
+        too_big = make_request(body="x" * (MAXIMUM_BATCH_SIZE + 1))
+        response = self.assertSameResponse(too_big)
+        self.assertEqual(response.status_int, 413)
+
+    def test_preflight(self):
+        response = self.assertSameResponse(make_request(
+            method="OPTIONS", Origin="https://www.example.com",
+            **{"Access-Control-Request-Method": "POST"}))
+        self.assertEqual(response.status_int, 204)
+
+        response = self.assertSameResponse(make_request(
+            method="OPTIONS", Origin="https://www.example.com"))
+        self.assertEqual(response.status_int, 403)
+
+    def test_other_paths_pass_through(self):
+        self.assertEqual(
+            make_request("/health", method="GET").get_response(
+                self.fast_app).json, {"ok": True})
+        self.assertSameResponse(make_request(method="GET"))
+        self.assertSameResponse(make_request("/v1/"))
+
+
+class LeanRequestTests(unittest.TestCase):
+    def make_environ(self, body, content_length):
+        environ = Request.blank("/v1", method="POST").environ
+        environ["wsgi.input"] = StringIO(body)
+        if content_length is None:
+            environ.pop("CONTENT_LENGTH", None)
+            environ["wsgi.input_terminated"] = True
+        else:
+            environ["CONTENT_LENGTH"] = str(content_length)
+        return environ
+
+    def test_body(self):
+        request = LeanRequest(self.make_environ("[1, 2]", 6))
+        self.assertEqual(request.body, "[1, 2]")
+        self.assertEqual(request.body, "[1, 2]")
+
+    def test_body_is_capped(self):
+        request = LeanRequest(self.make_environ("x" * 100, 100))
+        request.max_body_size = 10
+        self.assertEqual(request.body, "x" * 10)
+
+    def test_chunked_body_is_capped(self):
+        request = LeanRequest(self.make_environ("x" * 100, None))
+        request.max_body_size = 10
+        self.assertEqual(request.body, "x" * 10)
+
+    def test_no_body(self):
+        request = LeanRequest(self.make_environ("ignored", 0))
+        self.assertEqual(request.body, "")
@@ -0,0 +1,46 @@
+import unittest
+
+from events import framing
+
+
+class FramingTests(unittest.TestCase):
+    def test_roundtrip(self):
+        items = ['{"event": 1}', '{"event": 2}', '{"event": 3}']
+        messages = framing.pack_messages(items, 1024)
+        self.assertEqual(len(messages), 1)
+        self.assertTrue(framing.is_frame(messages[0]))
+        self.assertEqual(framing.unpack_message(messages[0]), items)
+
+    def test_single_item_is_unframed(self):
+        messages = framing.pack_messages(['{"event": 1}'], 1024)
+        self.assertEqual(messages, ['{"event": 1}'])
+
+    def test_legacy_message(self):
+        self.assertEqual(
+            framing.unpack_message('{"event": 1}'), ['{"event": 1}'])
+
+    def test_split_on_size(self):
+        items = ["x" * 40] * 5
+        messages = framing.pack_messages(items, 100)
+        self.assertTrue(all(len(m) <= 100 for m in messages))
+        self.assertEqual(len(messages), 3)
+        unpacked = []
+        for message in messages:
+            unpacked.extend(framing.unpack_message(message))
+        self.assertEqual(unpacked, items)
+
+    def test_maximum_size_item_fits(self):
+        items = ["x" * 100, "y"]
+        messages = framing.pack_messages(items, 100)
+        self.assertEqual(messages, items)
+
+    def test_truncated_frame(self):
+        message = framing.pack_messages(["abc", "def"], 1024)[0]
+        with self.assertRaises(framing.FramingError):
+            framing.unpack_message(message[:-1])
+
+    def test_unknown_version(self):
+        message = framing.pack_messages(["abc", "def"], 1024)[0]
+        message = message[:2] + "\x63" + message[3:]
+        with self.assertRaises(framing.FramingError):
+            framing.unpack_message(message)
@@ -0,0 +1,97 @@
+import unittest
+
+import mock
+from pyramid import testing
+from pyramid.httpexceptions import HTTPForbidden
+
+from events.health import DebugStats, HealthCheck
+from events.stats import RequestStats
+
+
+def make_queue(depth, capacity):
+    queue = mock.Mock()
+    queue.depth = depth
+    queue.capacity = capacity
+    return queue
+
+
+class HealthCheckTests(unittest.TestCase):
+    def test_ok(self):
+        health_check = HealthCheck(
+            [("events", make_queue(10, 100))],
+            error_queues=[("errors", make_queue(0, 50))])
+        request = testing.DummyRequest()
+        result = health_check(request)
+        self.assertEqual(result["status"], "ok")
+        self.assertEqual(result["queues"], {
+            "events": {"depth": 10, "capacity": 100},
+            "errors": {"depth": 0, "capacity": 50},
+        })
+        self.assertEqual(request.response.status_int, 200)
+
+    def test_degraded_queue(self):
+        health_check = HealthCheck(
+            [("events", make_queue(85, 100)), ("errors", make_queue(0, 50))],
+            degraded_watermark=0.8, degraded_status=429)
+        request = testing.DummyRequest()
+        result = health_check(request)
+        self.assertEqual(result["status"], "degraded")
+        self.assertEqual(request.response.status_int, 429)
+
+    def test_full_error_queue_is_healthy(self):
+        health_check = HealthCheck(
+            [("events", make_queue(0, 100))],
+            error_queues=[("errors", make_queue(50, 50))])
+        request = testing.DummyRequest()
+        result = health_check(request)
+        self.assertEqual(result["status"], "ok")
+        self.assertEqual(result["queues"]["errors"],
+                         {"depth": 50, "capacity": 50})
+
+        health_check.errors_degraded_watermark = 0.9
+        result = health_check(request)
+        self.assertEqual(result["status"], "degraded")
+
+    def test_degraded_while_spilling(self):
+        spill_log = mock.Mock(depth=3, bytes=300)
+        health_check = HealthCheck(
+            [("events", make_queue(0, 100))], spill_log=spill_log)
+        request = testing.DummyRequest()
+        result = health_check(request)
+        self.assertEqual(result["status"], "degraded")
+        self.assertEqual(result["spill"], {"depth": 3, "bytes": 300})
+        self.assertEqual(request.response.status_int, 503)
+
+
+class DebugStatsTests(unittest.TestCase):
+    def setUp(self):
+        self.request_stats = RequestStats()
+        self.request_stats.record("Key", 200, 0.001)
+        self.view = DebugStats("sekrit", self.request_stats)
+
+    def test_requires_secret(self):
+        request = testing.DummyRequest()
+        with self.assertRaises(HTTPForbidden):
+            self.view(request)
+
+        request.headers["Authorization"] = "Bearer wrong"
+        with self.assertRaises(HTTPForbidden):
+            self.view(request)
+
+    def test_stats(self):
+        request = testing.DummyRequest()
+        request.headers["Authorization"] = "Bearer sekrit"
+        result = self.view(request)
+        self.assertEqual(result["requests"], 1)
+        self.assertEqual(result["keys"]["Key"]["accepted"], 1)
+        self.assertNotIn("stage_latency_ms", result)
+
+    def test_stage_latencies(self):
+        profiler = mock.Mock()
+        profiler.recent.return_value = [
+            {"stages_ms": {"json": 1.}}, {"stages_ms": {"json": 3.}}]
+        view = DebugStats("sekrit", self.request_stats, profiler)
+        request = testing.DummyRequest()
+        request.headers["Authorization"] = "Bearer sekrit"
+        result = view(request)
+        self.assertEqual(result["stage_latency_ms"]["json"]["p99"], 3.)
@@ -1,11 +1,28 @@
+import datetime
+import errno
+import os
+import select
+import shutil
+import tempfile
 import unittest
 
 import baseplate
-from baseplate.message_queue import MessageQueue
+from baseplate.message_queue import MessageQueue, TimedOutError
 
-from events.injector import process_queue
+from events.compact import make_compact_headers, pack_compact_event
+from events.framing import pack_messages
+from events.shutdown import ShutdownFlag
+from events.transport import MessageQueueTransport, make_queue
+from events.injector import (
+    claim_queues,
+    drain_queue,
+    main,
+    process_queue,
+    process_queue_batched,
+    process_queues,
+)
 from kafka import KafkaProducer
-from kafka.common import KafkaError
+from kafka.common import KafkaError, KafkaTimeoutError
 from kafka.future import Future
 import mock
 from mock import Mock, MagicMock
@@ -25,7 +42,7 @@ class FailureException(Exception):
 class InjectorTests(unittest.TestCase):
     def setUp(self):
         self.event_queue = mock.create_autospec(MessageQueue)
-        self.event_queue.get = Mock(side_effect=[1,2,3])
+        self.event_queue.get = Mock(side_effect=["1", "2", "3"])
         self.mock_metrics_client = mock.create_autospec(
             baseplate.metrics.Client)
         self.allowed_origins = []
@@ -69,7 +86,7 @@ class InjectorTests(unittest.TestCase):
                           cb_spy)
         # Also verify propagation of queue and message to error callback.
         # Message is specified by mocking of self.event_queue.get in setUp.
-        cb_spy.assert_called_with(1, self.event_queue)
+        cb_spy.assert_called_with("1", self.event_queue)
 
     def test_process_queue_success_cb(self):
         """ Verify success callback executed on Future success"""
@@ -84,3 +101,269 @@ class InjectorTests(unittest.TestCase):
                           self.kafka_producer,
                           self.success_cb,
                           self.error_cb)
+
+    def test_process_queue_unpacks_frames(self):
+        """ Verify each event in a framed message is sent individually."""
+        frame, = pack_messages(["a", "b"], 1024)
+        self.event_queue.get = Mock(side_effect=[frame, "c"])
+        mock_future = Future()
+        self.kafka_producer.send = MagicMock(return_value=mock_future)
+        with self.assertRaises(StopIteration):
+            process_queue(self.event_queue,
+                          "test",
+                          self.kafka_producer,
+                          self.success_cb,
+                          self.error_cb)
+        self.assertEqual(
+            [mock.call("test", "a"), mock.call("test", "b"),
+             mock.call("test", "c")],
+            self.kafka_producer.send.call_args_list)
+
+    def test_process_queue_renders_compact_envelopes(self):
+        """ Verify compact events are sent to Kafka in JSON envelopes."""
+        headers = make_compact_headers(
+            "1.2.3.4", datetime.datetime(2015, 11, 17, 12, 34, 56))
+        frame, = pack_messages(
+            [pack_compact_event(headers, '{"a": 1}'), headers[0][:-1]], 1024)
+        self.event_queue.get = Mock(side_effect=[frame])
+        self.kafka_producer.send = MagicMock(return_value=Future())
+        with self.assertRaises(StopIteration):
+            process_queue(self.event_queue,
+                          "test",
+                          self.kafka_producer,
+                          self.success_cb,
+                          self.error_cb,
+                          metrics_client=self.mock_metrics_client)
+        self.assertEqual(
+            [mock.call("test", '{"ip": "1.2.3.4", "event": {"a": 1}, '
+                               '"time": "2015-11-17T12:34:56"}')],
+            self.kafka_producer.send.call_args_list)
+        self.mock_metrics_client.counter.assert_called_with(
+            "injector.bad_envelope")
+
+    def test_process_queue_returns_to_retune(self):
+        """ Verify the loop ends when the tuner wants new settings."""
+        self.kafka_producer.send = MagicMock(return_value=Future())
+        tuner = Mock()
+        tuner.should_retune.return_value = True
+        process_queue(self.event_queue,
+                      "test",
+                      self.kafka_producer,
+                      self.success_cb,
+                      self.error_cb,
+                      tuner=tuner)
+        self.assertEqual(self.event_queue.get.call_count, 1)
+        tuner.record_send.assert_called_once_with(1)
+
+    def test_process_queue_hands_failures_to_retry_scheduler(self):
+        """ Verify failed and timed out sends are scheduled for retry."""
+        failed = Future().failure(FailureException())
+        self.kafka_producer.send = MagicMock(
+            side_effect=[failed, KafkaTimeoutError(), Future()])
+        retry_scheduler = Mock()
+        retry_scheduler.is_full.return_value = False
+        retry_scheduler.time_until_due.return_value = 0.5
+        err_cb = Mock()
+        with self.assertRaises(StopIteration):
+            process_queue(self.event_queue,
+                          "test",
+                          self.kafka_producer,
+                          Mock(),
+                          err_cb,
+                          retry_scheduler=retry_scheduler)
+        self.assertFalse(err_cb.called)
+        self.event_queue.get.assert_called_with(timeout=0.5)
+        retry_scheduler.errback.assert_any_call("test", "1")
+        retry_scheduler.errback.return_value.assert_called_once_with(
+            failed.exception)
+        retry_scheduler.schedule.assert_called_once_with(
+            "test", "2", attempts=0)
+        self.assertEqual(retry_scheduler.resend_due.call_count, 4)
+
+    def test_process_queue_stops_on_shutdown(self):
+        """ Verify no more messages are taken once shutdown is requested."""
+        shutdown = ShutdownFlag()
+        def send(topic, event):
+            shutdown.request()
+            return Future()
+        self.kafka_producer.send = MagicMock(side_effect=send)
+        process_queue(self.event_queue,
+                      "test",
+                      self.kafka_producer,
+                      Mock(),
+                      self.error_cb,
+                      shutdown=shutdown)
+        self.assertEqual(self.event_queue.get.call_count, 1)
+
+    def test_process_queue_interrupted(self):
+        """ Verify a signal interrupting the queue read isn't fatal."""
+        self.event_queue.get = Mock(
+            side_effect=[select.error(errno.EINTR, "Interrupted"), "1"])
+        self.kafka_producer.send = MagicMock(return_value=Future())
+        with self.assertRaises(StopIteration):
+            process_queue(self.event_queue,
+                          "test",
+                          self.kafka_producer,
+                          Mock(),
+                          self.error_cb)
+        self.kafka_producer.send.assert_called_once_with("test", "1")
+
+
+class DrainTests(unittest.TestCase):
+    def setUp(self):
+        self.event_queue = mock.create_autospec(MessageQueue)
+
+    def test_drain_up_to_max(self):
+        self.event_queue.get = Mock(side_effect=["1", "2", "3", "4"])
+        messages = drain_queue(self.event_queue, 3, linger_secs=1)
+        self.assertEqual(messages, ["1", "2", "3"])
+
+    def test_drain_stops_after_linger(self):
+        self.event_queue.get = Mock(
+            side_effect=["1", "2", TimedOutError(), TimedOutError()])
+        messages = drain_queue(self.event_queue, 10, linger_secs=1)
+        self.assertEqual(messages, ["1", "2"])
+        self.assertEqual(self.event_queue.get.call_count, 4)
+
+    def test_drain_without_linger(self):
+        self.event_queue.get = Mock(side_effect=["1", TimedOutError()])
+        messages = drain_queue(self.event_queue, 10, linger_secs=0)
+        self.assertEqual(messages, ["1"])
+
+    def test_drain_keeps_messages_when_interrupted(self):
+        self.event_queue.get = Mock(side_effect=[
+            "1", TimedOutError(), select.error(errno.EINTR, "Interrupted")])
+        messages = drain_queue(self.event_queue, 10, linger_secs=1)
+        self.assertEqual(messages, ["1"])
+
+    def test_batched_callbacks(self):
+        self.event_queue.get = Mock(side_effect=["1", "2", TimedOutError()])
+        kafka_producer = mock.create_autospec(KafkaProducer)
+        succeeded = Future().success(None)
+        failed = Future().failure(FailureException())
+        kafka_producer.send = MagicMock(side_effect=[succeeded, failed])
+        success_cb = Mock()
+        err_cb = Mock()
+
+        with self.assertRaises(StopIteration):
+            process_queue_batched(self.event_queue,
+                                  "test",
+                                  kafka_producer,
+                                  success_cb,
+                                  err_cb,
+                                  max_messages=10,
+                                  linger_secs=0)
+
+        kafka_producer.flush.assert_called_once_with()
+        success_cb.assert_called_once_with(1)
+        err_cb.assert_called_once_with(
+            [("2", failed.exception)], self.event_queue)
+
+    def test_batched_flush_abandoned_on_shutdown(self):
+        self.event_queue.get = Mock(side_effect=["1", "2", TimedOutError()])
+        kafka_producer = mock.create_autospec(KafkaProducer)
+        kafka_producer.send = MagicMock(
+            side_effect=[Future().success(None), Future()])
+        shutdown = ShutdownFlag()
+
+        def flush(timeout=None):
+            # kafka is down: the first flush times out before the SIGTERM
+            # and the second after it
+            if kafka_producer.flush.call_count == 2:
+                shutdown.request()
+            raise AssertionError("Timeout waiting for future")
+        kafka_producer.flush.side_effect = flush
+        success_cb = Mock()
+        err_cb = Mock()
+
+        process_queue_batched(self.event_queue,
+                              "test",
+                              kafka_producer,
+                              success_cb,
+                              err_cb,
+                              max_messages=10,
+                              linger_secs=0,
+                              shutdown=shutdown)
+
+        self.assertEqual(kafka_producer.flush.call_args_list,
+                         [mock.call(timeout=1), mock.call(timeout=1)])
+        success_cb.assert_called_once_with(1)
+        self.assertFalse(err_cb.called)
+
+
+class MultiQueueTests(unittest.TestCase):
+    def make_queue(self, fd, messages):
+        queue = mock.create_autospec(MessageQueueTransport)
+        queue.fileno = Mock(return_value=fd)
+        queue.get = Mock(side_effect=messages + [TimedOutError()])
+        return queue
+
+    @mock.patch("events.injector.select.select")
+    def test_queues_served_fairly(self, select):
+        events_queue = self.make_queue(3, ["e1", "e2", "e3"])
+        errors_queue = self.make_queue(4, ["x1"])
+        select.side_effect = [([3, 4], [], [])]
+        kafka_producer = mock.create_autospec(KafkaProducer)
+        kafka_producer.send = MagicMock(return_value=Future())
+
+        with self.assertRaises(StopIteration):
+            process_queues([(events_queue, "Events"), (errors_queue, "Errors")],
+                           kafka_producer,
+                           Mock(),
+                           Mock(),
+                           quantum=2)
+
+        self.assertEqual(
+            [mock.call("Events", "e1"), mock.call("Events", "e2"),
+             mock.call("Errors", "x1")],
+            kafka_producer.send.call_args_list)
+
+
+class ClaimQueuesTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.config = {
+            "__file__": "events.ini",
+            "transport": "ring",
+            "transport.ring.directory": self.directory,
+            "topic.events": "Events",
+        }
+        self.queue = make_queue(self.config, "events")
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.directory)
+
+    def run_in_child(self, function):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os._exit(0 if function() else 1)
+            finally:
+                os._exit(2)
+        _, status = os.waitpid(pid, 0)
+        return os.WEXITSTATUS(status)
+
+    def test_mq_claimed(self):
+        queue = mock.create_autospec(MessageQueueTransport)
+        self.assertTrue(claim_queues([(queue, "Events")]))
+
+    def test_second_ring_consumer(self):
+        self.assertTrue(claim_queues([(self.queue, "Events")]))
+        self.assertEqual(self.run_in_child(
+            lambda: not claim_queues([(self.queue, "Events")])), 0)
+
+    @mock.patch.dict(os.environ, {"CONFIG_URI": "config:events.ini",
+                                  "QUEUE": "events"})
+    def test_second_injector_exits(self):
+        self.queue.fileno()
+
+        def run_main():
+            with mock.patch("paste.deploy.loadwsgi.appconfig",
+                            return_value=self.config), \
+                    mock.patch("logging.config.fileConfig"), \
+                    mock.patch("events.injector.make_sink") as make_sink:
+                main()
+            return not make_sink.called
+
+        self.assertEqual(self.run_in_child(run_main), 0)
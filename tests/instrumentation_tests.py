@@ -0,0 +1,85 @@
+import unittest
+
+import mock
+
+from events.instrumentation import (
+    NULL_STAGE_TIMER,
+    StageProfiler,
+    StageTimer,
+)
+
+
+class StageTimerTests(unittest.TestCase):
+    @mock.patch("events.instrumentation.time.time")
+    def test_marks(self, time):
+        time.side_effect = [100., 100.5, 101.5]
+        timer = StageTimer()
+        timer.mark("one")
+        timer.mark("two")
+        self.assertEqual(timer.stages, [("one", 0.5), ("two", 1.)])
+        self.assertEqual(timer.total, 1.5)
+
+    def test_null_timer_ignores_everything(self):
+        NULL_STAGE_TIMER.mark("stage")
+        NULL_STAGE_TIMER.compressed_bytes = 10
+        self.assertFalse(hasattr(NULL_STAGE_TIMER, "compressed_bytes"))
+
+
+class StageProfilerTests(unittest.TestCase):
+    def setUp(self):
+        self.metrics_client = mock.Mock()
+        patcher = mock.patch("events.instrumentation.record_timing")
+        self.record_timing = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_not_sampled(self):
+        profiler = StageProfiler(self.metrics_client, sample_rate=0)
+        timer = profiler.start()
+        self.assertIs(timer, NULL_STAGE_TIMER)
+        profiler.record(timer, 200)
+        self.assertFalse(self.record_timing.called)
+        self.assertEqual(profiler.recent(), [])
+
+    def test_sample_rate(self):
+        profiler = StageProfiler(self.metrics_client, sample_rate=0.25, seed=1)
+        sampled = sum(profiler.start() is not NULL_STAGE_TIMER
+                      for _ in xrange(1000))
+        self.assertTrue(200 < sampled < 300)
+
+    @mock.patch("events.instrumentation.time.time")
+    def test_record(self, time):
+        time.side_effect = [100., 100.001, 100.003]
+        profiler = StageProfiler(
+            self.metrics_client, sample_rate=1, ring_size=2)
+        timer = profiler.start()
+        timer.keyname = "Key"
+        timer.mark("signature")
+        timer.compressed_bytes = 10
+        timer.inflated_bytes = 40
+        timer.mark("inflate")
+        profiler.record(timer, 200)
+
+        recorded = {call[0][1]: call[0][2]
+                    for call in self.record_timing.call_args_list}
+        self.assertEqual(sorted(recorded), [
+            "payload.compressed_bytes",
+            "payload.inflated_bytes",
+            "stage.inflate",
+            "stage.signature",
+            "stage.total",
+        ])
+        self.assertEqual(recorded["payload.inflated_bytes"], 40)
+        self.assertAlmostEqual(recorded["stage.inflate"], 2.)
+
+        sample, = profiler.recent()
+        self.assertEqual(sample["key"], "Key")
+        self.assertEqual(sample["status"], 200)
+        self.assertEqual(list(sample["stages_ms"]), ["signature", "inflate"])
+
+    def test_ring_buffer_is_bounded(self):
+        profiler = StageProfiler(
+            self.metrics_client, sample_rate=1, ring_size=2)
+        for status in (200, 403, 400):
+            profiler.record(profiler.start(), status)
+        self.assertEqual(
+            [sample["status"] for sample in profiler.recent()], [403, 400])
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import datetime
+import json
+import unittest
+
+import mock
+from pyramid import testing
+
+from events import collector, envelope, jsonbackend
+
+from envelope_tests import CONFORMANCE_BATCHES, INVALID_BATCHES
+
+
+NON_FINITE_BATCHES = [
+    '[NaN]',
+    '[Infinity]',
+    '[-Infinity]',
+    '[{"a": [1, NaN]}]',
+    'NaN',
+]
+
+
+class BackendConformanceTests(unittest.TestCase):
+    """Every available backend must behave exactly like the stdlib's."""
+
+    def setUp(self):
+        self.backends = [jsonbackend.get_backend(name)
+                         for name in jsonbackend.available_backends()]
+        self.start_time = datetime.datetime(2015, 11, 17, 12, 34, 56)
+        self.request = testing.DummyRequest()
+        self.request.client_addr = "2.3.4.5"
+        self.request.environ["events.start_time"] = self.start_time
+
+    def envelopes(self, backend, body):
+        prefix, suffix = envelope.make_envelope_affixes(
+            self.request.client_addr, self.start_time, backend)
+        return [prefix + raw + suffix
+                for raw in envelope.split_batch(body, backend)]
+
+    def test_stdlib_always_available(self):
+        self.assertIn("stdlib", jsonbackend.available_backends())
+        self.assertEqual(jsonbackend.get_backend().name, "stdlib")
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            jsonbackend.get_backend("yaml")
+
+    @mock.patch.dict(jsonbackend._BACKENDS, {"simplejson": None})
+    @mock.patch("events.jsonbackend._LOG")
+    def test_uninstalled_backend_falls_back(self, log):
+        self.assertNotIn("simplejson", jsonbackend.available_backends())
+        self.assertEqual(jsonbackend.get_backend("simplejson").name, "stdlib")
+        self.assertTrue(log.warning.called)
+
+    def test_same_envelopes(self):
+        for backend in self.backends:
+            for body in CONFORMANCE_BATCHES:
+                self.assertEqual(
+                    self.envelopes(backend, body),
+                    self.envelopes(None, body),
+                    "%s differs for %r" % (backend.name, body))
+
+    def test_same_invalid_batches(self):
+        for backend in self.backends:
+            for body in INVALID_BATCHES:
+                with self.assertRaises(ValueError):
+                    envelope.split_batch(body, backend)
+
+    def test_unicode(self):
+        value = u"caf\xe9 \U0001f357  "
+        for backend in self.backends:
+            self.assertEqual(backend.dumps(value), json.dumps(value))
+            self.assertEqual(backend.loads(json.dumps(value)), value)
+            self.assertEqual(
+                backend.loads('"caf\xc3\xa9 \xf0\x9f\x8d\x97"'),
+                u"caf\xe9 \U0001f357")
+
+    def test_large_numbers(self):
+        raw = "123456789012345678901234567890"
+        for backend in self.backends:
+            self.assertEqual(backend.loads(raw), 123456789012345678901234567890)
+            self.assertEqual(backend.dumps(2 ** 100), str(2 ** 100))
+            # the raw span passes the client's digits through untouched
+            self.assertEqual(
+                envelope.split_batch("[%s, 1.00000000000000000001]" % raw,
+                                     backend),
+                [raw, "1.00000000000000000001"])
+
+    def test_non_finite_numbers_rejected(self):
+        for backend in self.backends:
+            for body in NON_FINITE_BATCHES:
+                with self.assertRaises(ValueError):
+                    envelope.split_batch(body, backend)
+            with self.assertRaises(ValueError):
+                backend.loads("NaN")
+            with self.assertRaises(ValueError):
+                backend.dumps(float("nan"))
+
+    def test_duplicate_keys(self):
+        for backend in self.backends:
+            self.assertEqual(backend.loads('{"dup": 1, "dup": 2}'), {"dup": 2})
+            self.assertEqual(
+                envelope.split_batch('[{"dup": 1, "dup": 2}]', backend),
+                ['{"dup": 1, "dup": 2}'])
+
+    def test_error_envelopes(self):
+        event = {"key": "TestKey", "error": "INVALID_PAYLOAD",
+                 "raw_batch": u"[caf\xe9"}
+        expected = collector.wrap_and_serialize_event(self.request, event)
+        for backend in self.backends:
+            self.assertEqual(
+                collector.wrap_and_serialize_event(
+                    self.request, event, dumps=backend.dumps),
+                expected)
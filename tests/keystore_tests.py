@@ -0,0 +1,88 @@
+import hashlib
+import hmac
+import os
+import shutil
+import signal
+import tempfile
+import unittest
+
+from events.keystore import Keystore, parse_key_file
+
+
+def expected_mac(secret, body):
+    return hmac.new(secret, body, hashlib.sha256).hexdigest()
+
+
+class KeystoreTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.key_file = os.path.join(self.tempdir, "keys")
+        self.write_keys("FileKey = ZmlsZQ==\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write_keys(self, contents, mtime=None):
+        with open(self.key_file, "w") as f:
+            f.write(contents)
+        if mtime:
+            os.utime(self.key_file, (mtime, mtime))
+
+    def test_static_keys(self):
+        keystore = Keystore({"Static": "secret"})
+        mac = keystore.new_mac("Static")
+        mac.update("body")
+        self.assertEqual(mac.hexdigest(), expected_mac("secret", "body"))
+
+    def test_macs_are_independent(self):
+        keystore = Keystore({"Static": "secret"})
+        first = keystore.new_mac("Static")
+        first.update("one")
+        second = keystore.new_mac("Static")
+        second.update("two")
+        self.assertEqual(first.hexdigest(), expected_mac("secret", "one"))
+        self.assertEqual(second.hexdigest(), expected_mac("secret", "two"))
+
+    def test_unknown_key(self):
+        keystore = Keystore({})
+        with self.assertRaises(KeyError):
+            keystore.new_mac("Missing")
+
+    def test_parse_key_file(self):
+        self.write_keys("# comment\n; other comment\n\nA = YQ==\nB=Yg==\n")
+        self.assertEqual(parse_key_file(self.key_file), {"A": "a", "B": "b"})
+
+    def test_parse_malformed_key_file(self):
+        self.write_keys("just garbage\n")
+        with self.assertRaises(ValueError):
+            parse_key_file(self.key_file)
+
+    def test_key_file_reloaded_on_change(self):
+        keystore = Keystore({"Static": "secret"}, key_file=self.key_file,
+                            check_interval=0)
+        self.assertIn("FileKey", keystore)
+
+        self.write_keys("NewKey = bmV3\n", mtime=1234567890)
+        mac = keystore.new_mac("NewKey")
+        mac.update("body")
+        self.assertEqual(mac.hexdigest(), expected_mac("new", "body"))
+        self.assertNotIn("FileKey", keystore)
+        self.assertIn("Static", keystore)
+
+    def test_bad_reload_keeps_old_keys(self):
+        keystore = Keystore({}, key_file=self.key_file, check_interval=0)
+        self.write_keys("garbage\n", mtime=1234567890)
+        keystore.new_mac("FileKey")
+        self.assertIn("FileKey", keystore)
+
+    def test_sighup_reload(self):
+        keystore = Keystore({}, key_file=self.key_file, check_interval=3600)
+        old_handler = signal.getsignal(signal.SIGHUP)
+        try:
+            keystore.install_sighup_handler()
+            stat = os.stat(self.key_file)
+            self.write_keys("NewKey = bmV3\n", mtime=stat.st_mtime)
+            os.kill(os.getpid(), signal.SIGHUP)
+            keystore.new_mac("NewKey")
+        finally:
+            signal.signal(signal.SIGHUP, old_handler)
@@ -0,0 +1,75 @@
+import base64
+from cStringIO import StringIO
+import gzip
+import hashlib
+import hmac
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from events.loadgen import BatchGenerator, Results, load_keys, report
+
+
+class LoadKeysTests(unittest.TestCase):
+    def test_load_keys(self):
+        settings = {
+            "key.One": base64.b64encode("one"),
+            "key.Two": base64.b64encode("two"),
+            "allowed_origins": "example.com",
+        }
+        self.assertEqual(load_keys(settings), [("One", "one"), ("Two", "two")])
+        self.assertEqual(load_keys(settings, ["Two"]), [("Two", "two")])
+
+    def test_key_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        key_file = os.path.join(directory, "keys")
+        with open(key_file, "w") as f:
+            f.write("Two = %s\n" % base64.b64encode("file"))
+        settings = {
+            "key.One": base64.b64encode("one"),
+            "key_file": key_file,
+        }
+        self.assertEqual(load_keys(settings),
+                         [("One", "one"), ("Two", "file")])
+
+
+class BatchGeneratorTests(unittest.TestCase):
+    def test_valid_requests_are_signed(self):
+        generator = BatchGenerator([("Key", "secret")], seed=1)
+        for _ in xrange(10):
+            path, headers, body, kind = generator.make_request()
+            self.assertEqual(kind, "valid")
+            self.assertEqual(path, "/v1")
+            mac = hmac.new("secret", body, hashlib.sha256).hexdigest()
+            self.assertEqual(headers["X-Signature"], "key=Key, mac=" + mac)
+            self.assertIsInstance(json.loads(body), list)
+
+    def test_gzip_and_query_signature(self):
+        generator = BatchGenerator(
+            [("Key", "secret")], gzip_ratio=1., signature="query", seed=1)
+        path, headers, body, kind = generator.make_request()
+        self.assertEqual(headers["Content-Encoding"], "gzip")
+        inflated = gzip.GzipFile(fileobj=StringIO(body)).read()
+        mac = hmac.new("secret", inflated, hashlib.sha256).hexdigest()
+        self.assertEqual(path, "/v1?key=Key&mac=" + mac)
+
+    def test_invalid_mix(self):
+        generator = BatchGenerator(
+            [("Key", "secret")], invalid_ratio=1., seed=1)
+        kinds = set(generator.make_request()[3] for _ in xrange(100))
+        self.assertEqual(
+            kinds, set(["bad_mac", "bad_json", "not_a_list", "no_useragent"]))
+
+
+class ReportTests(unittest.TestCase):
+    def test_report(self):
+        results = Results()
+        results.record(0.001, 200, "valid")
+        results.record(0.003, 403, "bad_mac")
+        out = StringIO()
+        report(results, 2., out=out)
+        self.assertIn("requests: 2 in 2.0s (1.0 req/s)", out.getvalue())
+        self.assertIn("200=1, 403=1", out.getvalue())
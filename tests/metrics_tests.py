@@ -0,0 +1,134 @@
+import unittest
+
+import baseplate
+import mock
+
+from events.metrics import (
+    AggregatingMetricsClient,
+    make_metrics_client,
+    record_timing,
+)
+
+
+class RecordingTransport(baseplate.metrics.Transport):
+    def __init__(self):
+        self.packets = []
+
+    def send(self, serialized_metric):
+        self.packets.append(serialized_metric)
+
+    @property
+    def lines(self):
+        return [line for packet in self.packets
+                for line in packet.splitlines()]
+
+
+class AggregatingMetricsClientTests(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch("events.metrics.time.time")
+        self.time = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.time.return_value = 1000.
+
+        patcher = mock.patch.object(
+            AggregatingMetricsClient, "_start_flusher")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.transport = RecordingTransport()
+        self.client = AggregatingMetricsClient(
+            baseplate.metrics.Client(self.transport, "ns"),
+            flush_interval=10, max_pending=5)
+
+    def test_counters_are_summed(self):
+        self.client.counter("collected.http.Key").increment(3)
+        self.client.counter("collected.http.Key").increment(2)
+        self.client.counter("other").increment(sample_rate=0.5)
+        self.client.counter("zero").increment()
+        self.client.counter("zero").decrement()
+        self.assertEqual(self.transport.packets, [])
+
+        self.client.flush()
+        self.assertEqual(self.transport.packets, [
+            "ns.collected.http.Key:5|c\nns.other:2|c"])
+
+    def test_gauges(self):
+        self.client.gauge("relative").increment(2)
+        self.client.gauge("relative").decrement(5)
+        self.client.gauge("absolute").replace(4)
+        self.client.gauge("absolute").replace(7)
+        self.client.gauge("absolute").increment(1)
+        self.client.flush()
+        self.assertEqual(self.transport.lines, [
+            "ns.absolute:8|g",
+            "ns.relative:-3|g",
+        ])
+
+    def test_timers_keep_samples(self):
+        for elapsed in (1., 2.):
+            self.time.side_effect = [1000., 1000. + elapsed / 1000., 1000.]
+            with self.client.timer("t"):
+                pass
+        self.time.side_effect = None
+        self.client.flush()
+        self.assertEqual(self.transport.lines, ["ns.t:1|ms", "ns.t:2|ms"])
+
+    def test_flush_on_interval(self):
+        self.client.counter("c").increment()
+        self.assertEqual(self.transport.packets, [])
+        self.time.return_value = 1010.
+        self.client.counter("c").increment()
+        self.assertEqual(self.transport.lines, ["ns.c:2|c"])
+
+    def test_flush_on_max_pending(self):
+        timer = self.client.timer("t")
+        for _ in xrange(5):
+            self.client.add_timing(timer.name, 1)
+        self.assertEqual(len(self.transport.lines), 5)
+
+    def test_packets_are_split(self):
+        for i in xrange(200):
+            self.client.counter("counter_number_%d" % i).increment()
+        self.client.flush()
+        self.assertGreater(len(self.transport.packets), 1)
+        self.assertTrue(all(len(packet) <= 1432
+                            for packet in self.transport.packets))
+        self.assertEqual(len(self.transport.lines), 200)
+
+    def test_flush_when_empty(self):
+        self.client.flush()
+        self.assertEqual(self.transport.packets, [])
+
+
+class MakeMetricsClientTests(unittest.TestCase):
+    def test_disabled_by_default(self):
+        client = make_metrics_client({"metrics.namespace": "ns"})
+        self.assertIsInstance(client, baseplate.metrics.Client)
+
+    @mock.patch("events.metrics.atexit")
+    def test_aggregate(self, atexit):
+        client = make_metrics_client({
+            "metrics.namespace": "ns",
+            "metrics.aggregate": "true",
+            "metrics.flush_interval": "5",
+        })
+        self.assertIsInstance(client, AggregatingMetricsClient)
+        self.assertEqual(client.flush_interval, 5.)
+        atexit.register.assert_called_once_with(client.flush)
+
+
+class RecordTimingTests(unittest.TestCase):
+    def test_baseplate_client(self):
+        transport = RecordingTransport()
+        client = baseplate.metrics.Client(transport, "ns")
+        record_timing(client, "size", 1024)
+        self.assertEqual(transport.packets, ["ns.size:1024|ms"])
+
+    @mock.patch.object(AggregatingMetricsClient, "_start_flusher")
+    def test_aggregating_client(self, _):
+        transport = RecordingTransport()
+        client = AggregatingMetricsClient(
+            baseplate.metrics.Client(transport, "ns"))
+        record_timing(client, "size", 1024)
+        client.flush()
+        self.assertEqual(transport.lines, ["ns.size:1024|ms"])
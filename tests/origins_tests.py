@@ -0,0 +1,46 @@
+import unittest
+
+from events.origins import OriginMatcher
+
+
+class OriginMatcherTests(unittest.TestCase):
+    def test_allow_all(self):
+        matcher = OriginMatcher(["*"])
+        self.assertTrue(matcher.is_allowed("https://anything.example"))
+        self.assertTrue(matcher.is_allowed("ftp://anything.example:21"))
+
+    def test_domain_and_subdomains(self):
+        matcher = OriginMatcher(["example.com", "other.org"])
+        self.assertTrue(matcher.is_allowed("https://example.com"))
+        self.assertTrue(matcher.is_allowed("http://www.example.com"))
+        self.assertTrue(matcher.is_allowed("https://a.b.other.org"))
+        self.assertFalse(matcher.is_allowed("https://notexample.com"))
+        self.assertFalse(matcher.is_allowed("https://example.com.evil.net"))
+        self.assertFalse(matcher.is_allowed("https://com"))
+
+    def test_scheme(self):
+        matcher = OriginMatcher(["example.com"])
+        self.assertFalse(matcher.is_allowed("ftp://example.com"))
+        self.assertFalse(matcher.is_allowed("example.com"))
+
+    def test_ports(self):
+        matcher = OriginMatcher(["example.com"])
+        self.assertTrue(matcher.is_allowed("http://example.com:80"))
+        self.assertTrue(matcher.is_allowed("https://example.com:443"))
+        self.assertFalse(matcher.is_allowed("https://example.com:8443"))
+        self.assertFalse(matcher.is_allowed("https://example.com:bogus"))
+
+    def test_no_hostname(self):
+        matcher = OriginMatcher(["example.com"])
+        self.assertFalse(matcher.is_allowed("https://"))
+        self.assertFalse(matcher.is_allowed("null"))
+
+    def test_cache_is_bounded(self):
+        matcher = OriginMatcher(["example.com"], cache_size=2)
+        matcher.is_allowed("https://a.example.com")
+        matcher.is_allowed("https://b.example.com")
+        matcher.is_allowed("https://a.example.com")
+        matcher.is_allowed("https://c.example.com")
+        self.assertEqual(
+            list(matcher._cache),
+            ["https://a.example.com", "https://c.example.com"])
@@ -0,0 +1,102 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+from events import ratelimit
+
+
+class ParseLimitsTests(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(ratelimit.parse_limits("1000, 1048576"),
+                         (1000, 1048576))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            ratelimit.parse_limits("1000")
+
+
+class RateLimiterTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "ratelimit")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_limiter(self, limits, **kwargs):
+        limiter = ratelimit.RateLimiter(
+            limits, path=self.path, capacity=64, **kwargs)
+        self.addCleanup(limiter.table.close)
+        return limiter
+
+    def test_unlimited(self):
+        limiter = self.make_limiter({})
+        for _ in xrange(100):
+            self.assertEqual(limiter.acquire("TestKey1", 1000, 10 ** 6), 0)
+
+    def test_events_limit(self):
+        limiter = self.make_limiter({"TestKey1": (10, 0)}, burst=1)
+        self.assertEqual(limiter.acquire("TestKey1", 6, 100), 0)
+        self.assertEqual(limiter.acquire("TestKey1", 4, 100), 0)
+        wait = limiter.acquire("TestKey1", 5, 100)
+        self.assertGreater(wait, 0.4)
+        self.assertLessEqual(wait, 0.5)
+        # other keys have their own buckets
+        self.assertEqual(limiter.acquire("TestKey2", 5, 100), 0)
+
+    def test_bytes_limit(self):
+        limiter = self.make_limiter({}, default_limits=(0, 1000), burst=1)
+        self.assertEqual(limiter.acquire("TestKey1", 1, 900), 0)
+        self.assertGreater(limiter.acquire("TestKey1", 1, 200), 0)
+        self.assertEqual(limiter.acquire("TestKey1", 1, 100), 0)
+
+    def test_rejected_batches_take_nothing(self):
+        limiter = self.make_limiter({"TestKey1": (10, 0)}, burst=1)
+        self.assertEqual(limiter.acquire("TestKey1", 8, 0), 0)
+        self.assertGreater(limiter.acquire("TestKey1", 5, 0), 0)
+        self.assertEqual(limiter.acquire("TestKey1", 2, 0), 0)
+
+    def test_refill(self):
+        limiter = self.make_limiter({"TestKey1": (1000, 0)}, burst=0.01)
+        self.assertEqual(limiter.acquire("TestKey1", 10, 0), 0)
+        self.assertGreater(limiter.acquire("TestKey1", 10, 0), 0)
+        time.sleep(0.02)
+        self.assertEqual(limiter.acquire("TestKey1", 10, 0), 0)
+
+    def test_oversized_batch_allowed_when_full(self):
+        limiter = self.make_limiter({"TestKey1": (10, 0)}, burst=1)
+        self.assertEqual(limiter.acquire("TestKey1", 50, 0), 0)
+        self.assertGreater(limiter.acquire("TestKey1", 1, 0), 4)
+
+    @mock.patch("events.ratelimit.time.time")
+    def test_bucket_in_debt_is_not_reclaimable(self, now):
+        now.return_value = 1000.
+        limiter = self.make_limiter({"TestKey1": (10, 0)}, burst=1)
+        self.assertEqual(limiter.acquire("TestKey1", 50, 0), 0)
+        bucket = limiter.table.update(
+            "TestKey1", lambda current: (None, current))
+
+        # refilled from -40 to -30, forgetting it would forgive the debt
+        now.return_value = 1001.
+        self.assertFalse(limiter._is_full(bucket))
+        now.return_value = 1005.
+        self.assertTrue(limiter._is_full(bucket))
+
+    def test_shared_between_processes(self):
+        # a process must not open the same table twice
+        pid = os.fork()
+        if pid == 0:
+            try:
+                ratelimit.RateLimiter(
+                    {"TestKey1": (10, 0)}, burst=1, path=self.path,
+                    capacity=64).acquire("TestKey1", 10, 0)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+        limiter = self.make_limiter({"TestKey1": (10, 0)}, burst=1)
+        self.assertGreater(limiter.acquire("TestKey1", 1, 0), 0)
@@ -0,0 +1,101 @@
+import unittest
+
+from kafka import KafkaProducer
+from kafka.common import KafkaTimeoutError
+from kafka.future import Future
+import mock
+
+from events.retry import RetryScheduler
+
+
+class RetrySchedulerTests(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch("events.retry.time.time")
+        self.time = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.time.return_value = 1000.
+
+        self.dead_letter = mock.Mock()
+        self.metrics_client = mock.Mock()
+        self.scheduler = RetryScheduler(
+            dead_letter=self.dead_letter,
+            metrics_client=self.metrics_client,
+            max_attempts=3, base_delay=1., max_delay=3., jitter=0.,
+            max_pending=2)
+        self.producer = mock.create_autospec(KafkaProducer)
+
+    def test_delay_backs_off(self):
+        self.assertEqual(
+            [self.scheduler.delay(n) for n in (1, 2, 3, 4)], [1., 2., 3., 3.])
+
+    def test_empty_scheduler_is_true(self):
+        # the injector checks "if retry_scheduler:" to see if it has one
+        self.assertTrue(RetryScheduler())
+
+    def test_jitter(self):
+        scheduler = RetryScheduler(base_delay=1., jitter=0.5, seed=1)
+        for _ in xrange(100):
+            self.assertTrue(0.5 <= scheduler.delay(1) <= 1.)
+
+    def test_errback_schedules_retry(self):
+        self.scheduler.errback("topic", "event")(Exception("boom"))
+        self.assertEqual(self.scheduler.pending_count, 1)
+        self.assertEqual(self.scheduler.time_until_due(), 1.)
+
+        self.scheduler.resend_due(self.producer)
+        self.assertFalse(self.producer.send.called)
+
+        self.time.return_value = 1001.
+        self.producer.send.return_value = Future()
+        self.scheduler.resend_due(self.producer)
+        self.producer.send.assert_called_once_with("topic", "event")
+        self.assertEqual(self.scheduler.pending_count, 0)
+
+    def test_retries_count_attempts_then_dead_letter(self):
+        self.producer.send.side_effect = lambda topic, event: \
+            Future().failure(Exception("boom"))
+        self.scheduler.errback("topic", "event")(Exception("boom"))
+        for now in (1001., 1003.):
+            self.time.return_value = now
+            self.scheduler.resend_due(self.producer)
+        self.assertEqual(self.producer.send.call_count, 2)
+        self.assertEqual(self.scheduler.time_until_due(), 0)
+
+        self.scheduler.resend_due(self.producer)
+        self.dead_letter.send.assert_called_once_with("topic", "event")
+        self.dead_letter.flush.assert_called_once_with()
+        self.assertEqual(self.scheduler.pending_count, 0)
+        self.metrics_client.counter.assert_any_call("injector.dead_letter")
+
+    def test_success_callback(self):
+        self.scheduler.schedule("topic", "event", 1)
+        self.time.return_value = 1001.
+        self.producer.send.return_value = Future().success(None)
+        success_cb = mock.Mock()
+        self.scheduler.resend_due(self.producer, success_cb)
+        success_cb.assert_called_once_with(None)
+
+    def test_producer_timeout_reschedules(self):
+        self.scheduler.schedule("topic", "a", 1)
+        self.scheduler.schedule("topic", "b", 1)
+        self.time.return_value = 1001.
+        self.producer.send.side_effect = KafkaTimeoutError()
+        self.scheduler.resend_due(self.producer)
+        self.assertEqual(self.producer.send.call_count, 1)
+        self.assertEqual(self.scheduler.pending_count, 2)
+        self.assertFalse(self.dead_letter.send.called)
+
+    def test_is_full(self):
+        self.scheduler.schedule("topic", "a", 1)
+        self.assertFalse(self.scheduler.is_full())
+        self.scheduler.schedule("topic", "b", 1)
+        self.assertTrue(self.scheduler.is_full())
+
+    def test_take_pending(self):
+        self.scheduler.schedule("topic", "later", 2)
+        self.scheduler.schedule("topic", "sooner", 1)
+        self.scheduler.schedule("topic", "dead", 3)
+        self.assertEqual(self.scheduler.take_pending(), [
+            ("topic", "sooner"), ("topic", "later"), ("topic", "dead")])
+        self.assertEqual(self.scheduler.pending_count, 0)
+        self.assertEqual(self.scheduler.take_pending(), [])
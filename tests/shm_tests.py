@@ -0,0 +1,88 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from events import shm
+
+
+def increment(current):
+    value = (current[0] if current else 0) + 1
+    return (value,), value
+
+
+def read(current):
+    return None, current
+
+
+class SharedHashTableTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "table")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_update(self):
+        table = shm.SharedHashTable(self.path, 64, "!q")
+        self.assertIsNone(table.update("a", read))
+        self.assertEqual(table.update("a", increment), 1)
+        self.assertEqual(table.update("a", increment), 2)
+        self.assertEqual(table.update("b", increment), 1)
+        self.assertEqual(table.update("a", read), (2,))
+        table.close()
+
+    def test_shared_through_file(self):
+        table = shm.SharedHashTable(self.path, 64, "!q")
+        table.update("a", increment)
+        table.close()
+
+        table = shm.SharedHashTable(self.path, 64, "!q")
+        self.assertEqual(table.update("a", read), (1,))
+        table.close()
+
+    def test_layout_mismatch(self):
+        shm.SharedHashTable(self.path, 64, "!q").close()
+        with self.assertRaises(shm.LayoutMismatchError):
+            shm.SharedHashTable(self.path, 128, "!q")
+        with self.assertRaises(shm.LayoutMismatchError):
+            shm.SharedHashTable(self.path, 64, "!d")
+
+    def test_full_bucket_evicts(self):
+        table = shm.SharedHashTable(self.path, 4, "!q", ways=4)
+        for key in "abcdef":
+            table.update(key, increment)
+        self.assertEqual(table.capacity, 4)
+        remembered = [key for key in "abcdef" if table.update(key, read)]
+        self.assertEqual(len(remembered), 4)
+        self.assertIn("f", remembered)
+        table.close()
+
+    def test_reclaimable_slots_are_reused_first(self):
+        table = shm.SharedHashTable(self.path, 2, "!q", ways=2,
+                                    reclaimable=lambda value: value[0] < 0)
+        table.update("stale", lambda current: ((-1,), None))
+        table.update("live", increment)
+        table.update("new", increment)
+        self.assertIsNone(table.update("stale", read))
+        self.assertEqual(table.update("live", read), (1,))
+        self.assertEqual(table.update("new", read), (1,))
+        table.close()
+
+    def test_concurrent_processes(self):
+        table = shm.SharedHashTable(self.path, 64, "!q")
+        pids = []
+        for _ in xrange(4):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    for _ in xrange(250):
+                        table.update("counter", increment)
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+
+        self.assertEqual(table.update("counter", read), (1000,))
+        table.close()
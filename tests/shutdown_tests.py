@@ -0,0 +1,130 @@
+import os
+import shutil
+import signal
+import tempfile
+import unittest
+
+from baseplate.message_queue import MessageQueue, TimedOutError
+from kafka.future import Future
+import mock
+
+from events.shutdown import (
+    InFlightTracker,
+    ShutdownFlag,
+    instance_spill_path,
+    requeue_or_spill,
+    take_spilled,
+)
+from events.sinks import NullSink
+
+
+class ShutdownFlagTests(unittest.TestCase):
+    @mock.patch("events.shutdown.signal.signal")
+    def test_install(self, signal_signal):
+        flag = ShutdownFlag()
+        flag.install()
+        signal_signal.assert_any_call(signal.SIGTERM, flag.request)
+        signal_signal.assert_any_call(signal.SIGINT, flag.request)
+
+        self.assertFalse(flag.requested)
+        flag.request(signal.SIGTERM, None)
+        self.assertTrue(flag.requested)
+
+
+class InFlightTrackerTests(unittest.TestCase):
+    def setUp(self):
+        self.sink = mock.Mock()
+        self.tracker = InFlightTracker(self.sink)
+
+    def test_resolved_sends_are_forgotten(self):
+        futures = [Future(), Future(), Future()]
+        self.sink.send.side_effect = futures
+        for value in ("a", "b", "c"):
+            self.tracker.send("topic", value)
+        self.assertEqual(self.tracker.in_flight_count, 3)
+
+        futures[0].success(None)
+        futures[2].failure(Exception())
+        self.assertEqual(self.tracker.take_unacknowledged(), [("topic", "b")])
+        self.assertEqual(self.tracker.take_unacknowledged(), [])
+
+    def test_already_resolved(self):
+        tracker = InFlightTracker(NullSink())
+        tracker.send("topic", "a")
+        self.assertEqual(tracker.in_flight_count, 0)
+
+    def test_errback_sees_event_gone(self):
+        future = Future()
+        self.sink.send.return_value = future
+        seen = []
+        self.tracker.send("topic", "a").add_errback(
+            lambda exc: seen.append(self.tracker.in_flight_count))
+        future.failure(Exception())
+        self.assertEqual(seen, [0])
+
+    def test_close_passes_timeout(self):
+        self.tracker.close(timeout=5)
+        self.sink.close.assert_called_once_with(timeout=5)
+
+
+class RequeueTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spill_path = os.path.join(self.directory, "spill")
+        self.events_queue = mock.create_autospec(MessageQueue)
+        self.errors_queue = mock.create_autospec(MessageQueue)
+        self.queues = {"Events": self.events_queue,
+                       "Errors": self.errors_queue}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_requeue(self):
+        lost = requeue_or_spill(
+            [("Events", "a"), ("Errors", "b")], self.queues, self.spill_path)
+        self.assertEqual(lost, 0)
+        self.events_queue.put.assert_called_once_with("a", timeout=0)
+        self.errors_queue.put.assert_called_once_with("b", timeout=0)
+        self.assertFalse(os.path.exists(self.spill_path))
+
+    def test_spill_when_full_and_replay(self):
+        self.events_queue.put.side_effect = TimedOutError()
+        lost = requeue_or_spill(
+            [("Events", "a\\nb"), ("Errors", "c"), ("Events", "d")],
+            self.queues, self.spill_path)
+        self.assertEqual(lost, 0)
+
+        self.assertEqual(take_spilled(self.spill_path),
+                         [("Events", "a\\nb"), ("Events", "d")])
+        self.assertFalse(os.path.exists(self.spill_path))
+        self.assertEqual(take_spilled(self.spill_path), [])
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_instance_spill_path(self):
+        self.assertEqual(
+            instance_spill_path(self.spill_path, ["events", "errors"], "2"),
+            self.spill_path + ".events+errors.2")
+        self.assertEqual(instance_spill_path(self.spill_path, ["events"]),
+                         self.spill_path + ".events")
+        self.assertIsNone(instance_spill_path(None, ["events"]))
+
+    def test_spill_claimed_by_one_replayer(self):
+        requeue_or_spill([("Unknown", "a")], self.queues, self.spill_path)
+        real_rename = os.rename
+
+        def rename_after_another(source, destination):
+            # another injector claims the file between our looking and taking
+            real_rename(source, source + ".replaying.other")
+            real_rename(source, destination)
+
+        with mock.patch("events.shutdown.os.rename", rename_after_another):
+            self.assertEqual(take_spilled(self.spill_path), [])
+
+    def test_lost_without_spill(self):
+        self.events_queue.put.side_effect = TimedOutError()
+        metrics_client = mock.Mock()
+        lost = requeue_or_spill(
+            [("Events", "a"), ("Unknown", "b")], self.queues,
+            metrics_client=metrics_client)
+        self.assertEqual(lost, 2)
+        metrics_client.counter.assert_called_once_with("injector.shutdown_lost")
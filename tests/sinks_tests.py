@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from kafka.common import KafkaTimeoutError
+
+from events import sinks
+
+
+class NullSinkTests(unittest.TestCase):
+    def test_send(self):
+        future = sinks.NullSink().send("topic", "value")
+        self.assertTrue(future.succeeded())
+
+
+class FileSinkTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "events")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_send(self):
+        sink = sinks.FileSink(self.path)
+        self.assertTrue(sink.send("Events", '{"a": 1}').succeeded())
+        sink.send("Errors", "two\nlines")
+        sink.close()
+
+        with open(self.path) as f:
+            self.assertEqual(
+                f.read(), 'Events 8\n{"a": 1}\nErrors 9\ntwo\nlines\n')
+
+        self.assertEqual(list(sinks.read_file_sink(self.path)),
+                         [("Events", '{"a": 1}'), ("Errors", "two\nlines")])
+
+
+class FakeBrokerSinkTests(unittest.TestCase):
+    def test_acknowledges_after_latency(self):
+        sink = sinks.FakeBrokerSink(ack_latency=0.01)
+        futures = [sink.send("topic", "value") for _ in xrange(10)]
+        sink.flush()
+        self.assertTrue(all(future.succeeded() for future in futures))
+        self.assertEqual(len(sink.ack_latencies), 10)
+        self.assertTrue(all(latency >= 0.01
+                            for latency in sink.ack_latencies))
+        sink.close()
+
+    def test_flush_timeout(self):
+        sink = sinks.FakeBrokerSink(ack_latency=10)
+        future = sink.send("topic", "value")
+        with self.assertRaises(AssertionError):
+            sink.flush(timeout=0.01)
+        self.assertFalse(future.is_done)
+        sink.close(timeout=0)
+
+    def test_failures(self):
+        sink = sinks.FakeBrokerSink(ack_latency=0, failure_rate=1.)
+        future = sink.send("topic", "value")
+        sink.flush()
+        self.assertTrue(future.failed())
+        self.assertIsInstance(future.exception, sinks.FakeBrokerError)
+        sink.close()
+
+    def test_timeouts(self):
+        sink = sinks.FakeBrokerSink(timeout_rate=1.)
+        with self.assertRaises(KafkaTimeoutError):
+            sink.send("topic", "value")
+        sink.close()
+
+    def test_close_with_deadline_fails_the_rest(self):
+        sink = sinks.FakeBrokerSink(ack_latency=60)
+        future = sink.send("topic", "value")
+        sink.close(timeout=0.01)
+        self.assertTrue(future.failed())
+
+
+class MakeSinkTests(unittest.TestCase):
+    def test_null(self):
+        sink = sinks.make_sink({"sink": "null"}, {})
+        self.assertIsInstance(sink, sinks.NullSink)
+
+    def test_fake(self):
+        sink = sinks.make_sink(
+            {"sink": "fake", "sink.fake.ack_latency_ms": "20"}, {})
+        self.assertIsInstance(sink, sinks.FakeBrokerSink)
+        self.assertEqual(sink.ack_latency, 0.02)
+        sink.close()
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            sinks.make_sink({"sink": "carrier-pigeon"}, {})
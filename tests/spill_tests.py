@@ -0,0 +1,178 @@
+import errno
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+from baseplate.message_queue import TimedOutError
+
+from events import spill
+
+
+class BoundedQueue(object):
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.messages = []
+
+    def put(self, message, timeout=None):
+        if len(self.messages) >= self.capacity:
+            raise TimedOutError
+        self.messages.append(message)
+
+
+class SpillLogTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def drain(self, log):
+        messages = []
+        while True:
+            message = log.peek()
+            if message is None:
+                return messages
+            messages.append(message)
+            log.pop()
+
+    def test_append_and_replay(self):
+        log = spill.SpillLog(self.directory, segment_size=1024)
+        log.append("one")
+        log.append("two")
+        self.assertEqual(log.depth, 2)
+        self.assertEqual(log.bytes, 6)
+        self.assertEqual(self.drain(log), ["one", "two"])
+        self.assertEqual(log.depth, 0)
+        self.assertEqual(log.bytes, 0)
+
+    def test_segment_rotation(self):
+        log = spill.SpillLog(self.directory, segment_size=64)
+        messages = ["message %02d" % i for i in xrange(20)]
+        for message in messages:
+            log.append(message)
+        segments = [f for f in os.listdir(self.directory)
+                    if f.endswith(".spill")]
+        self.assertGreater(len(segments), 1)
+
+        self.assertEqual(self.drain(log), messages)
+        segments = [f for f in os.listdir(self.directory)
+                    if f.endswith(".spill")]
+        self.assertEqual(len(segments), 1)
+
+    def test_message_too_large(self):
+        log = spill.SpillLog(self.directory, segment_size=16)
+        with self.assertRaises(ValueError):
+            log.append("x" * 16)
+
+    def test_segments_preallocated(self):
+        log = spill.SpillLog(self.directory, segment_size=64 * 1024)
+        log.append("one")
+        segment = os.path.join(self.directory, "000000000000.spill")
+        self.assertGreaterEqual(os.stat(segment).st_blocks * 512, 64 * 1024)
+        log.close()
+
+    def test_disk_full(self):
+        log = spill.SpillLog(self.directory, segment_size=64)
+        messages = ["message %02d" % i for i in xrange(5)]
+        for message in messages[:4]:
+            log.append(message)
+
+        with mock.patch("events.spill.os.write",
+                        side_effect=OSError(errno.ENOSPC, "No space")):
+            with self.assertRaises(EnvironmentError):
+                log.append(messages[4])
+
+        # nothing was lost and the log carries on once there is room
+        log.append(messages[4])
+        self.assertEqual(self.drain(log), messages)
+
+    def test_max_bytes(self):
+        log = spill.SpillLog(self.directory, segment_size=64, max_bytes=128)
+        for i in xrange(8):
+            log.append("message %02d" % i)
+        with self.assertRaises(spill.SpillLogFullError):
+            log.append("message 08")
+
+        # replaying frees segments up again
+        self.assertEqual(len(self.drain(log)), 8)
+        log.append("message 08")
+
+    def test_recovery(self):
+        log = spill.SpillLog(self.directory, segment_size=64)
+        for i in xrange(10):
+            log.append("message %d" % i)
+        for _ in xrange(3):
+            log.peek()
+            log.pop()
+        log.close()
+
+        log = spill.SpillLog(self.directory, segment_size=64)
+        self.assertEqual(log.depth, 7)
+        log.append("message 10")
+        self.assertEqual(
+            self.drain(log), ["message %d" % i for i in xrange(3, 11)])
+
+    def test_lock(self):
+        log = spill.SpillLog(self.directory)
+        with self.assertRaises(spill.SpillLogLockedError):
+            spill.SpillLog(self.directory)
+        log.close()
+        spill.SpillLog(self.directory).close()
+
+    def test_open_free_slot(self):
+        first = spill.SpillLog.open_free_slot(self.directory, max_slots=2)
+        second = spill.SpillLog.open_free_slot(self.directory, max_slots=2)
+        self.assertNotEqual(first.directory, second.directory)
+        with self.assertRaises(spill.SpillLogLockedError):
+            spill.SpillLog.open_free_slot(self.directory, max_slots=2)
+
+
+class SpillingQueueTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log = spill.SpillLog(self.directory, segment_size=1024)
+        self.queue = BoundedQueue(capacity=2)
+        self.spilling_queue = spill.SpillingQueue(self.queue, self.log)
+
+    def tearDown(self):
+        self.log.close()
+        shutil.rmtree(self.directory)
+
+    def test_spills_when_full(self):
+        for message in ("1", "2", "3", "4"):
+            self.spilling_queue.put(message)
+        self.assertEqual(self.queue.messages, ["1", "2"])
+        self.assertEqual(self.log.depth, 2)
+
+    def test_blocks_when_spill_log_full(self):
+        self.log.max_bytes = self.log.segment_size
+        # two fit on the queue and a segment holds 44 records of 23 bytes
+        for i in xrange(2 + 44):
+            self.spilling_queue.put("%019d" % i)
+        self.assertEqual(self.log.depth, 44)
+        with self.assertRaises(TimedOutError):
+            self.spilling_queue.put("%019d" % 46, timeout=0)
+
+    def test_drain_preserves_order(self):
+        for message in ("1", "2", "3"):
+            self.spilling_queue.put(message)
+        del self.queue.messages[:]
+
+        # this fits on the queue, but must wait behind the spilled message
+        self.spilling_queue.put("4")
+        self.assertEqual(self.queue.messages, [])
+
+        self.assertEqual(self.spilling_queue.drain(), 2)
+        self.assertEqual(self.queue.messages, ["3", "4"])
+        self.assertEqual(self.log.depth, 0)
+
+    def test_drain_stops_when_full(self):
+        for message in ("1", "2", "3", "4", "5"):
+            self.spilling_queue.put(message)
+        del self.queue.messages[:1]
+
+        self.assertEqual(self.spilling_queue.drain(), 1)
+        self.assertEqual(self.queue.messages, ["2", "3"])
+        self.assertEqual(self.log.depth, 2)
@@ -0,0 +1,41 @@
+import unittest
+
+import mock
+
+from events.stats import RequestStats, percentile, summarize_latencies
+
+
+class PercentileTests(unittest.TestCase):
+    def test_percentile(self):
+        values = range(101)
+        self.assertEqual(percentile(values, 0.5), 50)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile([], 0.5), None)
+
+    def test_summarize_latencies(self):
+        self.assertEqual(summarize_latencies([0.002, 0.001, 0.003]),
+                         {"p50": 2., "p90": 3., "p99": 3.})
+
+
+class RequestStatsTests(unittest.TestCase):
+    @mock.patch("events.stats.time.time")
+    def test_snapshot(self, time):
+        time.return_value = 100.
+        stats = RequestStats(window=2)
+
+        for now, keyname, status in [(101., "A", 200), (102., "A", 403),
+                                     (103., "B", 200), (104., "A", 200)]:
+            time.return_value = now
+            stats.record(keyname, status, 0.01)
+
+        time.return_value = 105.
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot["requests"], 4)
+        self.assertEqual(snapshot["requests_per_second"]["lifetime"], 0.8)
+        self.assertEqual(snapshot["requests_per_second"]["recent"], 1.)
+        self.assertEqual(snapshot["latency_ms"]["p50"], 10.)
+        self.assertEqual(snapshot["keys"], {
+            "A": {"accepted": 2, "rejected": 1,
+                  "statuses": {"200": 2, "403": 1}},
+            "B": {"accepted": 1, "rejected": 0, "statuses": {"200": 1}},
+        })
@@ -0,0 +1,217 @@
+import os
+import select
+import shutil
+import struct
+import tempfile
+import unittest
+
+from baseplate.message_queue import TimedOutError
+
+from events import ring, shm
+from events.transport import make_queue
+
+
+class RingQueueTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "ring")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_ring(self, lanes=4, lane_size=1024, max_message_size=100):
+        return ring.RingQueue(self.path, max_message_size, lanes=lanes,
+                              lane_size=lane_size)
+
+    def test_put_get(self):
+        queue = self.make_ring()
+        for message in ("a", "", "b" * 100):
+            queue.put(message)
+        self.assertEqual(queue.depth, 3 * 4 + 101)
+        self.assertEqual(queue.capacity, 1024)
+        self.assertEqual(queue.get(), "a")
+        self.assertEqual(queue.get(), "")
+        self.assertEqual(queue.get(), "b" * 100)
+        self.assertEqual(queue.depth, 0)
+        with self.assertRaises(TimedOutError):
+            queue.get(timeout=0)
+        with self.assertRaises(TimedOutError):
+            queue.get(timeout=0.01)
+        queue.close()
+
+    def test_wraps_around(self):
+        queue = self.make_ring(lanes=1, lane_size=256)
+        for i in xrange(100):
+            # sizes that leave too little room for a wrap marker sometimes
+            message = str(i) * (i % 7 + 20)
+            queue.put(message, timeout=0)
+            queue.put(message[::-1], timeout=0)
+            self.assertEqual(queue.get(timeout=0), message)
+            self.assertEqual(queue.get(timeout=0), message[::-1])
+        queue.close()
+
+    def test_full(self):
+        queue = self.make_ring(lanes=1, lane_size=256)
+        queue.put("x" * 100, timeout=0)
+        queue.put("x" * 100, timeout=0)
+        with self.assertRaises(TimedOutError):
+            queue.put("x" * 100, timeout=0)
+        with self.assertRaises(TimedOutError):
+            queue.put("x" * 100, timeout=0.01)
+        queue.get()
+        queue.put("y" * 100, timeout=0)
+        queue.close()
+
+    def test_too_big(self):
+        queue = self.make_ring()
+        with self.assertRaises(ValueError):
+            queue.put("x" * 101)
+        queue.close()
+        with self.assertRaises(ValueError):
+            ring.RingQueue(self.path + "2", 1000, lane_size=1024)
+
+    def test_layout_mismatch(self):
+        self.make_ring().close()
+        with self.assertRaises(shm.LayoutMismatchError):
+            self.make_ring(lanes=8)
+
+    def test_producer_processes(self):
+        queue = self.make_ring(lanes=4, lane_size=4096)
+        pids = []
+        for producer in xrange(3):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    for i in xrange(200):
+                        queue.put("%d:%d" % (producer, i))
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+
+        received = {}
+        for _ in xrange(600):
+            producer, i = queue.get(timeout=5).split(":")
+            received.setdefault(producer, []).append(int(i))
+        for pid in pids:
+            os.waitpid(pid, 0)
+
+        self.assertEqual(received, {
+            str(producer): range(200) for producer in xrange(3)})
+        queue.close()
+
+    def test_lanes_exhausted(self):
+        queue = self.make_ring(lanes=1)
+        queue.put("parent")
+        pid = os.fork()
+        if pid == 0:
+            try:
+                queue.put("child")
+            except ring.NoFreeLaneError:
+                os._exit(0)
+            finally:
+                os._exit(1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        queue.close()
+
+    def test_crashed_producer(self):
+        queue = self.make_ring(lanes=1)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                queue.put("before the crash")
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+        # its lane is free again and what it put is still there
+        queue.put("after the crash")
+        self.assertEqual(queue.get(timeout=0), "before the crash")
+        self.assertEqual(queue.get(timeout=0), "after the crash")
+        queue.close()
+
+    def test_restarted_consumer(self):
+        queue = self.make_ring()
+        for message in ("a", "b", "c"):
+            queue.put(message)
+        self.assertEqual(queue.get(timeout=0), "a")
+        queue.close()
+
+        queue = self.make_ring()
+        self.assertEqual(queue.get(timeout=0), "b")
+        self.assertEqual(queue.get(timeout=0), "c")
+        queue.close()
+
+    def test_inconsistent_lane_emptied(self):
+        queue = self.make_ring()
+        queue.put("a")
+        queue.close()
+
+        with open(self.path, "r+b") as f:
+            f.seek(64 + 64)  # lane 0's head
+            f.write(struct.pack("=Q", 10 ** 9))
+
+        queue = self.make_ring()
+        with self.assertRaises(TimedOutError):
+            queue.get(timeout=0)
+        queue.put("b")
+        self.assertEqual(queue.get(timeout=0), "b")
+        queue.close()
+
+    def test_single_consumer(self):
+        queue = self.make_ring()
+        queue.fileno()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                queue.get(timeout=0)
+            except ring.ConsumerLockedError:
+                os._exit(0)
+            finally:
+                os._exit(1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        queue.close()
+
+    def test_doorbell(self):
+        queue = self.make_ring()
+        fd = queue.fileno()
+        self.assertEqual(select.select([fd], [], [], 0)[0], [])
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                queue.put("ding")
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+        self.assertEqual(select.select([fd], [], [], 1)[0], [fd])
+        self.assertEqual(queue.get(timeout=0), "ding")
+        with self.assertRaises(TimedOutError):
+            queue.get(timeout=0)
+        self.assertEqual(select.select([fd], [], [], 0)[0], [])
+        queue.close()
+
+
+class MakeQueueTests(unittest.TestCase):
+    def test_ring(self):
+        directory = tempfile.mkdtemp()
+        try:
+            queue = make_queue({
+                "transport": "ring",
+                "transport.ring.directory": directory,
+                "transport.ring.lanes": "2",
+                "transport.ring.lane_size": "1048576",
+            }, "errors")
+            self.assertIsInstance(queue, ring.RingQueue)
+            self.assertEqual(queue.path,
+                             os.path.join(directory, "event-collector-errors"))
+            self.assertEqual(queue.lanes, 2)
+            queue.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            make_queue({"transport": "carrier-pigeon"}, "events")
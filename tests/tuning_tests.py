@@ -0,0 +1,51 @@
+import unittest
+
+import mock
+
+from events.tuning import ProducerTuner
+
+
+class ProducerTunerTests(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch("events.tuning.time.time")
+        self.time = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.time.return_value = 1000.
+
+        self.metrics_client = mock.Mock()
+        self.tuner = ProducerTuner(
+            batch_size=16384, linger_ms=10,
+            metrics_client=self.metrics_client, interval=10)
+
+    def simulate(self, records, size, ack_latency):
+        for _ in xrange(records):
+            self.tuner.record_send(size)
+        self.tuner.record_ack(ack_latency, count=records)
+
+    def test_waits_for_interval(self):
+        self.simulate(100000, 1000, 0.2)
+        self.time.return_value = 1005.
+        self.assertFalse(self.tuner.should_retune())
+
+    def test_no_traffic_keeps_settings(self):
+        self.time.return_value = 1010.
+        self.assertFalse(self.tuner.should_retune())
+        self.assertEqual(self.tuner.options,
+                         {"batch_size": 16384, "linger_ms": 10})
+
+    def test_heavy_traffic_grows_batches(self):
+        # 10k records/sec of 1KB each, acked in 200ms
+        self.simulate(100000, 1000, 0.2)
+        self.time.return_value = 1010.
+        self.assertTrue(self.tuner.should_retune())
+        self.assertEqual(self.tuner.options,
+                         {"batch_size": 1024 * 1024, "linger_ms": 100})
+        self.metrics_client.gauge.assert_any_call(
+            "injector.producer.batch_size")
+
+    def test_small_change_is_ignored(self):
+        # acks in 30ms suggest a 15ms linger, not enough to recreate for
+        self.simulate(100, 100, 0.03)
+        self.time.return_value = 1010.
+        self.assertFalse(self.tuner.should_retune())
+        self.assertEqual(self.tuner.linger_ms, 10)